@@ -4,13 +4,13 @@ import sqlite3
 import sys
 
 import pandas as pd
-import requests
 import streamlit as st
 
 import util.agents as agents
 import util.contracts as contracts
 import util.market as market
 import util.nav as nav
+import util.schema as schema
 import util.ships as ships
 import util.streamlit_util as stu
 
@@ -25,6 +25,9 @@ st.set_page_config(
 
 st.title("Space Traders")
 
+#Bring the SQLite schema up to date, only does work the first time in each process
+schema.apply_migrations()
+
 ###################################################
 #Streamlit Session State Keys 
 agentKey = "agent"
@@ -54,14 +57,14 @@ with st.sidebar:
 shipsTab, contractsTab, marketTab = st.tabs(["Ships", "Contracts", "Market"])
 
 #Get all waypoints for the Entire Universe. Used for plotting and navigation
-waypointsDf = nav.get_all_waypoints(st.session_state[agentKey].get_agent_token())
+waypointsDf = nav.get_all_waypoints(st.session_state[agentKey].get_agent_token(), asDataFrame = True)
 
 #Ship Tab for interactign with Ships
 with shipsTab:
     st.header("Ships")
 
-    #Get Ships for the Agent
-    shipsList = st.session_state[agentKey].get_ships()
+    #Get Ships for the Agent, the fleet snapshot is reused across reruns for agents.fleetTtl seconds
+    shipsList = st.session_state[agentKey].get_fleet() or []
     shipSymbolList = []
     for s in shipsList:
         shipSymbolList.append({"Symbol": s.symbol, "ShipObject": s})
@@ -96,17 +99,9 @@ with shipsTab:
         
         #Find Market in Ships System
         if st.button("Find Market in Ship's System") or st.session_state.findMarket:
-            markets = []
             system_symbol = ship.nav['systemSymbol']
-            # Fetch waypoints in the system
-            waypoints = nav.get_waypoints(st.session_state[agentKey].token, system_symbol)
-            # Filter waypoints with market trait
-            # Due to the way the API is structured, the waypoints are nested in a list of dictionaries MARKETPLACE is the trait we are looking for
-            for i in waypoints:
-                for j in i['traits']:
-                    print(i['symbol'], j['symbol'])
-                    if j['symbol'] == "MARKETPLACE":
-                        markets.append(i)
+            # Waypoints in the system are fetched once and indexed by trait, MARKETPLACE is the trait we are looking for
+            markets = nav.get_system_waypoints(st.session_state[agentKey].token, system_symbol).markets()
             #Set session state to True to allow for Streamlit to not close the button as soon as actions are taken within button
             st.session_state.findMarket = True
         
@@ -114,10 +109,21 @@ with shipsTab:
             if markets:
                 market_symbols = [market['symbol'] for market in markets]
                 selected_market = st.selectbox("Select Market", market_symbols)
-            
-                if st.button("Navigate to Market") or st.session_state.navigateToMarket:
-                    # Navigate the ship to the selected market
-                    print("Navigate to Market", ship.navigate_to_waypoint(st.session_state[agentKey].token, waypoint_symbol = selected_market))
+
+                #Fuel aware route from where the ship is now, with refuel stops, so the ship is never sent on a flight it cannot finish
+                route = ship.plan_route(st.session_state[agentKey].token, selected_market)
+                if route is None:
+                    st.error(f"{selected_market} cannot be reached with {ship.fuel['current']} fuel, even with refuel stops.")
+                elif route['legs']:
+                    st.markdown(f"Route: {len(route['legs'])} legs, {route['time']}s, {route['fuel']} fuel")
+                    st.dataframe(pd.DataFrame(route['legs']))
+
+                    #Each click flies the next leg, the route is planned again from wherever the ship is after it arrives
+                    if st.button("Navigate to Market") or st.session_state.navigateToMarket:
+                        print("Navigate to Market", ship.navigate_route(st.session_state[agentKey].token, route))
+                        st.session_state[agentKey].invalidate_fleet()
+                else:
+                    st.info(f"Ship is already at {selected_market}.")
                         
             else:
                 st.warning("No markets found in the current system.")
@@ -147,6 +153,12 @@ with shipsTab:
                 closestSystemsDf['description'] = closestSystemsDf.apply(lambda x: f"{x['symbol']} - {x['Distance']}", axis = 1)
                 systemSelection = st.selectbox("Select System", closestSystemsDf['description'])
                 systemSelectionSymbol = systemSelection.split(" - ")[0]
+
+                #Multi hop itinerary to the selected system over jump gates and warps
+                itinerary = ship.plan_itinerary(systemSelectionSymbol, token = st.session_state[agentKey].get_agent_token())
+                if itinerary:
+                    st.markdown(f"Itinerary: {len(itinerary['hops'])} hops, {itinerary['time']:.0f}s, {itinerary['fuel']} fuel")
+                    st.dataframe(pd.DataFrame(itinerary['hops']))
                 
                 #Get Waypoint Information for Selected System
                 wayPointList = pd.DataFrame(nav.get_waypoints(st.session_state[agentKey].get_agent_token(), systemSelectionSymbol))
@@ -161,6 +173,7 @@ with shipsTab:
                     print("Ship Status", ship.nav)
                     if ship.nav['status'] == "IN_ORBIT":
                         print(ship.warp_to_new_system(st.session_state[agentKey].token, wayPointSelect))
+                        st.session_state[agentKey].invalidate_fleet()
 
 #########TODO: Add Crew, Frame, Reactor, Engine, Cooldown, Modules, Mounts, Cargo, Fuel Tabs with relevant information          
         # with crew:
@@ -292,42 +305,31 @@ with contractsTab:
 #Market Tab for interacting with Market
 with marketTab:
     st.header("Market")
-    print("Market Listings")
-    #Get Transactions and Trade Goods from all ships stored in SQLLite DB
-    transactionsDf = market.get_transactions()
-    tradeGoodsDf = market.get_trade_goods()
     st.header("Market Transactions")
 
-    #Allow User to Select Trade Good to view transactions for, also transofrm transactions to be sorted by timestamp for graphing
-    tradeGoodSelecton = st.selectbox("Select Trade Good", transactionsDf['tradeSymbol'].unique(), index = 2)
-    transactionsDf = transactionsDf[transactionsDf['tradeSymbol'] == tradeGoodSelecton]
-    transactionsDf = transactionsDf.sort_values(by = 'timestamp').reset_index(drop = True)
-
-    #Build Segments for Plotly Chart by comparing price per unit of each transaction over time
-    segments = []
-    color = 'green'
-
-    for i in range(1, len(transactionsDf)):
-        if transactionsDf['pricePerUnit'].to_list()[i] > transactionsDf['pricePerUnit'].to_list()[i - 1]:
-            color = 'green'
-        else:
-            color = 'red'
-    
-        # Append segment
-        segments.append(go.Scatter(
-            x=transactionsDf['timestamp'].iloc[i-1:i+1],
-            y=transactionsDf['pricePerUnit'].iloc[i-1:i+1],
-            mode='lines',
-            line=dict(color=color, width=3)
-        ))
-
-
-    fig = go.Figure(segments)
+    #Allow User to Select Trade Good to view prices for, the chart reads that trade good's OHLC rollups instead of raw transactions
+    tradeSymbols = market.get_transaction_trade_symbols()
+    tradeGoodSelecton = st.selectbox("Select Trade Good", tradeSymbols, index = min(2, len(tradeSymbols) - 1) if tradeSymbols else None)
+
+    #Time window for the chart, the candle size is picked from the window so the chart never draws more than a few hundred candles
+    timeWindows = {"Last Hour": 3600, "Last Day": 86400, "Last Week": 7 * 86400, "Last Month": 30 * 86400, "All": None}
+    timeWindowSelection = st.selectbox("Time Window", list(timeWindows.keys()), index = len(timeWindows) - 1)
+    resolution, candlesDf = market.get_price_candles(tradeGoodSelecton, timeWindows[timeWindowSelection]) if tradeGoodSelecton else (None, pd.DataFrame(columns = ['bucket', 'open', 'high', 'low', 'close']))
+
+    fig = go.Figure(go.Candlestick(
+        x=candlesDf['bucket'],
+        open=candlesDf['open'],
+        high=candlesDf['high'],
+        low=candlesDf['low'],
+        close=candlesDf['close'],
+        increasing_line_color='green',
+        decreasing_line_color='red'
+    ))
     
 
     # Update layout
     fig.update_layout(
-        title='Market Transactions',
+        title=f'Market Transactions ({resolution} candles)',
         xaxis_title='Timestamp',
         yaxis_title='Price Per Unit',
         xaxis_rangeslider_visible=False
@@ -336,6 +338,8 @@ with marketTab:
 # Display the chart in Streamlit
     st.plotly_chart(fig)
     #st.dataframe(transactionsDf)
+    #Current state of every trade good, not the whole history
+    tradeGoodsDf = market.get_current_trade_goods()
     st.dataframe(tradeGoodsDf)
 
 #print("Ships Listing")
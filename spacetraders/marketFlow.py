@@ -8,20 +8,34 @@ import time
 from datetime import datetime, timedelta
 
 import pandas as pd
-import requests
 from prefect import flow, task, get_run_logger
 from prefect.server.schemas.schedules import IntervalSchedule
 
 import util.agents as agents
+import util.api_client as api
+import util.archive as archive
 import util.contracts as contracts
+import util.db_writer as db_writer
 import util.market as market
+import util.market_scheduler as market_scheduler
+import util.metrics as metrics
 import util.nav as nav
+import util.rate_limit as rl
+import util.rollups as rollups
+import util.schema as schema
 import util.ships as ships
 import util.sqlite_functions as sqf
+import util.trade_goods as trade_goods
 import logging
 
+#Logger for callbacks that run on the database writer thread, outside any Prefect task
+writerLogger = logging.getLogger("marketFlow.writer")
+
+#Market polling is background work, requests from the Streamlit app in the same process go first
+api.set_default_priority(rl.PRIORITY_BACKGROUND)
 
 @task
+@metrics.instrumented
 def load_agents():
     """
         Task that gets all agents.
@@ -32,6 +46,7 @@ def load_agents():
     return df
 
 @task
+@metrics.instrumented
 def load_ships(agentsDf: pd.DataFrame):
     """
     Task that loads ships for all agents.
@@ -45,18 +60,21 @@ def load_ships(agentsDf: pd.DataFrame):
     logger = get_run_logger()
     logger.info("Loading ships.")
 
-    agentsSymbolList = agentsDf['symbol'].tolist()
+    #Agents come from the rows load_agents already read, their ships are loaded concurrently
     shipsList = []
-    for a in agentsSymbolList:
-        agent = agents.load_agent(a)
+    for agent, shipList in agents.load_fleets(agents.agents_from_df(agentsDf)):
+        if shipList is None:
+            logger.warning(f"Could not load ships for {agent.symbol}, skipping.")
+            continue
         shipsDic = {}
         shipsDic['Agent'] = agent.symbol
-        shipsDic['Ships'] = agent.get_ships()
+        shipsDic['Ships'] = shipList
         shipsDic['Token'] = agent.get_agent_token()
         shipsList.append(shipsDic)
     return shipsList
 
 @task
+@metrics.instrumented
 def get_market_waypoints(shipsList: list):
     """
     Task that checks if any ships are at a waypoint with a market
@@ -69,91 +87,257 @@ def get_market_waypoints(shipsList: list):
     """
     logger = get_run_logger()
     logger.info("Getting market waypoints.")
+    #Markets already in the registry are known, only waypoints not seen before are looked up, once per waypoint
+    registry = market_scheduler.load_registry()
     marketWapoints = []
+    checked = set()
     for agent in shipsList:
         for ship in agent['Ships']:
-            waypoint = nav.get_waypoint(agent['Token'], ship.nav['systemSymbol'], ship.nav['waypointSymbol'])
-            for t in waypoint['data']['traits']:
-                if t['symbol'] == "MARKETPLACE":
-                    marketDic = {'systemSymbol': ship.nav['systemSymbol'], 'waypointSymbol': ship.nav['waypointSymbol'], 'token': agent['Token']}
-                    marketWapoints.append(marketDic)
+            waypointSymbol = ship.nav['waypointSymbol']
+            if waypointSymbol in checked:
+                continue
+            checked.add(waypointSymbol)
+            if waypointSymbol not in registry:
+                waypoint = nav.get_waypoint(agent['Token'], ship.nav['systemSymbol'], waypointSymbol, fields = ["traits"])
+                if waypoint is None:
+                    logger.warning(f"Could not load waypoint {waypointSymbol}, skipping.")
+                    continue
+                if not any(t['symbol'] == "MARKETPLACE" for t in waypoint['data']['traits']):
+                    continue
+            marketDic = {'systemSymbol': ship.nav['systemSymbol'], 'waypointSymbol': waypointSymbol, 'token': agent['Token']}
+            marketWapoints.append(marketDic)
+    market_scheduler.register_markets(marketWapoints)
     return marketWapoints
 
 @task
+@metrics.instrumented
+def schedule_markets(marketWaypoints: list, budget: int = market_scheduler.defaultBudget):
+    """
+    Task that picks which markets to poll this cycle, favouring markets that are stale or whose prices move a lot.
+
+    Parameters:
+    marketWaypoints (list): Market waypoints ships are at now.
+    budget (int): Most markets to poll.
+
+    Returns:
+    List of Dicts: The market waypoints to poll
+    """
+    logger = get_run_logger()
+    selected = market_scheduler.select_markets(marketWaypoints, budget)
+    logger.info(f"Polling {len(selected)} of {len(marketWaypoints)} markets.")
+    return selected
+
+#Most rows handed to the database writer in one batch, a market with more rows is split
+pipelineBatchSize = 500
+
+def fetch_markets(marketWaypoints, polls):
+    """
+    Fetch stage of the market pipeline, yields each market as its response arrives.
+
+    Parameters:
+    marketWaypoints (list): Market waypoints to poll
+    polls (list): Filled with (marketWaypoint, sell prices, fetch time) of every market for the scheduler
+
+    Returns:
+    Generator of Tuples: marketWaypoint, market data and ISO timestamp of the fetch, failed markets are logged and left out
+    """
+    logger = get_run_logger()
+    for mw, marketData, fetchedAt, error in market.poll_markets(marketWaypoints):
+        #Only the sell prices are kept for the scheduler, so the rows themselves are not held after they are written
+        prices = None if marketData is None else {'tradeGoods': [{'symbol': tg['symbol'], 'sellPrice': tg['sellPrice']} for tg in marketData.get('tradeGoods', [])]}
+        polls.append((mw, prices, fetchedAt))
+        if marketData is None:
+            logger.warning(f"Could not load market {mw['waypointSymbol']}, skipping. {error or ''}")
+            continue
+        yield mw, marketData, fetchedAt
+
+def normalize_markets(markets):
+    """
+    Normalize stage of the market pipeline, turns each market into its transaction and trade good rows.
+    Each trade good is stamped with the time its own market's response arrived.
+
+    Parameters:
+    markets (Generator of Tuples): Output of fetch_markets
+
+    Returns:
+    Generator of Tuples: (table name, List of Dicts) for each kind of row a market has
+    """
+    for mw, marketData, fetchedAt in markets:
+        transactions = marketData.get('transactions', [])
+        if transactions:
+            yield "Market_Transactions", transactions
+        tradeGoods = marketData.get('tradeGoods', [])
+        for tg in tradeGoods:
+            tg['waypointSymbol'] = mw['waypointSymbol']
+            tg['timestamp'] = fetchedAt
+        if tradeGoods:
+            yield "Market_TradeGoods", tradeGoods
+
+def batch_rows(rowGroups, batchSize = pipelineBatchSize):
+    """
+    Batch stage of the market pipeline, splits each market's rows into DataFrames of at most batchSize rows.
+
+    Parameters:
+    rowGroups (Generator of Tuples): Output of normalize_markets
+    batchSize (int): Most rows in one batch
+
+    Returns:
+    Generator of Tuples: (table name, pd.DataFrame)
+    """
+    for tableName, rows in rowGroups:
+        for start in range(0, len(rows), batchSize):
+            yield tableName, pd.DataFrame(rows[start:start + batchSize])
+
+def queue_transactions(transactionsDf):
+    """
+    Queues market transactions for the background database writer.
+    Transactions already stored by an earlier poll are skipped, the price rollups are recomputed once the new rows are committed.
+
+    Parameters:
+    transactionsDf (pd.DataFrame): Transaction data
+
+    Returns:
+    Future: Resolves to the inserted and skipped counts once the rows are committed
+    """
+    def after_insert(counts):
+        writerLogger.info(f"Inserted {counts['inserted']} transactions, skipped {counts['skipped']} already stored.")
+        if counts['inserted'] > 0:
+            buckets = rollups.update_rollups(transactionsDf)
+            writerLogger.info(f"Recomputed {buckets} price rollup buckets.")
+
+    return db_writer.get_writer().submit_rows("Market_Transactions", transactionsDf, onConflict = "IGNORE", after = after_insert)
+
+def queue_trade_goods(tradeGoodsDf):
+    """
+    Queues trade goods for the background database writer. Only goods whose prices, supply, activity or volume changed are stored, plus periodic keyframes.
+
+    Parameters:
+    tradeGoodsDf (pd.DataFrame): Trade Goods data
+
+    Returns:
+    Future: Resolves to the changed, keyframe and unchanged counts once the rows are committed
+    """
+    def after_insert(counts):
+        writerLogger.info(f"Stored {counts['changed']} changed trade goods and {counts['keyframes']} keyframes, skipped {counts['unchanged']} unchanged.")
+
+    return db_writer.get_writer().submit(lambda conn: trade_goods.write_snapshot(conn, tradeGoodsDf), after = after_insert)
+
+#Write stage for each table the pipeline produces
+pipelineWriters = {
+    "Market_Transactions": queue_transactions
+    ,"Market_TradeGoods": queue_trade_goods
+}
+
+#Rows actually stored for each table, from the counts its write stage's Future resolves to
+#Transactions already stored and unchanged trade goods are skipped, so this is less than the rows queued
+pipelineStoredRows = {
+    "Market_Transactions": lambda counts: counts['inserted']
+    ,"Market_TradeGoods": lambda counts: counts['changed'] + counts['keyframes']
+}
+
+@task
+@metrics.instrumented
 def check_market(marketWaypoints: list):
     """
-    Task that checks the market for various data points.
+    Task that polls markets and streams their data into the database.
+    The stages fetch, normalize, batch and write are chained generators, so each market's rows are queued for the
+    database writer as soon as its response arrives while other markets are still being fetched. The writer's queue is
+    bounded, so a slow disk holds the pipeline back instead of rows piling up in memory.
+    Once every market is fetched the task waits for its own writes, so the rows metric counts rows stored rather than queued.
 
     Parameters:
     marketWaypoints (list): List of market waypoints.
 
     Returns:
-    Dictionary: Dictionary containing transactions and trade goods as list of dicts
+    Dictionary: Markets polled and failed, and rows queued and stored per table
     """
     logger = get_run_logger()
     logger.info("Loading market data.")
 
-    transactions = []
-    tradeGoods = []
-    for mw in marketWaypoints:
-        marketData = market.check_market(mw['token'], mw['systemSymbol'], mw['waypointSymbol'])
-        tradeGoodsSingle = marketData['tradeGoods']
-        current_timestamp = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
-        for t in marketData['transactions']:
-            transactions.append(t)
-        for tg in marketData['tradeGoods']:
-            tg['waypointSymbol'] = mw['waypointSymbol']
-            tg['timestamp'] = current_timestamp
-            tradeGoods.append(tg)
-    data = {'transactions': transactions, 'tradeGoods': tradeGoods}
-    return data
+    polls = []
+    queued = {tableName: 0 for tableName in pipelineWriters}
+    writes = []
+    for tableName, batch in batch_rows(normalize_markets(fetch_markets(marketWaypoints, polls))):
+        writes.append((tableName, pipelineWriters[tableName](batch)))
+        queued[tableName] += len(batch)
+    market_scheduler.record_polls(polls)
+    failed = sum(1 for p in polls if p[1] is None)
+    stored = {tableName: 0 for tableName in pipelineWriters}
+    for tableName, future in writes:
+        try:
+            stored[tableName] += pipelineStoredRows[tableName](future.result())
+        except Exception:
+            #Failed writes are logged by the writer and fail flush_writes
+            pass
+    #Failed markets are already counted as API errors by the client
+    metrics.add_rows(sum(stored.values()))
+    logger.info(f"Polled {len(polls) - failed} markets, {failed} failed. Queued {queued['Market_TradeGoods']} trade goods and {queued['Market_Transactions']} transactions, "
+                f"stored {stored['Market_TradeGoods']} and {stored['Market_Transactions']}.")
+    return {'markets': len(polls), 'failed': failed, 'queued': queued, 'stored': stored}
 
 @task
-def upload_transactions(transactions: list):
+@metrics.instrumented
+def flush_writes():
     """
-    Task to put market transaction data into the sqlite db
+    Task that waits for the background database writer to commit everything queued so far.
 
     Parameters:
-    transactions (list): Transaction data
+    None
 
     Returns:
-    Boolean: True if successful, False if not
+    bool: True if everything was written in time
+
+    Raises:
+    db_writer.DbWriteError: If any queued write failed, so the task fails instead of losing the data silently
     """
     logger = get_run_logger()
-    logger.info("Starting upload of transaction data.")
-    transactionsDf = pd.DataFrame(transactions)
-    return sqf.insert_data("Market_Transactions", transactionsDf)
+    started = time.perf_counter()
+    try:
+        flushed = db_writer.flush(timeout = 300)
+    except db_writer.DbWriteError as e:
+        metrics.add_errors(len(e.errors))
+        logger.error(str(e))
+        raise
+    if not flushed:
+        metrics.add_errors()
+    logger.info(f"Database writes flushed in {time.perf_counter() - started:.3f}s." if flushed else "Timed out waiting for database writes.")
+    return flushed
 
 @task
-def upload_trade_goods(tradeGoods: list):
+@metrics.instrumented
+def archive_market_history():
     """
-    Task to put trade goods data into the sqlite db
+    Task that rolls market rows older than archive.archiveAfterDays out of SQLite into the Parquet archive.
 
     Parameters:
-    tradeGoods (list): Trade Goods data
+    None
 
     Returns:
-    dB: True if successful, False if not
+    Dict: Maps table name to the rows moved and files written
     """
     logger = get_run_logger()
-    logger.info("Starting upload of trade good data.")
-    tradeGoodsDf = pd.DataFrame(tradeGoods)
-    return sqf.insert_data("Market_TradeGoods", tradeGoodsDf)
+    logger.info("Archiving old market data.")
+    result = archive.archive_market_history()
+    metrics.add_rows(sum(counts['rows'] for counts in result.values()))
+    for tableName, counts in result.items():
+        logger.info(f"Archived {counts['rows']} rows of {tableName} into {counts['files']} files.")
+    return result
 
 @flow
 def get_market_data():
     """
-        Flow to get market data.
+        Flow to get market data. Each task's wall time, API calls, bytes received, rows written and errors are stored in Task_Metrics.
     """
+    metrics.start_run()
     agentsDf = load_agents()
     shipsDic = load_ships(agentsDf)
     marketWaypoints = get_market_waypoints(shipsDic)
-    marketData = check_market(marketWaypoints)
-    # print(marketData['transactions'])
-    # print(marketData['tradeGoods'])
-    print("Upload transactions", upload_transactions(marketData['transactions']))
-    print("Upload trade goods", upload_trade_goods(marketData['tradeGoods']))
+    print("Market data", check_market(schedule_markets(marketWaypoints)))
+    #Archiving reads what was just uploaded, so it waits for the writer
+    flush_writes()
+    archive_market_history()
 
 
 if __name__ == '__main__':
+    schema.apply_migrations()
     get_market_data.serve(name="get_market_data")
\ No newline at end of file
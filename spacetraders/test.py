@@ -3,10 +3,10 @@ import time
 from datetime import datetime
 
 import pandas as pd
-import requests
 from prefect import flow, task
 
 import util.agents as agents
+import util.api_client as api
 import util.contracts as contracts
 import util.nav as nav
 import util.ships as ships
@@ -14,9 +14,7 @@ import util.sqlite_functions as sqf
 
 
 def check_market(token, symbol, waypointSymbol):
-    url = f'https://api.spacetraders.io/v2/systems/{symbol}/waypoints/{waypointSymbol}/market'
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get(url, headers = headers)
+    response = api.get_client(token).get(f"/systems/{symbol}/waypoints/{waypointSymbol}/market")
     if response.status_code == 200:
         return response.json()['data']
     else:
@@ -28,7 +26,7 @@ ships = agent.get_ships()
 #print(ships)
 marketWapoints = []
 for s in ships:
-    waypoint = nav.get_waypoint(agent.get_agent_token(), s.nav['systemSymbol'], s.nav['waypointSymbol'])
+    waypoint = nav.get_waypoint(agent.get_agent_token(), s.nav['systemSymbol'], s.nav['waypointSymbol'], fields = ["traits"])
     for t in waypoint['data']['traits']:
         if t['symbol'] == "MARKETPLACE":
             #print(f"Ship {s.symbol} is at a {t['name']}")
@@ -1,13 +1,23 @@
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
-import requests
 import streamlit as st
 
+import util.api_client as api
 import util.contracts as contracts
+import util.db_writer as db_writer
 import util.ships as ships
 import util.sqlite_functions as sqf
 
+#Seconds a fleet snapshot from get_fleet is reused before /my/ships is fetched again
+fleetTtl = 30
+
+#Fleet snapshots by agent token, (fetched at, List of Ship)
+_fleets = {}
+_fleetsLock = threading.Lock()
 
 class Agent():
     """
@@ -52,9 +62,7 @@ class Agent():
         Returns:
         Dict: Dictionary containing agent information
         """
-        url = "https://api.spacetraders.io/v2/my/agent"
-        headers = {'Authorization': f'Bearer {self.token}'}
-        response = requests.get(url, headers = headers)
+        response = api.get_client(self.token).get("/my/agent")
         if response.status_code == 200:
             return response.json()
         else:
@@ -73,9 +81,7 @@ class Agent():
         Returns:
         List of Contract: List of Contract objects
         """
-        url = "https://api.spacetraders.io/v2/my/contracts"
-        headers = {'Authorization': f'Bearer {self.token}'}
-        response = requests.get(url, headers = headers)
+        response = api.get_client(self.token).get("/my/contracts")
         if response.status_code == 200:
             contractList = []
             for c in response.json()["data"]:
@@ -84,26 +90,69 @@ class Agent():
         else:
             print(f"Error: {response.status_code} - {response.text}")
     
+    def iter_ships(self, maxWorkers = api.defaultPageWorkers):
+        """
+        Yields the agent's ships one page at a time. By Hitting the API.
+        Pages are fetched at the largest page size, the pages after the first concurrently.
+        
+        Parameters:
+        maxWorkers (int): Maximum number of pages fetched at the same time
+        
+        Returns:
+        Generator of Ship: Ship objects, in API order, raises RuntimeError if a page cannot be fetched
+        """
+        for page in api.iter_pages(self.token, "/my/ships", maxWorkers = maxWorkers, raiseOnError = True):
+            for c in page:
+                yield ships.Ship(c)
+
     def get_ships(self):
         """
-        Gets the ships for the agent. By Hitting the API.
+        Gets every ship for the agent. By Hitting the API. The result is kept as the agent's fleet snapshot.
         
         Parameters:
         None
         
         Returns:
-        List of Ship: List of Ship objects
+        List of Ship: List of Ship objects, None if the ships could not be loaded
         """
-        url = "https://api.spacetraders.io/v2/my/ships"
-        headers = headers = {'Authorization': f'Bearer {self.token}'}
-        response = requests.get(url, headers = headers)
-        if response.status_code == 200:
-            shipList = []
-            for c in response.json()["data"]:
-                shipList.append(ships.Ship(c))
-            return shipList
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
+        try:
+            shipList = list(self.iter_ships())
+        except RuntimeError as e:
+            print(f"Error: {e}")
+            return None
+        with _fleetsLock:
+            _fleets[self.token] = (time.time(), shipList)
+        return shipList
+
+    def get_fleet(self, maxAge = None):
+        """
+        Gets the agent's fleet snapshot, fetching it again only when it is older than maxAge.
+        
+        Parameters:
+        maxAge (float): Seconds a snapshot is reused, defaults to fleetTtl
+        
+        Returns:
+        List of Ship: List of Ship objects, None if the ships could not be loaded
+        """
+        maxAge = fleetTtl if maxAge is None else maxAge
+        with _fleetsLock:
+            cached = _fleets.get(self.token)
+        if cached is not None and time.time() - cached[0] < maxAge:
+            return cached[1]
+        return self.get_ships()
+
+    def invalidate_fleet(self):
+        """
+        Drops the agent's fleet snapshot, used after a ship is moved so the next get_fleet fetches it again.
+        
+        Parameters:
+        None
+        
+        Returns:
+        None
+        """
+        with _fleetsLock:
+            _fleets.pop(self.token, None)
     
 
 def load_all_agents():
@@ -129,34 +178,68 @@ def create_agent(agentSymbol):
     Returns:
     Dict: Dictionary containing agent information
     """
-    url = 'https://api.spacetraders.io/v2/register'
-    headers = {'Content-Type' : 'application/json'
-               ,"Accept": "application/json"}
     params = {
         "symbol": agentSymbol
         ,"faction": "COSMIC"
         }
-    response = requests.post(url, json = params).json()
+    response = api.get_client().post("/register", json = params).json()
     responseJson = response["data"]["agent"]
     responseJson["token"] = response["data"]["token"]
-    sqf.update_agent_into(responseJson)
+    #Written by the background writer, waiting for the ack so the agent can be loaded straight away
+    db_writer.get_writer().submit(lambda conn: sqf.write_agent(conn, responseJson)).result()
     return responseJson
 
-def load_agent(agentSymbol):
+def load_agent(agentSymbol, verify = True):
     """
     Loads an agent from the SQLLite database.
     
     Parameters:
     agentSymbol (str): Symbol of the agent
+    verify (bool): Check the stored token against the API, registering the agent again if it is rejected
     
     Returns:
     Agent: Agent object
     """
     conn = sqf.create_connection()
-    cursor = conn.cursor()
     #Check if symbol in db
-    query = "SELECT * from AGENTS WHERE symbol = " + "\'" + agentSymbol + "\'"
-    agentDic = pd.read_sql_query(query, con = conn).to_dict('records')
+    query = "SELECT * from AGENTS WHERE symbol = ?"
+    agentDic = pd.read_sql_query(query, con = conn, params = (agentSymbol,)).to_dict('records')
+    sqf.close_connection(conn)
     agent = Agent(agentDic[0])
-    response = agent.get_agent_info()
-    return agent
\ No newline at end of file
+    if verify:
+        response = agent.get_agent_info()
+    return agent
+
+def agents_from_df(agentsDf):
+    """
+    Builds Agent objects from rows already read from the AGENTS table, without another query or API call.
+    
+    Parameters:
+    agentsDf (pd.DataFrame): DataFrame containing agent information, from load_all_agents
+    
+    Returns:
+    List of Agent: Agent objects, in row order
+    """
+    return [Agent(a) for a in agentsDf.to_dict('records')]
+
+def load_fleets(agentList, maxWorkers = api.defaultPageWorkers, maxAge = None):
+    """
+    Loads the ships of many agents at once.
+    The stored token is trusted, the agent is only checked against the API, and registered again if needed, when its ships cannot be loaded.
+    
+    Parameters:
+    agentList (List of Agent): Agents to load ships for
+    maxWorkers (int): Maximum number of agents loaded at the same time
+    maxAge (float): Seconds a fleet snapshot is reused, defaults to fleetTtl
+    
+    Returns:
+    List of Tuples: (Agent, List of Ship) in the order of agentList, the list is None if the ships could not be loaded
+    """
+    def load(agent):
+        shipList = agent.get_fleet(maxAge)
+        if shipList is None:
+            agent.get_agent_info()
+            shipList = agent.get_ships()
+        return agent, shipList
+    with ThreadPoolExecutor(max_workers = max(1, maxWorkers)) as executor:
+        return list(executor.map(load, agentList))
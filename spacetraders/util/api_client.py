@@ -0,0 +1,280 @@
+import importlib.util
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+import util.metrics as metrics
+import util.rate_limit as rl
+
+#Base URL for every SpaceTraders API call
+baseUrl = "https://api.spacetraders.io/v2"
+
+#Timeouts in seconds, connect is kept short so an unreachable host fails fast
+defaultTimeout = httpx.Timeout(15.0, connect=5.0)
+
+#Connection pool limits, keep-alive connections are reused across calls to the same host
+defaultLimits = httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60.0)
+
+#HTTP/2 is only enabled when the optional h2 package is installed
+http2Available = importlib.util.find_spec("h2") is not None
+
+#How many times a request is retried after a 429 before the response is handed back
+maxRetries = 5
+
+#Largest page size the API accepts for paginated endpoints
+maxPageLimit = 20
+
+#Pages fetched at the same time by fetch_all_pages
+defaultPageWorkers = 4
+
+#Priority used when a call does not pass one, background processes such as marketFlow lower it
+defaultPriority = rl.PRIORITY_USER
+
+#One client per agent token, None is used for unauthenticated calls
+_clients = {}
+_clientsLock = threading.Lock()
+
+
+class ApiClient():
+    """
+    Class that represents a pooled, keep-alive connection to the SpaceTraders API for one agent token.
+
+    Attributes:
+    token (str): Token for the agent, None for unauthenticated calls
+    session (httpx.Client): Pooled HTTP session shared by every call made with this token
+    scheduler (RequestScheduler): Rate limit aware queue every request for this token waits in
+    """
+    def __init__(self, token = None, http2 = None, timeout = None, limits = None):
+        """
+        Initializes an ApiClient object.
+
+        Parameters:
+        token (str): Token for the agent
+        http2 (bool): Whether to use HTTP/2, defaults to True when h2 is installed
+        timeout (httpx.Timeout): Timeouts for each request
+        limits (httpx.Limits): Connection pool limits
+
+        Returns:
+        None
+        """
+        self.token = token
+        headers = {"Accept": "application/json"}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        if http2 is None:
+            http2 = http2Available
+        self.session = httpx.Client(
+            base_url = baseUrl
+            ,headers = headers
+            ,timeout = timeout or defaultTimeout
+            ,limits = limits or defaultLimits
+            ,http2 = http2
+        )
+        self.scheduler = rl.RequestScheduler()
+
+    def request(self, method, path, params = None, json = None, priority = None):
+        """
+        Sends a request to the API over the pooled session once the rate limit allows it.
+        A 429 response holds back every request for this token for the time the API asks for, then the request is retried.
+
+        Parameters:
+        method (str): HTTP method
+        path (str): Path relative to the API base URL, e.g. "/my/ships"
+        params (Dict): Query parameters
+        json (Dict): JSON body
+        priority (int): rl.PRIORITY_USER or rl.PRIORITY_BACKGROUND, defaults to defaultPriority
+
+        Returns:
+        httpx.Response: Response from the API
+        """
+        if priority is None:
+            priority = defaultPriority
+        for attempt in range(maxRetries + 1):
+            self.scheduler.acquire(priority)
+            try:
+                response = self.session.request(method, path, params = params, json = json)
+            except httpx.HTTPError:
+                metrics.record_api_call(error = True)
+                raise
+            metrics.record_api_call(len(response.content), response.status_code >= 400)
+            self.scheduler.update_from_headers(response.headers)
+            if response.status_code != 429 or attempt == maxRetries:
+                return response
+            retryAfter = rl.retry_after_seconds(response)
+            print(f"Rate limited on {path}, retrying in {retryAfter:.2f}s")
+            self.scheduler.block_for(retryAfter)
+        return response
+
+    def get(self, path, params = None, priority = None):
+        """
+        Sends a GET request to the API.
+
+        Parameters:
+        path (str): Path relative to the API base URL
+        params (Dict): Query parameters
+        priority (int): Priority of the request
+
+        Returns:
+        httpx.Response: Response from the API
+        """
+        return self.request("GET", path, params = params, priority = priority)
+
+    def post(self, path, json = None, priority = None):
+        """
+        Sends a POST request to the API.
+
+        Parameters:
+        path (str): Path relative to the API base URL
+        json (Dict): JSON body
+        priority (int): Priority of the request
+
+        Returns:
+        httpx.Response: Response from the API
+        """
+        return self.request("POST", path, json = json, priority = priority)
+
+    def close(self):
+        """
+        Closes the pooled session.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        self.session.close()
+
+def get_client(token = None):
+    """
+    Function that gets the shared client for a token, creating it on first use.
+
+    Parameters:
+    token (str): Token for the agent, None for unauthenticated calls
+
+    Returns:
+    ApiClient: Client shared by every call made with this token
+    """
+    with _clientsLock:
+        client = _clients.get(token)
+        if client is None:
+            client = ApiClient(token)
+            _clients[token] = client
+        return client
+
+def fetch_page(token, path, page, limit = maxPageLimit, params = None, priority = None):
+    """
+    Function that fetches one page of a paginated endpoint.
+
+    Parameters:
+    token (str): Token for the agent
+    path (str): Path relative to the API base URL
+    page (int): Page number, starting at 1
+    limit (int): Page size
+    params (Dict): Extra query parameters
+    priority (int): Priority of the request
+
+    Returns:
+    Dict: Response body with data and meta, None if the request failed
+    """
+    pageParams = dict(params or {})
+    pageParams["limit"] = limit
+    pageParams["page"] = page
+    response = get_client(token).get(path, params = pageParams, priority = priority)
+    if response.status_code == 200:
+        return response.json()
+    else:
+        print(f"Error fetching {path} page {page}: {response.status_code} - {response.text}")
+        return None
+
+def iter_pages(token, path, limit = maxPageLimit, params = None, maxWorkers = defaultPageWorkers, priority = None, raiseOnError = False):
+    """
+    Generator that yields every page of a paginated endpoint, in page order.
+    The first page is fetched alone to read meta.total, the remaining pages are fetched concurrently
+    and yielded as soon as every page before them has arrived.
+
+    Parameters:
+    token (str): Token for the agent
+    path (str): Path relative to the API base URL
+    limit (int): Page size
+    params (Dict): Extra query parameters
+    maxWorkers (int): Maximum number of pages fetched at the same time
+    priority (int): Priority of the requests
+    raiseOnError (bool): Raise RuntimeError on a failed page instead of skipping it
+
+    Returns:
+    Generator of Lists of Dicts: Items of each page
+    """
+    first = fetch_page(token, path, 1, limit, params, priority)
+    if first is None:
+        if raiseOnError:
+            raise RuntimeError(f"Could not fetch {path} page 1")
+        return
+    yield first['data']
+    total = first.get('meta', {}).get('total', len(first['data']))
+    pageCount = math.ceil(total / limit) if limit else 1
+    if pageCount <= 1:
+        return
+    with ThreadPoolExecutor(max_workers = max(1, maxWorkers)) as executor:
+        futures = [executor.submit(fetch_page, token, path, p, limit, params, priority) for p in range(2, pageCount + 1)]
+        try:
+            for pageNumber, future in enumerate(futures, start = 2):
+                page = future.result()
+                if page is not None:
+                    yield page['data']
+                elif raiseOnError:
+                    raise RuntimeError(f"Could not fetch {path} page {pageNumber}")
+        finally:
+            #Stop fetching pages nobody will read if the consumer stops early or a page failed
+            for future in futures:
+                future.cancel()
+
+def fetch_all_pages(token, path, limit = maxPageLimit, params = None, maxWorkers = defaultPageWorkers, priority = None):
+    """
+    Function that fetches every page of a paginated endpoint, see iter_pages. Pages that fail are left out.
+
+    Parameters:
+    token (str): Token for the agent
+    path (str): Path relative to the API base URL
+    limit (int): Page size
+    params (Dict): Extra query parameters
+    maxWorkers (int): Maximum number of pages fetched at the same time
+    priority (int): Priority of the requests
+
+    Returns:
+    List of Dicts: Items from every page, in page order
+    """
+    items = []
+    for page in iter_pages(token, path, limit, params, maxWorkers, priority):
+        items.extend(page)
+    return items
+
+def set_default_priority(priority):
+    """
+    Function that sets the priority used by calls that do not pass one.
+
+    Parameters:
+    priority (int): rl.PRIORITY_USER or rl.PRIORITY_BACKGROUND
+
+    Returns:
+    None
+    """
+    global defaultPriority
+    defaultPriority = priority
+
+def close_all_clients():
+    """
+    Function that closes every shared client.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    with _clientsLock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
@@ -0,0 +1,284 @@
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+import util.sqlite_functions as sqf
+import util.trade_goods as trade_goods
+
+#Parquet support comes from the optional pyarrow package, without it nothing is archived and reads see only SQLite
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+archiveAvailable = pq is not None
+
+#Folder the Parquet archive is written under, one subfolder per table
+archiveDir = "data/archive"
+
+#Days market rows stay in SQLite before they are rolled into the archive
+archiveAfterDays = 30
+
+#Tables that can be archived and the column each one is partitioned by besides the date
+archiveTables = {
+    "Market_Transactions": "tradeSymbol"
+    ,"Market_TradeGoods": "symbol"
+}
+
+#Arrow types for the SQLite column types used by the market tables
+_arrowTypes = {"TEXT": "string", "INTEGER": "int64", "REAL": "float64"}
+
+
+def _table_dir(tableName):
+    """
+    Gets the folder a table's archive is written to.
+
+    Parameters:
+    tableName (str): Name of the table
+
+    Returns:
+    str: Path of the folder
+    """
+    return os.path.join(archiveDir, tableName)
+
+def _arrow_schema(tableName):
+    """
+    Builds the Arrow schema for a table from its SQLite definition, so every file of a table has the same column types.
+
+    Parameters:
+    tableName (str): Name of the table
+
+    Returns:
+    pa.Schema: Schema with one field per table column
+    """
+    conn = sqf.create_connection()
+    rows = conn.execute("PRAGMA table_info(" + tableName + ")").fetchall()
+    sqf.close_connection(conn)
+    return pa.schema([(r[1], getattr(pa, _arrowTypes.get(r[2].upper(), "string"))()) for r in rows])
+
+def cutoff_timestamp(days = archiveAfterDays):
+    """
+    Function that gets the timestamp rows older than days are archived before, in the API's ISO format.
+
+    Parameters:
+    days (int): Age in days
+
+    Returns:
+    str: ISO timestamp
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days = days)
+    return cutoff.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def write_partitions(tableName, df):
+    """
+    Function that writes rows to the archive, one Parquet file per date and symbol partition.
+    Files are laid out as <table>/date=YYYY-MM-DD/symbol=<symbol>/part-*.parquet and keep every column, so a file can be read on its own.
+    Each file is written under a temporary name and renamed when complete, so readers never see a half written file.
+    If any file fails, the files already written are removed before the error is raised.
+
+    Parameters:
+    tableName (str): Name of the table
+    df (pd.DataFrame): Rows to write, with every column of the table
+
+    Returns:
+    List of str: Paths of the files written
+    """
+    if len(df) == 0:
+        return []
+    symbolColumn = archiveTables[tableName]
+    schema = _arrow_schema(tableName)
+    dates = df['timestamp'].str.slice(0, 10)
+    partName = f"part-{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}.parquet"
+    files = []
+    tempPath = None
+    try:
+        for (date, symbol), part in df.groupby([dates, df[symbolColumn]], sort = False):
+            folder = os.path.join(_table_dir(tableName), f"date={date}", f"symbol={symbol}")
+            os.makedirs(folder, exist_ok = True)
+            table = pa.Table.from_pandas(part[schema.names], schema = schema, preserve_index = False)
+            path = os.path.join(folder, partName)
+            tempPath = path + ".tmp"
+            pq.write_table(table, tempPath)
+            os.replace(tempPath, path)
+            files.append(path)
+    except Exception:
+        remove_files(files + [tempPath] if tempPath else files)
+        raise
+    return files
+
+def remove_files(paths):
+    """
+    Function that removes archive files, used to undo a write that was not committed.
+
+    Parameters:
+    paths (List of str): Paths of the files
+
+    Returns:
+    None
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def archive_table(tableName, before = None):
+    """
+    Function that moves rows older than a timestamp out of SQLite and into the Parquet archive.
+    The rows are read without a lock and written to Parquet, then only those rows are deleted in a short write transaction,
+    so the database writer is not held up for the Parquet write. If the write, the delete or the commit fails the new files
+    are removed, so the rows stay in SQLite only and no row is ever in both tiers or deleted without being archived.
+
+    Parameters:
+    tableName (str): Name of the table, one of archiveTables
+    before (str): ISO timestamp, rows older than it are archived, defaults to archiveAfterDays ago.
+                  Trade goods are cut at the start of its keyframe window, so a window is never split between SQLite and the archive
+
+    Returns:
+    Dict: rows moved and files written
+    """
+    if not archiveAvailable:
+        print("pyarrow is not installed, nothing archived")
+        return {'rows': 0, 'files': 0}
+    if tableName not in archiveTables:
+        raise ValueError(f"{tableName} cannot be archived")
+    if before is None:
+        before = cutoff_timestamp()
+    if tableName == "Market_TradeGoods":
+        before = trade_goods.window_start(before, 0)
+    conn = sqf.create_connection()
+    files = []
+    try:
+        df = pd.read_sql_query("SELECT rowid AS archiveRowId, * FROM " + tableName + " WHERE timestamp < ?", conn, params = [before])
+        rowIds = df.pop('archiveRowId')
+        files = write_partitions(tableName, df)
+        #Rows are deleted by rowid, so a row stored after the read is never deleted without being archived
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("DELETE FROM " + tableName + " WHERE rowid = ?", ((int(r),) for r in rowIds))
+        conn.commit()
+    except Exception:
+        if conn.in_transaction:
+            conn.rollback()
+        remove_files(files)
+        raise
+    finally:
+        sqf.close_connection(conn)
+    return {'rows': len(df), 'files': len(files)}
+
+def archive_market_history(days = archiveAfterDays):
+    """
+    Function that archives every market table.
+
+    Parameters:
+    days (int): Rows older than this many days are archived
+
+    Returns:
+    Dict: Maps table name to the rows moved and files written
+    """
+    before = cutoff_timestamp(days)
+    return {t: archive_table(t, before) for t in archiveTables}
+
+def _partition_files(tableName, symbols = None, start = None, end = None):
+    """
+    Lists the archive files that can hold rows for the given symbols and time window, skipping every other partition folder.
+
+    Parameters:
+    tableName (str): Name of the table
+    symbols (List of str): Symbols to keep, None keeps every symbol
+    start (str): ISO timestamp, partitions before its date are skipped
+    end (str): ISO timestamp, partitions after its date are skipped
+
+    Returns:
+    List of str: Paths of the files
+    """
+    tableDir = _table_dir(tableName)
+    if not os.path.isdir(tableDir):
+        return []
+    startDate = start[:10] if start else None
+    endDate = end[:10] if end else None
+    files = []
+    for dateFolder in sorted(os.listdir(tableDir)):
+        date = dateFolder.partition("=")[2]
+        if (startDate and date < startDate) or (endDate and date > endDate):
+            continue
+        datePath = os.path.join(tableDir, dateFolder)
+        for symbolFolder in sorted(os.listdir(datePath)):
+            if symbols is not None and symbolFolder.partition("=")[2] not in symbols:
+                continue
+            symbolPath = os.path.join(datePath, symbolFolder)
+            files.extend(os.path.join(symbolPath, f) for f in sorted(os.listdir(symbolPath)) if f.endswith(".parquet"))
+    return files
+
+def has_archive(tableName):
+    """
+    Function that checks if a table has anything in the archive.
+
+    Parameters:
+    tableName (str): Name of the table
+
+    Returns:
+    bool: True if the archive folder for the table has any partitions
+    """
+    tableDir = _table_dir(tableName)
+    return archiveAvailable and os.path.isdir(tableDir) and len(os.listdir(tableDir)) > 0
+
+def archived_symbols(tableName):
+    """
+    Function that gets every symbol with a partition in the archive, read from the folder names.
+
+    Parameters:
+    tableName (str): Name of the table
+
+    Returns:
+    Set of str: Symbols in the archive
+    """
+    if not has_archive(tableName):
+        return set()
+    tableDir = _table_dir(tableName)
+    return {f.partition("=")[2] for d in os.listdir(tableDir) for f in os.listdir(os.path.join(tableDir, d))}
+
+def read_archive(tableName, columns = None, filters = None, start = None, end = None):
+    """
+    Function that reads rows from the archive. Folders outside the symbols and dates asked for are never opened,
+    and only the requested columns are read from each memory mapped file.
+
+    Parameters:
+    tableName (str): Name of the table
+    columns (List of str): Columns to return, None returns every column
+    filters (Dict): Maps column name to a value or a list of values the column must match
+    start (str): Only rows with a timestamp at or after this ISO timestamp
+    end (str): Only rows with a timestamp before this ISO timestamp
+
+    Returns:
+    pd.DataFrame: Matching rows, unsorted
+    """
+    if not has_archive(tableName):
+        return pd.DataFrame(columns = columns)
+    filters = {c: v for c, v in (filters or {}).items() if v is not None}
+    symbolColumn = archiveTables[tableName]
+    symbols = filters.get(symbolColumn)
+    if symbols is not None and not isinstance(symbols, (list, tuple, set)):
+        symbols = [symbols]
+    files = _partition_files(tableName, None if symbols is None else set(symbols), start, end)
+    readColumns = None
+    if columns is not None:
+        readColumns = list(dict.fromkeys(list(columns) + list(filters) + ['timestamp']))
+    frames = [pq.read_table(f, columns = readColumns, memory_map = True).to_pandas() for f in files]
+    if not frames:
+        return pd.DataFrame(columns = columns)
+    df = pd.concat(frames, ignore_index = True)
+    keep = pd.Series(True, index = df.index)
+    for c, v in filters.items():
+        keep &= df[c].isin(list(v)) if isinstance(v, (list, tuple, set)) else df[c] == v
+    if start is not None:
+        keep &= df['timestamp'] >= start
+    if end is not None:
+        keep &= df['timestamp'] < end
+    df = df[keep]
+    if columns is not None:
+        df = df[list(columns)]
+    return df.reset_index(drop = True)
@@ -1,9 +1,9 @@
 import json
 
 import pandas as pd
-import requests
 import streamlit as st
 
+import util.api_client as api
 import util.sqlite_functions as sqf
 
 
@@ -69,11 +69,7 @@ class Contract():
         Returns:
         bool: Whether the contract was accepted
         """
-        url = "https://api.spacetraders.io/v2/my/contracts/" + self.id + "/accept"
-        headers = {'Authorization': f'Bearer {token}'
-                   ,"Accept": "application/json"
-                   ,"Content-Type": "application/json"}
-        response = requests.post(url, headers = headers)
+        response = api.get_client(token).post("/my/contracts/" + self.id + "/accept")
         if response.status_code == 200:
             self.accepted = True
             return True
@@ -90,9 +86,7 @@ def get_contracts(token):
     Returns:
     List of Contract: List of Contract objects
     """
-    url = 'https://api.spacetraders.io/v2/my/contracts'
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get(url, headers = headers)
+    response = api.get_client(token).get("/my/contracts")
     if response.status_code == 200:
         accepted = True
         return response
@@ -0,0 +1,315 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+import util.sqlite_functions as sqf
+
+#Writes waiting in the queue before submit blocks the producer
+defaultMaxQueued = 64
+
+#Most queued writes committed together in one transaction
+defaultMaxGroup = 32
+
+#Seconds the writer waits for more writes after the first one before committing
+defaultLinger = 0.05
+
+#Seconds to wait for queued writes when the process exits
+exitFlushTimeout = 30
+
+
+class DbWriteError(Exception):
+    """
+    Exception raised by flush when writes queued before it failed.
+
+    Attributes:
+    errors (List of Exceptions): Exception of each failed write
+    """
+    def __init__(self, errors):
+        """
+        Initializes a DbWriteError object.
+
+        Parameters:
+        errors (List of Exceptions): Exception of each failed write
+
+        Returns:
+        None
+        """
+        super().__init__(f"{len(errors)} database writes failed, first error: {errors[0]}")
+        self.errors = errors
+
+
+class DbWriter():
+    """
+    Class that represents the single background thread that writes to the SQLite database.
+    Producers put writes on a bounded queue and get a Future back, the Future is the acknowledgement that the write was committed.
+    Writes waiting in the queue are committed together in one transaction, each inside its own savepoint so a failing write only undoes itself.
+
+    Attributes:
+    maxQueued (int): Writes waiting in the queue before submit blocks
+    maxGroup (int): Most writes committed in one transaction
+    linger (float): Seconds to wait for more writes before committing
+    failures (int): Writes that failed since the writer was created
+    """
+    def __init__(self, maxQueued = defaultMaxQueued, maxGroup = defaultMaxGroup, linger = defaultLinger):
+        """
+        Initializes a DbWriter object. The thread starts on the first write.
+
+        Parameters:
+        maxQueued (int): Writes waiting in the queue before submit blocks
+        maxGroup (int): Most writes committed in one transaction
+        linger (float): Seconds to wait for more writes before committing
+
+        Returns:
+        None
+        """
+        self.maxQueued = maxQueued
+        self.maxGroup = maxGroup
+        self.linger = linger
+        self._queue = queue.Queue(maxsize = maxQueued)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.failures = 0
+        self._errors = []
+
+    def _start(self):
+        """
+        Starts the writer thread if it is not running.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target = self._run, name = "db-writer", daemon = True)
+                self._thread.start()
+
+    def submit(self, write, after = None, timeout = None):
+        """
+        Queues a write. Blocks while the queue is full, which slows producers down to the speed of the disk.
+
+        Parameters:
+        write (Callable): Called on the writer thread with a connection inside a transaction, must not commit, its return value is the Future's result
+        after (Callable): Called on the writer thread with the result once the write is committed
+        timeout (float): Seconds to wait for room in the queue, None waits forever
+
+        Returns:
+        Future: Resolves to the write's result once it is committed, or to its exception
+        """
+        future = Future()
+        self._start()
+        self._queue.put((write, after, future), timeout = timeout)
+        return future
+
+    def submit_rows(self, tableName, rows, columns = None, onConflict = None, after = None, timeout = None):
+        """
+        Queues rows to insert into a table.
+
+        Parameters:
+        tableName (str): Name of the table
+        rows (pd.DataFrame or List of Dicts): Rows to insert
+        columns (List of str): Columns to insert, defaults to the DataFrame's columns or the keys of the first row
+        onConflict (str): Conflict clause, e.g. "IGNORE" to skip rows that break a unique key
+        after (Callable): Called with the counts once the rows are committed
+        timeout (float): Seconds to wait for room in the queue, None waits forever
+
+        Returns:
+        Future: Resolves to a Dict of rows, inserted and skipped counts once the rows are committed
+        """
+        def write(conn):
+            query, chunks = sqf.prepare_insert(tableName, rows, columns, onConflict = onConflict)
+            total = 0
+            before = conn.total_changes
+            for chunk in chunks:
+                conn.executemany(query, chunk)
+                total += len(chunk)
+            inserted = min(conn.total_changes - before, total)
+            return {'rows': total, 'inserted': inserted, 'skipped': total - inserted}
+        return self.submit(write, after, timeout)
+
+    def flush(self, timeout = None):
+        """
+        Waits until every write queued before the call is committed.
+        Writes that failed since the last flush are raised together, so a caller that dropped the Futures still finds out.
+
+        Parameters:
+        timeout (float): Seconds to wait, None waits forever
+
+        Returns:
+        bool: True if everything was written in time
+
+        Raises:
+        DbWriteError: If any write queued since the last flush failed
+        """
+        flushed = True
+        if self._thread is not None:
+            try:
+                self.submit(None, timeout = timeout).result(timeout = timeout)
+            except Exception:
+                flushed = False
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            raise DbWriteError(errors)
+        return flushed
+
+    def _record_failure(self, error):
+        """
+        Logs a failed write or after callback and keeps it for the next flush. Runs on the writer thread.
+
+        Parameters:
+        error (Exception): Exception the write or its after callback raised
+
+        Returns:
+        None
+        """
+        print(f"Error writing to database: {error}")
+        with self._lock:
+            self.failures += 1
+            self._errors.append(error)
+
+    def _next_group(self):
+        """
+        Takes the next writes off the queue, waiting up to linger for more after the first.
+        A flush marker ends the group so it is acknowledged only after the writes before it.
+
+        Parameters:
+        None
+
+        Returns:
+        List of Tuples: (write, after, future) for each write in the group
+        """
+        group = [self._queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(group) < self.maxGroup and group[-1][0] is not None:
+            try:
+                group.append(self._queue.get(timeout = max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return group
+
+    def _run(self):
+        """
+        Writer thread loop, commits one group of writes per transaction.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        while True:
+            group = self._next_group()
+            writes = [g for g in group if g[0] is not None]
+            results = self._write_group(writes) if writes else []
+            for (write, after, future), (ok, value) in zip(writes, results):
+                if ok:
+                    future.set_result(value)
+                    if after is not None:
+                        try:
+                            after(value)
+                        except Exception as e:
+                            #The write is committed but whatever after keeps in step with it is not, flush reports it like a failed write
+                            self._record_failure(e)
+                else:
+                    self._record_failure(value)
+                    future.set_exception(value)
+            for write, after, future in group:
+                if write is None:
+                    future.set_result(True)
+
+    def _write_group(self, writes):
+        """
+        Runs a group of writes in one transaction, each in its own savepoint.
+
+        Parameters:
+        writes (List of Tuples): (write, after, future) for each write
+
+        Returns:
+        List of Tuples: (True, result) or (False, exception) for each write
+        """
+        conn = None
+        results = []
+        try:
+            #A connection that cannot be opened fails the group instead of killing the writer thread
+            conn = sqf.create_connection()
+            if conn is None:
+                raise sqlite3.OperationalError("Could not open a connection to the database")
+            conn.execute("BEGIN IMMEDIATE")
+            for write, after, future in writes:
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((True, write(conn)))
+                    conn.execute("RELEASE write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((False, e))
+            conn.commit()
+        except Exception as e:
+            if conn is not None and conn.in_transaction:
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+            results = [(False, e) for w in writes]
+        finally:
+            if conn is not None:
+                sqf.close_connection(conn)
+        return results
+
+_writer = None
+_writerLock = threading.Lock()
+
+def get_writer():
+    """
+    Function that gets the process wide database writer, creating it on first use.
+
+    Parameters:
+    None
+
+    Returns:
+    DbWriter: Database writer
+    """
+    global _writer
+    with _writerLock:
+        if _writer is None:
+            _writer = DbWriter()
+        return _writer
+
+def flush(timeout = None):
+    """
+    Function that waits until every write queued so far is committed.
+
+    Parameters:
+    timeout (float): Seconds to wait, None waits forever
+
+    Returns:
+    bool: True if everything was written in time
+
+    Raises:
+    DbWriteError: If any write queued since the last flush failed
+    """
+    return _writer is None or _writer.flush(timeout)
+
+def _flush_at_exit():
+    """
+    Function that flushes the writer when the process exits, failed writes were already logged on the writer thread.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    try:
+        flush(exitFlushTimeout)
+    except DbWriteError as e:
+        print(e)
+
+atexit.register(_flush_at_exit)
@@ -0,0 +1,505 @@
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import util.api_client as api
+import util.spatial as spatial
+import util.sqlite_functions as sqf
+import util.universe as universe
+
+#Warp travel time multiplier in CRUISE, the API uses it the same way as the in-system multipliers
+warpTimeMultiplier = 50
+
+#Fixed seconds added to every warp
+warpTimeOverhead = 15
+
+#Seconds a jump is assumed to cost, the ship's cooldown after jumping
+jumpCost = 60
+
+#Edge kinds in the adjacency structure
+EDGE_WARP = 0
+EDGE_JUMP = 1
+edgeNames = {EDGE_WARP: "WARP", EDGE_JUMP: "JUMP"}
+
+#How long stored jump gate connections are used before they are refreshed in the background, in seconds
+jumpGateTtl = 24 * 3600
+
+#Seconds between background jump gate refreshes, so a refresh that keeps failing is not restarted on every lookup
+jumpGateRetryInterval = 30 * 60
+
+#Graphs by (universe fetch time, jump gate fetch time, warp range, engine speed)
+_graphs = {}
+_graphsLock = threading.Lock()
+
+_refreshLock = threading.Lock()
+_refreshThread = None
+_lastRefreshStart = None
+
+
+def ensure_jump_gate_table():
+    """
+    Function that creates the Jump_Gate_Connections table if it does not exist.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    conn = sqf.create_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS Jump_Gate_Connections (systemSymbol TEXT NOT NULL, waypointSymbol TEXT NOT NULL, connectedSymbol TEXT NOT NULL, connectedSystemSymbol TEXT NOT NULL, fetchedAt REAL NOT NULL, PRIMARY KEY (waypointSymbol, connectedSymbol))")
+    conn.commit()
+    sqf.close_connection(conn)
+
+def system_of(waypointSymbol):
+    """
+    Function that gets the system symbol of a waypoint symbol, e.g. X1-AB12 for X1-AB12-I55.
+
+    Parameters:
+    waypointSymbol (str): Symbol for the waypoint
+
+    Returns:
+    str: Symbol for the system
+    """
+    return "-".join(waypointSymbol.split("-")[:2])
+
+def fetch_jump_gate(token, systemSymbol, waypointSymbol):
+    """
+    Function that gets the connections of a jump gate from the API.
+
+    Parameters:
+    token (str): Token for the agent
+    systemSymbol (str): Symbol for the system
+    waypointSymbol (str): Symbol for the jump gate waypoint
+
+    Returns:
+    List of str: Symbols of the connected jump gates, None if the request failed
+    """
+    response = api.get_client(token).get(f"/systems/{systemSymbol}/waypoints/{waypointSymbol}/jump-gate")
+    if response.status_code == 200:
+        return response.json()['data']['connections']
+    else:
+        print(f"Error: {response.status_code} - {response.text}")
+        return None
+
+def refresh_jump_gates(token, systemSymbols = None, maxWorkers = api.defaultPageWorkers):
+    """
+    Function that fetches the connections of every known jump gate and stores them.
+    Jump gates are read from the System_Waypoints table the universe loader fills. Gates that fail, for example
+    uncharted ones, keep their stored connections.
+
+    Parameters:
+    token (str): Token for the agent
+    systemSymbols (Iterable of str): Only refresh gates in these systems, None refreshes every gate
+    maxWorkers (int): Maximum number of gates fetched at the same time
+
+    Returns:
+    int: Number of gates refreshed
+    """
+    gates = universe.load_system_waypoints()
+    gates = gates[gates['type'] == "JUMP_GATE"]
+    if systemSymbols is not None:
+        gates = gates[gates['systemSymbol'].isin(list(systemSymbols))]
+    gateList = list(zip(gates['systemSymbol'], gates['symbol']))
+    with ThreadPoolExecutor(max_workers = max(1, maxWorkers)) as executor:
+        results = list(executor.map(lambda g: fetch_jump_gate(token, g[0], g[1]), gateList))
+    fetchedAt = time.time()
+    ensure_jump_gate_table()
+    conn = sqf.create_connection()
+    refreshed = 0
+    with conn:
+        for (systemSymbol, waypointSymbol), connections in zip(gateList, results):
+            if connections is None:
+                continue
+            conn.execute("DELETE FROM Jump_Gate_Connections WHERE waypointSymbol = ?", (waypointSymbol,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO Jump_Gate_Connections VALUES (?, ?, ?, ?, ?)"
+                ,[(systemSymbol, waypointSymbol, c, system_of(c), fetchedAt) for c in connections]
+            )
+            refreshed += 1
+    sqf.close_connection(conn)
+    return refreshed
+
+def load_jump_connections():
+    """
+    Function that loads the stored jump gate connections as system pairs.
+
+    Parameters:
+    None
+
+    Returns:
+    Tuple: List of (systemSymbol, connectedSystemSymbol) pairs, and the latest fetch time or None
+    """
+    ensure_jump_gate_table()
+    conn = sqf.create_connection()
+    pairs = conn.execute("SELECT DISTINCT systemSymbol, connectedSystemSymbol FROM Jump_Gate_Connections").fetchall()
+    latest = conn.execute("SELECT MAX(fetchedAt) FROM Jump_Gate_Connections").fetchone()[0]
+    sqf.close_connection(conn)
+    return pairs, latest
+
+def jump_gates_stale(jumpFetchedAt, ttl = jumpGateTtl):
+    """
+    Function that checks if the stored jump gate connections need a refresh.
+
+    Parameters:
+    jumpFetchedAt (float): Latest fetch time from load_jump_connections, None if nothing is stored
+    ttl (float): Maximum age in seconds
+
+    Returns:
+    bool: True if nothing is stored, the connections are older than the ttl, or the universe was reloaded since
+    """
+    if jumpFetchedAt is None:
+        return True
+    if time.time() - jumpFetchedAt > ttl:
+        return True
+    universeFetchedAt = universe.get_meta()["fetchedAt"]
+    return universeFetchedAt is not None and datetime.fromisoformat(universeFetchedAt).timestamp() > jumpFetchedAt
+
+def _refresh_jump_gates_thread(token):
+    """
+    Function run on the background thread, refreshes every jump gate.
+
+    Parameters:
+    token (str): Token for the agent
+
+    Returns:
+    None
+    """
+    global _refreshThread
+    try:
+        print(f"Refreshed {refresh_jump_gates(token)} jump gates")
+    except Exception as e:
+        print(e)
+    finally:
+        with _refreshLock:
+            _refreshThread = None
+
+def refresh_jump_gates_in_background(token):
+    """
+    Function that starts a background refresh of the jump gate connections, unless one is running or started recently.
+
+    Parameters:
+    token (str): Token for the agent
+
+    Returns:
+    bool: True if a refresh was started
+    """
+    global _refreshThread, _lastRefreshStart
+    with _refreshLock:
+        now = time.time()
+        if _refreshThread is not None or (_lastRefreshStart is not None and now - _lastRefreshStart < jumpGateRetryInterval):
+            return False
+        _lastRefreshStart = now
+        _refreshThread = threading.Thread(target = _refresh_jump_gates_thread, args = (token,), daemon = True)
+        _refreshThread.start()
+        return True
+
+def warp_time(distance, speed):
+    """
+    Function that computes how long a warp takes in CRUISE, works on scalars and arrays.
+
+    Parameters:
+    distance (float or np.ndarray): Distance of the warp
+    speed (int): Engine speed of the ship
+
+    Returns:
+    np.ndarray: Seconds
+    """
+    distance = np.asarray(distance, dtype = float)
+    return np.round(np.round(np.maximum(1, distance)) * (warpTimeMultiplier / speed) + warpTimeOverhead)
+
+def warp_fuel(distance):
+    """
+    Function that computes the fuel a warp burns in CRUISE, works on scalars and arrays.
+
+    Parameters:
+    distance (float or np.ndarray): Distance of the warp
+
+    Returns:
+    np.ndarray: Fuel units
+    """
+    return np.maximum(1, np.round(np.asarray(distance, dtype = float)))
+
+
+class GalaxyGraph():
+    """
+    Class that represents the galaxy as a graph of systems, with jump gate edges and warp edges
+    between systems closer than the warp range. Adjacency is precomputed in compressed sparse row form,
+    the neighbours of system i are indices[indptr[i]:indptr[i + 1]]. Edge costs are travel time in seconds.
+
+    Attributes:
+    symbols (np.ndarray): System symbols, by node
+    positions (Dict): Maps system symbol to node
+    x (np.ndarray): x coordinate of each node
+    y (np.ndarray): y coordinate of each node
+    indptr (np.ndarray): Start of each node's edges
+    indices (np.ndarray): Neighbour node of each edge
+    costs (np.ndarray): Cost of each edge in seconds
+    kinds (np.ndarray): EDGE_WARP or EDGE_JUMP for each edge
+    distances (np.ndarray): Distance of each edge
+    scale (float): Lowest cost per unit of distance over the warp edges
+    gateIndex (spatial.SystemIndex): Spatial index over the systems with a jump gate edge
+    """
+    def __init__(self, index, jumpPairs, warpRange, speed):
+        """
+        Initializes a GalaxyGraph object.
+
+        Parameters:
+        index (spatial.SystemIndex): Spatial index over the systems
+        jumpPairs (List of Tuples): (systemSymbol, connectedSystemSymbol) jump gate connections
+        warpRange (float): Longest warp the ship can make, 0 for no warp edges
+        speed (int): Engine speed of the ship
+
+        Returns:
+        None
+        """
+        self.symbols = index.df['symbol'].to_numpy()
+        self.positions = index.symbolPositions
+        self.x = index.x
+        self.y = index.y
+        nodeCount = len(self.symbols)
+
+        sources = []
+        targets = []
+        kinds = []
+        if warpRange > 0:
+            for i in range(nodeCount):
+                neighbours, _ = index.within_positions(self.x[i], self.y[i], warpRange)
+                neighbours = neighbours[neighbours != i]
+                sources.append(np.full(len(neighbours), i))
+                targets.append(neighbours)
+                kinds.append(np.full(len(neighbours), EDGE_WARP))
+        jumpSources = []
+        jumpTargets = []
+        for a, b in jumpPairs:
+            i = self.positions.get(a)
+            j = self.positions.get(b)
+            if i is None or j is None or i == j:
+                continue
+            #Gates connect both ways
+            jumpSources.extend([i, j])
+            jumpTargets.extend([j, i])
+        sources.append(np.array(jumpSources, dtype = np.int64))
+        targets.append(np.array(jumpTargets, dtype = np.int64))
+        kinds.append(np.full(len(jumpSources), EDGE_JUMP))
+
+        sources = np.concatenate(sources).astype(np.int64)
+        targets = np.concatenate(targets).astype(np.int64)
+        kinds = np.concatenate(kinds).astype(np.int64)
+        distances = np.hypot(self.x[sources] - self.x[targets], self.y[sources] - self.y[targets])
+        costs = np.where(kinds == EDGE_JUMP, float(jumpCost), warp_time(distances, speed))
+
+        order = np.lexsort((costs, sources))
+        self.indices = targets[order]
+        self.kinds = kinds[order]
+        self.distances = distances[order]
+        self.costs = costs[order]
+        self.indptr = np.searchsorted(sources[order], np.arange(nodeCount + 1))
+        #Jumps cost the same at any distance, so only warps bound the cost per unit of distance
+        moving = (self.distances > 0) & (self.kinds == EDGE_WARP)
+        self.scale = float((self.costs[moving] / self.distances[moving]).min()) if moving.any() else 0.0
+        gateNodes = np.unique(self.indices[self.kinds == EDGE_JUMP])
+        self.gateIndex = spatial.SystemIndex(pd.DataFrame({'x': self.x[gateNodes], 'y': self.y[gateNodes]}))
+        self._gateDistances = {}
+
+    def _gate_distance(self, node):
+        """
+        Gets the distance from a node to the closest system with a jump gate edge.
+
+        Parameters:
+        node (int): Node
+
+        Returns:
+        float: Distance, inf if there are no jump edges
+        """
+        distance = self._gateDistances.get(node)
+        if distance is None:
+            nearest = self.gateIndex.nearest(self.x[node], self.y[node], k = 1)
+            distance = float(nearest['Distance'].iloc[0]) if len(nearest) else float("inf")
+            self._gateDistances[node] = distance
+        return distance
+
+    def _lower_bound(self, node, goal):
+        """
+        Gets a consistent lower bound on the travel time from a node to a goal.
+        A route either warps the whole way, costing at least scale times the straight line distance, or warps to a gate,
+        jumps at least once and warps from a gate to the goal. Each jump edge changes the bound by at most jumpCost.
+
+        Parameters:
+        node (int): Node
+        goal (int): Goal node
+
+        Returns:
+        float: Seconds
+        """
+        direct = self.scale * np.hypot(self.x[node] - self.x[goal], self.y[node] - self.y[goal])
+        viaGates = jumpCost + self.scale * (self._gate_distance(node) + self._gate_distance(goal))
+        return min(direct, viaGates)
+
+    def _potential(self, node, source, target):
+        """
+        Gets the average potential of a node, the heuristic both search directions share.
+
+        Parameters:
+        node (int): Node
+        source (int): Start node
+        target (int): Goal node
+
+        Returns:
+        float: Potential of the node
+        """
+        return (self._lower_bound(node, target) - self._lower_bound(node, source)) / 2
+
+    def shortest_path(self, origin, destination):
+        """
+        Finds the fastest itinerary between two systems with bidirectional A*.
+        Both searches run Dijkstra on costs reduced by the average potential, so the usual
+        bidirectional stopping rule holds while the straight line distance still guides the search.
+
+        Parameters:
+        origin (str): Symbol of the start system
+        destination (str): Symbol of the goal system
+
+        Returns:
+        Dict: path (List of str), hops (List of Dicts), time (float seconds), fuel (int), None if there is no route
+        """
+        source = self.positions.get(origin)
+        target = self.positions.get(destination)
+        if source is None or target is None:
+            return None
+        if source == target:
+            return {"path": [origin], "hops": [], "time": 0.0, "fuel": 0}
+
+        potentials = {}
+        def potential(node):
+            if node not in potentials:
+                potentials[node] = self._potential(node, source, target)
+            return potentials[node]
+
+        #Index 0 is the forward search from the origin, index 1 the reverse search from the destination
+        dist = [{source: 0.0}, {target: 0.0}]
+        previous = [{source: None}, {target: None}]
+        heaps = [[(0.0, source)], [(0.0, target)]]
+        signs = [1, -1]
+        best = float("inf")
+        meet = None
+        while heaps[0] and heaps[1]:
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            d, node = heapq.heappop(heaps[side])
+            if d > dist[side][node]:
+                continue
+            sign = signs[side]
+            nodePotential = sign * potential(node)
+            for e in range(self.indptr[node], self.indptr[node + 1]):
+                neighbour = int(self.indices[e])
+                reduced = self.costs[e] - nodePotential + sign * potential(neighbour)
+                newDist = d + max(0.0, reduced)
+                if newDist < dist[side].get(neighbour, float("inf")):
+                    dist[side][neighbour] = newDist
+                    previous[side][neighbour] = (node, e)
+                    heapq.heappush(heaps[side], (newDist, neighbour))
+                    other = dist[1 - side].get(neighbour)
+                    if other is not None and newDist + other < best:
+                        best = newDist + other
+                        meet = neighbour
+        if meet is None:
+            return None
+
+        #Walk back to the origin, then forward to the destination
+        hops = []
+        node = meet
+        while previous[0][node] is not None:
+            fromNode, e = previous[0][node]
+            hops.append(self._hop(fromNode, node, e))
+            node = fromNode
+        hops.reverse()
+        node = meet
+        while previous[1][node] is not None:
+            toNode, e = previous[1][node]
+            hops.append(self._hop(node, toNode, e))
+            node = toNode
+        return {
+            "path": [origin] + [h["to"] for h in hops]
+            ,"hops": hops
+            ,"time": float(sum(h["time"] for h in hops))
+            ,"fuel": int(sum(h["fuel"] for h in hops))
+        }
+
+    def _hop(self, fromNode, toNode, edge):
+        """
+        Describes one hop of an itinerary.
+
+        Parameters:
+        fromNode (int): Node the hop leaves from
+        toNode (int): Node the hop arrives at
+        edge (int): Edge used, stored on either endpoint
+
+        Returns:
+        Dict: from, to, method, distance, time and fuel of the hop
+        """
+        kind = int(self.kinds[edge])
+        distance = float(self.distances[edge])
+        return {
+            "from": str(self.symbols[fromNode])
+            ,"to": str(self.symbols[toNode])
+            ,"method": edgeNames[kind]
+            ,"distance": distance
+            ,"time": float(self.costs[edge])
+            ,"fuel": 0 if kind == EDGE_JUMP else int(warp_fuel(distance))
+        }
+
+def get_graph(warpRange, speed, token = None):
+    """
+    Function that gets the galaxy graph for a warp range and engine speed.
+    Graphs are built once and reused until the stored universe or jump gate connections change.
+    With a token, missing or stale jump gate connections are refreshed in the background and picked up by a later call.
+
+    Parameters:
+    warpRange (float): Longest warp the ship can make, 0 for no warp edges
+    speed (int): Engine speed of the ship
+    token (str): Token for the agent, None never refreshes the jump gates
+
+    Returns:
+    GalaxyGraph: Graph over every stored system
+    """
+    index = universe.get_system_index()
+    jumpPairs, jumpFetchedAt = load_jump_connections()
+    if token is not None and jump_gates_stale(jumpFetchedAt):
+        refresh_jump_gates_in_background(token)
+    key = (universe.get_meta()["fetchedAt"], jumpFetchedAt, len(jumpPairs), float(warpRange), speed)
+    with _graphsLock:
+        graph = _graphs.get(key)
+        if graph is None:
+            graph = GalaxyGraph(index, jumpPairs, warpRange, speed)
+            #Graphs from an older universe or gate list are never used again
+            for oldKey in [k for k in _graphs if k[:3] != key[:3]]:
+                del _graphs[oldKey]
+            _graphs[key] = graph
+        return graph
+
+def plan_ship_itinerary(ship, destinationSystem, warpRange = None, token = None):
+    """
+    Function that plans a multi hop itinerary for a ship to another system.
+    Warp edges are limited to the ship's fuel capacity, the ship is assumed to refuel between warps.
+
+    Parameters:
+    ship (Ship): Ship object
+    destinationSystem (str): Symbol of the goal system
+    warpRange (float): Longest warp allowed, defaults to the ship's fuel capacity
+    token (str): Token for the agent, used to refresh the jump gate connections when they are missing or stale
+
+    Returns:
+    Dict: Itinerary from GalaxyGraph.shortest_path, None if there is no route
+    """
+    if warpRange is None:
+        warpRange = ship.fuel['capacity']
+    graph = get_graph(warpRange, ship.engine['speed'], token)
+    return graph.shortest_path(ship.nav['systemSymbol'], destinationSystem)
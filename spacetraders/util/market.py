@@ -1,13 +1,20 @@
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 
 import pandas as pd
-import requests
 import streamlit as st
 
+import util.api_client as api
+import util.archive as archive
 import util.contracts as contracts
+import util.rollups as rollups
 import util.ships as ships
 import util.sqlite_functions as sqf
+import util.trade_goods as trade_goods
 
+#Markets polled at the same time for one agent token, the rate limiter still spaces the requests out
+defaultMarketWorkersPerToken = 4
 
 def check_market(token, symbol, waypointSymbol):
     """
@@ -21,36 +28,240 @@ def check_market(token, symbol, waypointSymbol):
     Returns:
     Dict: Dictionary containing market information
     """
-    url = f'https://api.spacetraders.io/v2/systems/{symbol}/waypoints/{waypointSymbol}/market'
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get(url, headers = headers)
+    response = api.get_client(token).get(f"/systems/{symbol}/waypoints/{waypointSymbol}/market")
     if response.status_code == 200:
         return response.json()['data']
     else:
             print(f"Error: {response.status_code} - {response.text}")
 
-def get_transactions():
+def _fetch_market(marketWaypoint):
     """
-    Function that gets all market transactions from SQLite database.
+    Fetches one market and stamps it with the time the response arrived.
 
     Parameters:
-    None
+    marketWaypoint (Dict): systemSymbol, waypointSymbol and token of the market
+
+    Returns:
+    Tuple: marketWaypoint, market data (None if the fetch failed), ISO timestamp of the fetch and the exception if one was raised
+    """
+    try:
+        marketData = check_market(marketWaypoint['token'], marketWaypoint['systemSymbol'], marketWaypoint['waypointSymbol'])
+        error = None
+    except Exception as e:
+        marketData = None
+        error = e
+    fetchedAt = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+    return marketWaypoint, marketData, fetchedAt, error
+
+def poll_markets(marketWaypoints, maxWorkersPerToken = defaultMarketWorkersPerToken):
+    """
+    Generator that fetches many markets at once and yields each one as it arrives.
+    Each token gets its own pool of maxWorkersPerToken threads, so one agent's markets cannot hold up another's.
+    A market that fails is yielded with its error instead of stopping the others, and a waypoint listed more than once is fetched once.
+
+    Parameters:
+    marketWaypoints (List of Dicts): systemSymbol, waypointSymbol and token of each market
+    maxWorkersPerToken (int): Markets fetched at the same time for one token
+
+    Returns:
+    Generator of Tuples: marketWaypoint, market data (None if the fetch failed), ISO timestamp of the fetch and the exception if one was raised
+    """
+    byToken = {}
+    seen = set()
+    for mw in marketWaypoints:
+        if mw['waypointSymbol'] in seen:
+            continue
+        seen.add(mw['waypointSymbol'])
+        byToken.setdefault(mw['token'], []).append(mw)
+    executors = [ThreadPoolExecutor(max_workers = max(1, min(maxWorkersPerToken, len(mws)))) for mws in byToken.values()]
+    try:
+        futures = [executor.submit(_fetch_market, mw) for executor, mws in zip(executors, byToken.values()) for mw in mws]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        #Stop fetching markets nobody will read if the consumer stops early
+        for executor in executors:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+def _select_tiers(tableName, columns, filters, start, end, orderBy, descending, limit, offset, includeArchive):
+    """
+    Gets rows from SQLite and, when the table has archived partitions, from the Parquet archive, as one result.
+    Each tier returns at most limit + offset rows in order, the merged rows are sorted and paged once more.
+
+    Parameters:
+    tableName (str): Name of the table
+    columns (List of str): Columns to return, None returns every column
+    filters (Dict): Maps column name to a value or a list of values the column must match
+    start (str): Only rows at or after this ISO timestamp
+    end (str): Only rows before this ISO timestamp
+    orderBy (str): Column to sort by
+    descending (bool): Sort newest first
+    limit (int): Maximum number of rows
+    offset (int): Rows to skip
+    includeArchive (bool): Read the archive as well as SQLite
 
     Returns:
-    pd.DataFrame: DataFrame containing all market transactions
+    pd.DataFrame: DataFrame containing the matching rows
     """
-    transactions = sqf.get_all_values('Market_Transactions')
+    if not (includeArchive and archive.has_archive(tableName)):
+        return sqf.select_values(tableName, columns, filters, 'timestamp', start, end, orderBy, descending, limit, offset)
+    tierLimit = None if limit is None else limit + (offset or 0)
+    #The sort column has to come back from both tiers to merge them
+    tierColumns = None if columns is None or orderBy is None or orderBy in columns else list(columns) + [orderBy]
+    tierColumns = tierColumns or columns
+    hot = sqf.select_values(tableName, tierColumns, filters, 'timestamp', start, end, orderBy, descending, tierLimit)
+    cold = archive.read_archive(tableName, tierColumns, filters, start, end)
+    if len(cold) == 0:
+        df = hot
+    else:
+        df = pd.concat([cold, hot], ignore_index = True)
+        if orderBy:
+            df = df.sort_values(by = orderBy, ascending = not descending, kind = 'stable')
+    if offset:
+        df = df.iloc[offset:]
+    if limit is not None:
+        df = df.iloc[:limit]
+    if columns is not None:
+        df = df[list(columns)]
+    return df.reset_index(drop = True)
+
+def get_transactions(tradeSymbol = None, waypointSymbol = None, start = None, end = None, columns = None, limit = None, offset = None, orderBy = "timestamp", descending = False, includeArchive = True):
+    """
+    Function that gets market transactions from SQLite database and the Parquet archive. Filtering, sorting and paging are done by SQLite,
+    archived partitions outside the trade goods and dates asked for are skipped. With no arguments every transaction is returned.
+
+    Parameters:
+    tradeSymbol (str or List of str): Only transactions of these trade goods
+    waypointSymbol (str or List of str): Only transactions at these waypoints
+    start (str): Only transactions at or after this ISO timestamp
+    end (str): Only transactions before this ISO timestamp
+    columns (List of str): Columns to return, None returns every column
+    limit (int): Maximum number of transactions
+    offset (int): Transactions to skip, used with limit for paging
+    orderBy (str): Column to sort by
+    descending (bool): Sort newest first
+    includeArchive (bool): Include archived transactions
+
+    Returns:
+    pd.DataFrame: DataFrame containing the matching market transactions
+    """
+    filters = {'tradeSymbol': tradeSymbol, 'waypointSymbol': waypointSymbol}
+    transactions = _select_tiers('Market_Transactions', columns, filters, start, end, orderBy, descending, limit, offset, includeArchive)
     return transactions
 
-def get_trade_goods():
+def get_trade_good_changes(symbol = None, waypointSymbol = None, start = None, end = None, columns = None, limit = None, offset = None, orderBy = "timestamp", descending = False, includeArchive = True):
+    """
+    Function that gets stored trade good changes from SQLite database and the Parquet archive. Filtering, sorting and paging are done by SQLite,
+    archived partitions outside the trade goods and dates asked for are skipped. With no arguments every stored row is returned.
+    Snapshots are delta encoded, a row is stored when a good changed and as a keyframe once per trade_goods.keyframeHours,
+    use get_current_trade_goods or get_trade_goods_as_of for the full state of every good.
+    
+    Parameters:
+    symbol (str or List of str): Only these trade goods
+    waypointSymbol (str or List of str): Only trade goods at these waypoints
+    start (str): Only snapshots at or after this ISO timestamp
+    end (str): Only snapshots before this ISO timestamp
+    columns (List of str): Columns to return, None returns every column
+    limit (int): Maximum number of rows
+    offset (int): Rows to skip, used with limit for paging
+    orderBy (str): Column to sort by
+    descending (bool): Sort newest first
+    includeArchive (bool): Include archived snapshots
+    
+    Returns:
+    pd.DataFrame: DataFrame containing the matching trade goods
+    """
+    filters = {'symbol': symbol, 'waypointSymbol': waypointSymbol}
+    changes = _select_tiers('Market_TradeGoods', columns, filters, start, end, orderBy, descending, limit, offset, includeArchive)
+    return changes
+
+def get_trade_goods(symbol = None, waypointSymbol = None, timestamp = None, includeArchive = True):
+    """
+    Function that gets the full state of trade goods, one row per waypoint and trade good, rebuilt from the stored changes and keyframes.
+    Use get_trade_good_changes for the stored rows themselves.
+    
+    Parameters:
+    symbol (str or List of str): Only these trade goods
+    waypointSymbol (str or List of str): Only trade goods at these waypoints
+    timestamp (str): ISO timestamp to rebuild the state at, None for the current state
+    includeArchive (bool): Include archived snapshots when rebuilding a past state
+    
+    Returns:
+    pd.DataFrame: State of each good, see get_current_trade_goods and get_trade_goods_as_of
+    """
+    if timestamp is None:
+        return get_current_trade_goods(symbol, waypointSymbol)
+    return get_trade_goods_as_of(timestamp, symbol, waypointSymbol, includeArchive)
+
+def get_current_trade_goods(symbol = None, waypointSymbol = None):
+    """
+    Function that gets the current state of trade goods, one row per waypoint and trade good.
+    
+    Parameters:
+    symbol (str or List of str): Only these trade goods
+    waypointSymbol (str or List of str): Only trade goods at these waypoints
+    
+    Returns:
+    pd.DataFrame: Newest state of each good, timestamp is when it was last seen and changedAt when it last changed
+    """
+    return trade_goods.get_latest(symbol, waypointSymbol)
+
+def get_trade_goods_as_of(timestamp, symbol = None, waypointSymbol = None, includeArchive = True):
     """
-    Function that gets all trade goods from SQLite database.
+    Function that rebuilds the state of trade goods at a point in time from the stored changes and keyframes.
+    Each good's state is its newest row at or before the timestamp, however long before it the market was last polled.
+    Goods with no such row left in SQLite are looked up in the Parquet archive.
+    
+    Parameters:
+    timestamp (str): ISO timestamp
+    symbol (str or List of str): Only these trade goods
+    waypointSymbol (str or List of str): Only trade goods at these waypoints
+    includeArchive (bool): Include archived snapshots
+    
+    Returns:
+    pd.DataFrame: One row per waypoint and trade good seen at or before the timestamp, the state it was in at the timestamp
+    """
+    timestamp = trade_goods.normalize_timestamp(timestamp)
+    state, missing = trade_goods.get_as_of(timestamp, symbol, waypointSymbol)
+    if missing and includeArchive and archive.has_archive('Market_TradeGoods'):
+        #Archived rows are all older than the rows left in SQLite, so only goods without a row in SQLite need the archive
+        filters = {'symbol': sorted({s for w, s in missing}), 'waypointSymbol': sorted({w for w, s in missing})}
+        cold = archive.read_archive('Market_TradeGoods', trade_goods.historyColumns, filters, end = trade_goods.instant_after(timestamp))
+        if len(cold) > 0:
+            cold = trade_goods.state_as_of(cold, timestamp)
+            missingKeys = set(missing)
+            cold = cold[[k in missingKeys for k in zip(cold['waypointSymbol'], cold['symbol'])]]
+            state = pd.concat([state, cold], ignore_index = True)
+    return state.sort_values(['waypointSymbol', 'symbol']).reset_index(drop = True)
+
+def get_transaction_trade_symbols():
+    """
+    Function that gets every trade good that has transactions in SQLite database or the Parquet archive.
     
     Parameters:
     None
     
     Returns:
-    pd.DataFrame: DataFrame containing all trade goods
+    List of str: Trade symbols, sorted
+    """
+    symbols = set(sqf.get_distinct_values('Market_Transactions', 'tradeSymbol'))
+    return sorted(symbols | archive.archived_symbols('Market_Transactions'))
+
+def get_price_candles(tradeSymbol, windowSeconds = None, waypointSymbol = None):
+    """
+    Function that gets price candles for a trade good over a time window ending now, from the OHLC rollups.
+    The resolution is picked so the window is drawn in at most rollups.maxChartPoints candles.
+
+    Parameters:
+    tradeSymbol (str): Symbol for the trade good
+    windowSeconds (float): Length of the time window, None for all of history
+    waypointSymbol (str): Only candles from this waypoint, None combines every waypoint
+
+    Returns:
+    Tuple: Resolution used and pd.DataFrame of candles sorted by bucket
     """
-    trade_goods = sqf.get_all_values('Market_TradeGoods')
-    return trade_goods
\ No newline at end of file
+    resolution = rollups.pick_resolution(windowSeconds)
+    start = rollups.window_start(windowSeconds)
+    if start is not None:
+        start = rollups.bucket_of(start, resolution)
+    return resolution, rollups.get_ohlc(tradeSymbol, resolution, start, waypointSymbol = waypointSymbol)
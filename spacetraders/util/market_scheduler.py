@@ -0,0 +1,150 @@
+import heapq
+import json
+import time
+from datetime import datetime, timezone
+
+import util.db_writer as db_writer
+import util.sqlite_functions as sqf
+
+#Market API calls each polling cycle may spend
+defaultBudget = 20
+
+#Seconds after which a market counts as fully stale, staleness is measured in these units
+targetInterval = 300
+
+#Seconds a market is left alone after being polled, however volatile it is
+minPollInterval = 60
+
+#Weight of the newest price change in the running volatility
+volatilityAlpha = 0.3
+
+#How much volatility raises a market's priority, a market whose prices move 10% per poll counts double
+volatilityWeight = 10
+
+
+def load_registry():
+    """
+    Function that loads every known market.
+
+    Parameters:
+    None
+
+    Returns:
+    Dict: Maps waypoint symbol to its registry row as a Dict
+    """
+    df = sqf.select_values("Market_Registry")
+    return {r['waypointSymbol']: r for r in df.to_dict('records')}
+
+def register_markets(marketWaypoints):
+    """
+    Function that records markets a ship is at now, adding markets seen for the first time.
+
+    Parameters:
+    marketWaypoints (List of Dicts): systemSymbol and waypointSymbol of each market
+
+    Returns:
+    None
+    """
+    now = time.time()
+    rows = {mw['waypointSymbol']: (mw['waypointSymbol'], mw['systemSymbol'], now, now) for mw in marketWaypoints}
+    if not rows:
+        return
+
+    def write(conn):
+        conn.executemany(
+            "INSERT INTO Market_Registry (waypointSymbol, systemSymbol, firstSeen, lastSeen) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (waypointSymbol) DO UPDATE SET lastSeen = excluded.lastSeen"
+            ,list(rows.values())
+        )
+    db_writer.get_writer().submit(write).result()
+
+def priority(entry, now):
+    """
+    Function that scores how much a market needs polling, staleness scaled up by its volatility.
+
+    Parameters:
+    entry (Dict): Registry row of the market
+    now (float): Current time in seconds since the epoch
+
+    Returns:
+    float: Priority, higher is polled first, inf for a market never polled and None for one polled too recently
+    """
+    if entry.get('lastPolled') is None or entry['lastPolled'] != entry['lastPolled']:
+        return float("inf")
+    age = now - entry['lastPolled']
+    if age < minPollInterval:
+        return None
+    return (age / targetInterval) * (1 + volatilityWeight * entry.get('volatility', 0))
+
+def select_markets(marketWaypoints, budget = defaultBudget):
+    """
+    Function that picks which of the markets ships are at now to poll this cycle.
+    Each market is listed once however many ships are at it, the budget most in need of polling are picked.
+
+    Parameters:
+    marketWaypoints (List of Dicts): systemSymbol, waypointSymbol and token of each market a ship is at
+    budget (int): Most markets to poll
+
+    Returns:
+    List of Dicts: The picked markets, highest priority first
+    """
+    registry = load_registry()
+    now = time.time()
+    queue = []
+    seen = set()
+    for i, mw in enumerate(marketWaypoints):
+        if mw['waypointSymbol'] in seen:
+            continue
+        seen.add(mw['waypointSymbol'])
+        score = priority(registry.get(mw['waypointSymbol'], {}), now)
+        if score is not None:
+            #heapq is a min-heap, the index breaks ties without comparing dicts
+            heapq.heappush(queue, (-score, i, mw))
+    return [heapq.heappop(queue)[2] for i in range(min(budget, len(queue)))]
+
+def price_change(oldPrices, newPrices):
+    """
+    Function that measures how much a market's prices moved between two polls.
+
+    Parameters:
+    oldPrices (Dict): Maps trade symbol to sell price at the previous poll
+    newPrices (Dict): Maps trade symbol to sell price at this poll
+
+    Returns:
+    float: Mean relative change over the goods in both polls, 0 if none are
+    """
+    changes = [abs(newPrices[s] - p) / p for s, p in oldPrices.items() if s in newPrices and p]
+    return sum(changes) / len(changes) if changes else 0.0
+
+def record_polls(results):
+    """
+    Function that records the outcome of a polling cycle, updating each market's last poll time and volatility.
+    A failed poll counts as a poll too, so a market that keeps failing waits minPollInterval and ages like any other instead of staying first in line.
+
+    Parameters:
+    results (List of Tuples): marketWaypoint, market data (None if the fetch failed) and ISO timestamp of the fetch, as yielded by market.poll_markets
+
+    Returns:
+    None
+    """
+    if not results:
+        return
+    registry = load_registry()
+    updates = []
+    failures = []
+    for mw, marketData, fetchedAt in results:
+        polledAt = datetime.strptime(fetchedAt, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo = timezone.utc).timestamp()
+        if marketData is None:
+            failures.append((polledAt, mw['waypointSymbol']))
+            continue
+        entry = registry.get(mw['waypointSymbol'], {})
+        newPrices = {tg['symbol']: tg['sellPrice'] for tg in marketData.get('tradeGoods', [])}
+        volatility = entry.get('volatility') or 0.0
+        if entry.get('lastPrices') and newPrices:
+            volatility = volatilityAlpha * price_change(json.loads(entry['lastPrices']), newPrices) + (1 - volatilityAlpha) * volatility
+        updates.append((polledAt, volatility, json.dumps(newPrices) if newPrices else entry.get('lastPrices'), mw['waypointSymbol']))
+
+    def write(conn):
+        conn.executemany("UPDATE Market_Registry SET lastPolled = ?, polls = polls + 1, volatility = ?, lastPrices = ? WHERE waypointSymbol = ?", updates)
+        conn.executemany("UPDATE Market_Registry SET lastPolled = ?, failures = failures + 1 WHERE waypointSymbol = ?", failures)
+    db_writer.get_writer().submit(write).result()
@@ -0,0 +1,179 @@
+import functools
+import os
+import threading
+import time
+import uuid
+
+import util.db_writer as db_writer
+
+#Prometheus export comes from the optional prometheus_client package, without it metrics are only stored in SQLite
+try:
+    from prometheus_client import CollectorRegistry, Gauge, write_to_textfile
+except ImportError:
+    CollectorRegistry = None
+
+prometheusAvailable = CollectorRegistry is not None
+
+#Path of the Prometheus textfile the last run's metrics are written to, for node_exporter's textfile collector
+#Set SPACETRADERS_PROMETHEUS_TEXTFILE to turn it on, None leaves it off
+prometheusTextfile = os.environ.get("SPACETRADERS_PROMETHEUS_TEXTFILE")
+
+#Values measured for each task, in the order they are stored
+metricNames = ["seconds", "apiCalls", "bytesReceived", "rows", "errors"]
+
+#Process wide API counters, a task's share is the difference between their values when it starts and ends
+_counters = {'apiCalls': 0, 'bytesReceived': 0, 'apiErrors': 0}
+_countersLock = threading.Lock()
+
+#Measurements of the tasks running now, innermost last, and the id of the current run
+_active = []
+_runId = None
+_runMetrics = {}
+
+
+def record_api_call(bytesReceived = 0, error = False):
+    """
+    Function that counts one API call, called by the API client for every response or failed request.
+
+    Parameters:
+    bytesReceived (int): Size of the response body
+    error (bool): True if the call failed or the API answered with an error status
+
+    Returns:
+    None
+    """
+    with _countersLock:
+        _counters['apiCalls'] += 1
+        _counters['bytesReceived'] += bytesReceived
+        if error:
+            _counters['apiErrors'] += 1
+
+def _snapshot():
+    """
+    Copies the API counters.
+
+    Parameters:
+    None
+
+    Returns:
+    Dict: Current value of each counter
+    """
+    with _countersLock:
+        return dict(_counters)
+
+def start_run():
+    """
+    Function that starts a new run, the tasks measured after it are stored under its id.
+
+    Parameters:
+    None
+
+    Returns:
+    str: Id of the run
+    """
+    global _runId, _runMetrics
+    _runId = uuid.uuid4().hex
+    _runMetrics = {}
+    return _runId
+
+def add_rows(count):
+    """
+    Function that adds rows written to the task being measured.
+
+    Parameters:
+    count (int): Number of rows
+
+    Returns:
+    None
+    """
+    if _active:
+        _active[-1]['rows'] += count
+
+def add_errors(count = 1):
+    """
+    Function that adds errors to the task being measured, for failures the task handles itself.
+
+    Parameters:
+    count (int): Number of errors
+
+    Returns:
+    None
+    """
+    if _active:
+        _active[-1]['errors'] += count
+
+def _store(task, startedAt, values):
+    """
+    Queues one task's metrics for the database writer and refreshes the Prometheus textfile.
+
+    Parameters:
+    task (str): Name of the task
+    startedAt (float): Start time in seconds since the epoch
+    values (Dict): Value of each of metricNames
+
+    Returns:
+    None
+    """
+    runId = _runId or start_run()
+    row = [runId, task, startedAt] + [values[m] for m in metricNames]
+    db_writer.get_writer().submit(lambda conn: conn.execute("INSERT OR REPLACE INTO Task_Metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row))
+    _runMetrics[task] = values
+    if prometheusTextfile:
+        write_prometheus(prometheusTextfile)
+
+def instrumented(fn):
+    """
+    Decorator that measures every call of a task: wall time, API calls, bytes received, rows written and errors.
+    API calls, bytes and API errors are counted by the API client, rows and handled errors come from add_rows and add_errors.
+    A task that raises counts one more error and is still stored.
+
+    Parameters:
+    fn (Callable): Task function
+
+    Returns:
+    Callable: Wrapped function
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        measurement = {'rows': 0, 'errors': 0}
+        _active.append(measurement)
+        before = _snapshot()
+        startedAt = time.time()
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            measurement['errors'] += 1
+            raise
+        finally:
+            _active.remove(measurement)
+            after = _snapshot()
+            values = {
+                'seconds': time.perf_counter() - started
+                ,'apiCalls': after['apiCalls'] - before['apiCalls']
+                ,'bytesReceived': after['bytesReceived'] - before['bytesReceived']
+                ,'rows': measurement['rows']
+                ,'errors': measurement['errors'] + after['apiErrors'] - before['apiErrors']
+            }
+            _store(fn.__name__, startedAt, values)
+    return wrapper
+
+def write_prometheus(path):
+    """
+    Function that writes the current run's task metrics to a Prometheus textfile, one gauge per metric labelled by task.
+
+    Parameters:
+    path (str): Path of the textfile
+
+    Returns:
+    bool: True if the file was written, False if prometheus_client is not installed
+    """
+    if not prometheusAvailable:
+        return False
+    registry = CollectorRegistry()
+    gauges = {m: Gauge(f"spacetraders_task_{m}", f"{m} of the last marketFlow run, by task", ["task"], registry = registry) for m in metricNames}
+    for task, values in _runMetrics.items():
+        for m in metricNames:
+            gauges[m].labels(task = task).set(values[m])
+    write_to_textfile(path, registry)
+    return True
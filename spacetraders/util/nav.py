@@ -5,11 +5,14 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 import pydeck as pdk
-import requests
 import streamlit as st
 
+import util.api_client as api
 import util.ships as ships
+import util.spatial as spatial
 import util.sqlite_functions as sqf
+import util.universe as universe
+import util.waypoints as waypoints
 
 # Waypoint types for Graphing
 waypoint_types = ["PLANET", "GAS_GIANT", "MOON", "ORBITAL_STATION", "JUMP_GATE", "ASTEROID_FIELD", "ASTEROID", "ENGINEERED_ASTEROID", "ASTEROID_BASE", "NEBULA", "DEBRIS_FIELD", "GRAVITY_WELL", "ARTIFICIAL_GRAVITY_WELL", "FUEL_STATION"]
@@ -79,6 +82,7 @@ def chart_system(df):
 def search_system(token, system, traits=None):
     """
     Function that searches for a system for either all waypoints or waypoints with specific traits.
+    Answered from the indexed per system waypoint store, see util.waypoints.
     
     Parameters:
     token (str): Token for the agent
@@ -88,67 +92,82 @@ def search_system(token, system, traits=None):
     Returns:
     List of Dicts: List of dicts containing waypoint information
     """
+    systemWaypoints = get_system_waypoints(token, system)
     if traits == None:
-        url = "https://api.spacetraders.io/v2/systems/" + system + "/waypoints"
-    else:
-         url = "https://api.spacetraders.io/v2/systems/" + system + "/waypoints?traits=" + traits
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get(url, headers = headers)
-    if response.status_code == 200:
-        return response.json()['data']
-    else:
-            print(f"Error: {response.status_code} - {response.text}")
-            return False
+        return systemWaypoints.all()
+    return systemWaypoints.with_trait(traits)
+
+def get_system_waypoints(token, systemSymbol):
+    """
+    Function that gets every waypoint of a system, indexed by trait, type and faction.
+    All pages are fetched once and then queries such as markets, shipyards or fuel stations are answered locally.
+    
+    Parameters:
+    token (str): Token for the agent
+    systemSymbol (str): Symbol for the system
+    
+    Returns:
+    waypoints.SystemWaypoints: Waypoints of the system
+    """
+    return waypoints.get_system(token, systemSymbol)
 
-@st.cache_data
-def get_all_waypoints(token):
+@st.cache_data(ttl = 600)
+def get_all_waypoints(token, asDataFrame = False, concurrent = True, maxWorkers = api.defaultPageWorkers, useStore = True):
     """
-    Function that gets all waypoints. Data is cached by streamlit.
+    Function that gets all waypoints. Data is cached by streamlit for 10 minutes so background refreshes of the store show up.
+    By default the universe is served from the persistent store in SQLite, see util.universe.
+    When fetching from the API, the first page is read for meta.total and the remaining pages are fetched concurrently.
     
     Parameters:
     token (str): Token for the agent
+    asDataFrame (bool): Return a DataFrame instead of a list of dicts
+    concurrent (bool): Fetch pages concurrently, False walks the pages one at a time
+    maxWorkers (int): Maximum number of pages fetched at the same time
+    useStore (bool): Serve from the persistent store, False always fetches from the API
     
     Returns:
-    List of Dicts: List of dicts containing waypoint information"""
-    page = 1
-    all_waypoints = []
-    while True:
-        url = f"https://api.spacetraders.io/v2/systems?limit=20&page={page}"
-        headers = {'Authorization': f'Bearer {token}'}
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            data = response.json()['data']
-            if not data:
+    List of Dicts or pd.DataFrame: Waypoint information, in page order"""
+    if useStore:
+        df = universe.get_systems(token)
+        if asDataFrame:
+            return df
+        return df.to_dict('records')
+    if concurrent:
+        all_waypoints = api.fetch_all_pages(token, "/systems", maxWorkers = maxWorkers)
+    else:
+        page = 1
+        all_waypoints = []
+        while True:
+            data = api.fetch_page(token, "/systems", page)
+            if not data or not data['data']:
                 break
-            all_waypoints.extend(data)
+            all_waypoints.extend(data['data'])
             page += 1
-        else:
-            print(f"Error: {response.status_code} - {response.text}")
-            break
+    if asDataFrame:
+        return pd.DataFrame(all_waypoints)
     return all_waypoints
 
-def get_waypoint(token, systemSymbol, waypointSymbol):
+def get_waypoint(token, systemSymbol, waypointSymbol, fields = None):
     """ 
-    Function that gets a waypoint.
+    Function that gets a waypoint. Served from the waypoint cache while the needed fields are inside their TTL,
+    concurrent lookups of the same waypoint share one API call, see util.waypoints.
     
     Parameters:
     token (str): Token for the agent
     systemSymbol (str): Symbol for the system
     waypointSymbol (str): Symbol for the waypoint
+    fields (List of str): Fields the caller needs, None needs every field to be fresh
     
     Returns:
-    Dict: Dictionary containing waypoint information"""
-    url = f"https://api.spacetraders.io/v2/systems/{systemSymbol}/waypoints/{waypointSymbol}"
-    headers = {'Authorization': f'Bearer {token}'}
-    response = requests.get(url, headers = headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-            print(f"Error: {response.status_code} - {response.text}")
+    Dict: Dictionary containing waypoint information under 'data', None if the waypoint could not be loaded"""
+    data = waypoints.get_waypoint(token, systemSymbol, waypointSymbol, fields)
+    if data is None:
+        return None
+    return {'data': data}
 
 def get_waypoints(token, system_symbol):
     """
-    Function that gets all waypoints for a system.
+    Function that gets all waypoints for a system, from every page.
     
     Parameters:
     token (str): Token for the agent
@@ -157,17 +176,7 @@ def get_waypoints(token, system_symbol):
     Returns:
     List of Dicts: List of dicts containing waypoint information
     """
-    url = f"https://api.spacetraders.io/v2/systems/{system_symbol}/waypoints"
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Accept': 'application/json'
-    }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()['data']
-    else:
-        print(f"Error fetching waypoints: {response.status_code} - {response.text}")
-        return []
+    return get_system_waypoints(token, system_symbol).all()
 
 def navigate_to_waypoint(token, ship_symbol, waypoint_symbol):
     """
@@ -180,15 +189,10 @@ def navigate_to_waypoint(token, ship_symbol, waypoint_symbol):
     Returns:
     Dict: Dictionary containing waypoint information
     """
-    url = f"https://api.spacetraders.io/v2/ships/{ship_symbol}/navigate"
-    headers = {
-        'Authorization': f'Bearer {token}',
-        'Content-Type': 'application/json'
-    }
     payload = {
         'waypointSymbol': waypoint_symbol
     }
-    response = requests.post(url, headers=headers, json=payload)
+    response = api.get_client(token).post(f"/my/ships/{ship_symbol}/navigate", json=payload)
     if response.status_code == 200:
         return response.json()
     else:
@@ -198,33 +202,15 @@ def navigate_to_waypoint(token, ship_symbol, waypoint_symbol):
 def refresh_systems(token):
     """
     Function that refreshes the systems table in the SQLite database.
+    Bulk loads every page into staging tables and swaps them in atomically, see util.universe.refresh_systems.
     
     Parameters:
     token (str): Token for the agent
     
     Returns:
-    None
+    pd.DataFrame: DataFrame containing system information
     """
-    conn = sqf.create_connection()
-    cursor = conn.cursor()
-    query = "DELETE FROM Systems"
-    print(query)
-    cursor.execute(query)
-    sqf.close_connection(conn)
-
-    url = "https://api.spacetraders.io/v2/systems"
-    headers = {'Accept': "application/json"}
-    data = []
-    for i in range(1,20):
-        response = (requests.get(url, headers).json()['data'])
-        for j in response:
-             data.append(j)
-
-    df = pd.DataFrame(data)
-    df = df.drop(columns = ['waypoints', 'factions'])
-    df['waypoints'] = ''
-    df['factions'] = ''
-    sqf.insert_data("Systems", df)
+    return universe.refresh_systems(token)
 
 def animated_system_plot(token, systemSymbol):
      """
@@ -338,23 +324,24 @@ def animated_system_plot(token, systemSymbol):
         # Display the figure
         st.plotly_chart(fig, use_container_width=True)
 
-def get_closest_systems(waypointsDf, ship, numSystems = None):
+def get_closest_systems(waypointsDf, ship, numSystems = None, radius = None):
     """
-    Function that gets the closest systems to a ship.
+    Function that gets the closest systems to a ship, using the spatial index built once per universe load.
     
     Parameters:
-    waypointsDf (pd.DataFrame): DataFrame containing waypoint information
+    waypointsDf (pd.DataFrame): DataFrame containing system information, only indexed on the spot if it is not the stored universe
     ship (Ship): Ship object
     numSystems (int): Number of systems to return
+    radius (float): Return every system within this distance instead of the closest numSystems
     
     Returns:
-    pd.DataFrame: DataFrame containing closest systems
+    pd.DataFrame: DataFrame containing closest systems with a Distance column, sorted by Distance
     """
     if numSystems == None:
         numSystems = 5
-    shipX = ship.nav['route']['origin']['x']
-    shipY = ship.nav['route']['origin']['y']
-    waypointsDf['Distance'] = np.sqrt((waypointsDf['x'] - shipX)**2 + (waypointsDf['y'] - shipY)**2)
-    waypointsDf = waypointsDf.sort_values(by = 'Distance')
-    return waypointsDf.head(numSystems)
-
+    index = universe.get_system_index()
+    if waypointsDf is not None and len(waypointsDf) != len(index):
+        index = spatial.SystemIndex(pd.DataFrame(waypointsDf))
+    if radius is not None:
+        return index.within_of_ship(ship, radius)
+    return index.nearest_to_ship(ship, numSystems)
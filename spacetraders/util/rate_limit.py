@@ -0,0 +1,226 @@
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime, timezone
+
+#Request priorities, lower values are served first
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+#Default SpaceTraders limits, 2 requests per second plus a burst pool of 30 requests every 60 seconds
+defaultRatePerSecond = 2.0
+defaultBurst = 30
+defaultBurstWindow = 60.0
+
+
+class TokenBucket():
+    """
+    Class that represents a token bucket.
+
+    Attributes:
+    capacity (float): Maximum number of tokens the bucket holds
+    rate (float): Tokens added per second
+    tokens (float): Tokens currently available
+    updated (float): Monotonic time the bucket was last refilled
+    """
+    def __init__(self, capacity, rate):
+        """
+        Initializes a TokenBucket object, starting full.
+
+        Parameters:
+        capacity (float): Maximum number of tokens the bucket holds
+        rate (float): Tokens added per second
+
+        Returns:
+        None
+        """
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        """
+        Adds the tokens earned since the last refill.
+
+        Parameters:
+        now (float): Current monotonic time
+
+        Returns:
+        None
+        """
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until_token(self):
+        """
+        Gets the number of seconds until one token is available.
+
+        Parameters:
+        None
+
+        Returns:
+        float: Seconds until a token is available, 0 if one is available now
+        """
+        if self.tokens >= 1:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (1 - self.tokens) / self.rate
+
+
+class RequestScheduler():
+    """
+    Class that queues requests for one token and releases them within the API rate limit.
+    Requests are served by priority, then in arrival order. A request first spends a token from the
+    per second bucket and falls back to the burst bucket.
+
+    Attributes:
+    static (TokenBucket): Per second bucket
+    burst (TokenBucket): Burst bucket
+    blockedUntil (float): Monotonic time before which no request is released, set by 429 responses
+    """
+    def __init__(self, ratePerSecond = defaultRatePerSecond, burst = defaultBurst, burstWindow = defaultBurstWindow):
+        """
+        Initializes a RequestScheduler object.
+
+        Parameters:
+        ratePerSecond (float): Sustained requests per second
+        burst (int): Size of the burst pool
+        burstWindow (float): Seconds for the burst pool to refill
+
+        Returns:
+        None
+        """
+        self.static = TokenBucket(ratePerSecond, ratePerSecond)
+        self.burst = TokenBucket(burst, burst / burstWindow)
+        self.blockedUntil = 0.0
+        self._queue = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, priority = PRIORITY_USER):
+        """
+        Blocks until the caller may send one request.
+
+        Parameters:
+        priority (int): Priority of the request, PRIORITY_USER or PRIORITY_BACKGROUND
+
+        Returns:
+        float: Seconds spent waiting in the queue
+        """
+        start = time.monotonic()
+        ticket = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._queue, ticket)
+            while True:
+                now = time.monotonic()
+                self.static.refill(now)
+                self.burst.refill(now)
+                if self._queue[0] == ticket:
+                    wait = self.blockedUntil - now
+                    if wait <= 0:
+                        if self.static.tokens >= 1:
+                            self.static.tokens -= 1
+                            break
+                        if self.burst.tokens >= 1:
+                            self.burst.tokens -= 1
+                            break
+                        wait = min(self.static.time_until_token(), self.burst.time_until_token())
+                    self._condition.wait(timeout = wait)
+                else:
+                    self._condition.wait()
+            heapq.heappop(self._queue)
+            self._condition.notify_all()
+        return time.monotonic() - start
+
+    def block_for(self, seconds):
+        """
+        Holds back every queued request for a number of seconds, used when the API answers 429.
+
+        Parameters:
+        seconds (float): Seconds to wait before sending the next request
+
+        Returns:
+        None
+        """
+        with self._condition:
+            self.blockedUntil = max(self.blockedUntil, time.monotonic() + seconds)
+            self.static.tokens = 0
+            self.burst.tokens = 0
+            self._condition.notify_all()
+
+    def update_from_headers(self, headers):
+        """
+        Syncs the buckets with the rate limit headers returned by the API.
+
+        Parameters:
+        headers (Mapping): Response headers
+
+        Returns:
+        None
+        """
+        perSecond = _to_float(headers.get("x-ratelimit-limit-per-second"))
+        burst = _to_float(headers.get("x-ratelimit-limit-burst"))
+        burstWindow = _to_float(headers.get("x-ratelimit-burst-time"))
+        remaining = _to_float(headers.get("x-ratelimit-remaining"))
+        with self._condition:
+            if perSecond:
+                self.static.capacity = perSecond
+                self.static.rate = perSecond
+            if burst:
+                self.burst.capacity = burst
+                if burstWindow:
+                    self.burst.rate = burst / burstWindow
+            #The server's count is authoritative when it is lower than ours
+            if remaining is not None:
+                self.burst.tokens = min(self.burst.tokens, remaining)
+
+def retry_after_seconds(response, default = 1.0):
+    """
+    Function that gets how long to wait after a 429 response.
+    Checks the Retry-After header, then the retryAfter field SpaceTraders puts in the error body,
+    then the x-ratelimit-reset header.
+
+    Parameters:
+    response (httpx.Response): 429 response from the API
+    default (float): Seconds to wait when the response does not say
+
+    Returns:
+    float: Seconds to wait
+    """
+    retryAfter = _to_float(response.headers.get("retry-after"))
+    if retryAfter is not None:
+        return retryAfter
+    try:
+        retryAfter = _to_float(response.json()["error"]["data"]["retryAfter"])
+    except Exception:
+        retryAfter = None
+    if retryAfter is not None:
+        return retryAfter
+    reset = response.headers.get("x-ratelimit-reset")
+    if reset:
+        try:
+            resetTime = datetime.fromisoformat(reset.replace("Z", "+00:00"))
+            return max(0.0, (resetTime - datetime.now(timezone.utc)).total_seconds())
+        except ValueError:
+            pass
+    return default
+
+def _to_float(value):
+    """
+    Function that converts a header value to a float.
+
+    Parameters:
+    value (str): Header value
+
+    Returns:
+    float: Converted value, None if missing or not a number
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
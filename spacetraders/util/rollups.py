@@ -0,0 +1,196 @@
+from datetime import datetime, timedelta, timezone
+
+import util.sqlite_functions as sqf
+
+#Bucket sizes the rollups are kept at: (timestamp characters kept, suffix that completes the bucket start, bucket length)
+#Timestamps are ISO strings from the API, so a bucket start is the timestamp cut down to its minute, hour or day
+resolutions = {
+    "1m": (16, ":00.000Z", timedelta(minutes = 1))
+    ,"1h": (13, ":00:00.000Z", timedelta(hours = 1))
+    ,"1d": (10, "T00:00:00.000Z", timedelta(days = 1))
+}
+
+#Most buckets the chart asks for, the finest resolution that stays under it is used
+maxChartPoints = 500
+
+rollupColumns = ["tradeSymbol", "waypointSymbol", "bucket", "open", "high", "low", "close", "volume", "trades", "avgPrice", "openTime", "closeTime"]
+
+
+def table_name(resolution):
+    """
+    Function that gets the rollup table for a resolution.
+
+    Parameters:
+    resolution (str): One of resolutions
+
+    Returns:
+    str: Name of the table
+    """
+    if resolution not in resolutions:
+        raise ValueError(f"Unknown resolution {resolution}")
+    return "Market_Ohlc_" + resolution
+
+def bucket_of(timestamp, resolution):
+    """
+    Function that gets the start of the bucket a timestamp falls in.
+
+    Parameters:
+    timestamp (str): ISO timestamp
+    resolution (str): One of resolutions
+
+    Returns:
+    str: ISO timestamp of the bucket start
+    """
+    length, suffix, _ = resolutions[resolution]
+    return timestamp[:length] + suffix
+
+def _bucket_sql(resolution):
+    """
+    Builds the SQL expression that turns a transaction's timestamp into its bucket start.
+
+    Parameters:
+    resolution (str): One of resolutions
+
+    Returns:
+    str: SQL expression
+    """
+    length, suffix, _ = resolutions[resolution]
+    return f"substr(t.timestamp, 1, {length}) || '{suffix}'"
+
+def _rollup_sql(resolution, join = ""):
+    """
+    Builds the statement that recomputes rollup rows from Market_Transactions.
+    Open and close are the prices of the first and last transaction in the bucket, ties broken by rowid.
+
+    Parameters:
+    resolution (str): One of resolutions
+    join (str): Extra JOIN clause limiting which transactions are read
+
+    Returns:
+    str: INSERT OR REPLACE statement
+    """
+    bucket = _bucket_sql(resolution)
+    window = f"PARTITION BY t.tradeSymbol, t.waypointSymbol, {bucket}"
+    return f"""INSERT OR REPLACE INTO {table_name(resolution)} ({", ".join(rollupColumns)})
+    SELECT tradeSymbol, waypointSymbol, bucket
+        ,MAX(CASE WHEN firstRank = 1 THEN pricePerUnit END), MAX(pricePerUnit), MIN(pricePerUnit), MAX(CASE WHEN lastRank = 1 THEN pricePerUnit END)
+        ,SUM(units), COUNT(*), AVG(pricePerUnit), MIN(timestamp), MAX(timestamp)
+    FROM (
+        SELECT t.tradeSymbol, t.waypointSymbol, t.pricePerUnit, t.units, t.timestamp, {bucket} AS bucket
+            ,ROW_NUMBER() OVER ({window} ORDER BY t.timestamp, t.rowid) AS firstRank
+            ,ROW_NUMBER() OVER ({window} ORDER BY t.timestamp DESC, t.rowid DESC) AS lastRank
+        FROM Market_Transactions t {join}
+    )
+    GROUP BY tradeSymbol, waypointSymbol, bucket"""
+
+def rebuild_rollups(cursor):
+    """
+    Function that recomputes every rollup row from every stored transaction.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database, inside a transaction
+
+    Returns:
+    None
+    """
+    for resolution in resolutions:
+        cursor.execute("DELETE FROM " + table_name(resolution))
+        cursor.execute(_rollup_sql(resolution))
+
+def update_rollups(transactionsDf):
+    """
+    Function that recomputes the rollup buckets a batch of transactions falls in, at every resolution.
+    Only the touched buckets are read back from Market_Transactions, so the cost follows the batch and not the table.
+    Recomputing from the stored rows makes it safe to call with transactions that were already stored.
+
+    Parameters:
+    transactionsDf (pd.DataFrame): Transactions just ingested, with tradeSymbol, waypointSymbol and timestamp
+
+    Returns:
+    int: Number of buckets recomputed
+    """
+    if len(transactionsDf) == 0:
+        return 0
+    keys = transactionsDf[['tradeSymbol', 'waypointSymbol', 'timestamp']].drop_duplicates()
+    conn = sqf.create_connection()
+    touched = 0
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS Rollup_Touched (tradeSymbol TEXT, waypointSymbol TEXT, bucket TEXT, bucketEnd TEXT, PRIMARY KEY (tradeSymbol, waypointSymbol, bucket))")
+        for resolution, (_, _, length) in resolutions.items():
+            buckets = {(r[0], r[1], bucket_of(r[2], resolution)) for r in keys.itertuples(index = False, name = None)}
+            rows = []
+            for tradeSymbol, waypointSymbol, bucket in buckets:
+                bucketEnd = datetime.strptime(bucket, '%Y-%m-%dT%H:%M:%S.%fZ') + length
+                rows.append((tradeSymbol, waypointSymbol, bucket, bucketEnd.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'))
+            conn.execute("DELETE FROM Rollup_Touched")
+            conn.executemany("INSERT INTO Rollup_Touched VALUES (?, ?, ?, ?)", rows)
+            #The range join lets the (tradeSymbol, timestamp) index find each bucket's transactions
+            conn.execute(_rollup_sql(resolution, "JOIN Rollup_Touched r ON t.tradeSymbol = r.tradeSymbol AND t.waypointSymbol = r.waypointSymbol AND t.timestamp >= r.bucket AND t.timestamp < r.bucketEnd"))
+            touched += len(rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        sqf.close_connection(conn)
+    return touched
+
+def pick_resolution(windowSeconds):
+    """
+    Function that picks the finest resolution that draws a time window in at most maxChartPoints buckets.
+
+    Parameters:
+    windowSeconds (float): Length of the time window, None for all of history
+
+    Returns:
+    str: One of resolutions
+    """
+    if windowSeconds is None:
+        return "1d"
+    for resolution, (_, _, length) in resolutions.items():
+        if windowSeconds / length.total_seconds() <= maxChartPoints:
+            return resolution
+    return "1d"
+
+def get_ohlc(tradeSymbol, resolution, start = None, end = None, waypointSymbol = None):
+    """
+    Function that gets price candles for a trade good.
+    Without a waypoint, the candles of every waypoint in a bucket are combined into one.
+
+    Parameters:
+    tradeSymbol (str): Symbol for the trade good
+    resolution (str): One of resolutions
+    start (str): Only buckets starting at or after this ISO timestamp
+    end (str): Only buckets starting before this ISO timestamp
+    waypointSymbol (str): Only candles from this waypoint
+
+    Returns:
+    pd.DataFrame: bucket, open, high, low, close, volume, trades and avgPrice, sorted by bucket
+    """
+    filters = {'tradeSymbol': tradeSymbol, 'waypointSymbol': waypointSymbol}
+    df = sqf.select_values(table_name(resolution), None, filters, 'bucket', start, end, 'bucket')
+    if waypointSymbol is not None or len(df) == 0:
+        return df.drop(columns = ['tradeSymbol', 'waypointSymbol', 'openTime', 'closeTime'])
+    df['priceSum'] = df['avgPrice'] * df['trades']
+    grouped = df.groupby('bucket', sort = True)
+    candles = grouped.agg(high = ('high', 'max'), low = ('low', 'min'), volume = ('volume', 'sum'), trades = ('trades', 'sum'), priceSum = ('priceSum', 'sum'))
+    candles['open'] = df.loc[grouped['openTime'].idxmin(), ['bucket', 'open']].set_index('bucket')['open']
+    candles['close'] = df.loc[grouped['closeTime'].idxmax(), ['bucket', 'close']].set_index('bucket')['close']
+    candles['avgPrice'] = candles['priceSum'] / candles['trades']
+    return candles.reset_index()[['bucket', 'open', 'high', 'low', 'close', 'volume', 'trades', 'avgPrice']]
+
+def window_start(windowSeconds):
+    """
+    Function that gets the ISO timestamp a time window ending now starts at.
+
+    Parameters:
+    windowSeconds (float): Length of the time window, None for all of history
+
+    Returns:
+    str: ISO timestamp, None for all of history
+    """
+    if windowSeconds is None:
+        return None
+    start = datetime.now(timezone.utc) - timedelta(seconds = windowSeconds)
+    return start.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
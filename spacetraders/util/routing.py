@@ -0,0 +1,247 @@
+import heapq
+
+import numpy as np
+
+#Flight mode multipliers used by the API to turn distance into travel time
+modeTimeMultipliers = {"BURN": 12.5, "CRUISE": 25, "STEALTH": 30, "DRIFT": 250}
+
+#Fixed seconds added to every flight
+flightTimeOverhead = 15
+
+#Flight modes the planner may use, in the order they are tried for each hop
+defaultModes = ("CRUISE", "DRIFT")
+
+
+def distance_matrix(xs, ys):
+    """
+    Function that computes the distance between every pair of points.
+
+    Parameters:
+    xs (np.ndarray): x coordinates
+    ys (np.ndarray): y coordinates
+
+    Returns:
+    np.ndarray: Square matrix of distances
+    """
+    xs = np.asarray(xs, dtype = float)
+    ys = np.asarray(ys, dtype = float)
+    return np.hypot(xs[:, None] - xs[None, :], ys[:, None] - ys[None, :])
+
+def fuel_cost(distance, mode = "CRUISE"):
+    """
+    Function that computes the fuel a flight burns, works on scalars and arrays.
+
+    Parameters:
+    distance (float or np.ndarray): Distance of the flight
+    mode (str): Flight mode
+
+    Returns:
+    int or np.ndarray: Fuel units
+    """
+    distance = np.asarray(distance, dtype = float)
+    base = np.maximum(1, np.round(distance))
+    if mode == "DRIFT":
+        fuel = np.ones_like(base)
+    elif mode == "BURN":
+        fuel = 2 * base
+    else:
+        fuel = base
+    #Flights between a waypoint and its orbitals do not burn fuel
+    fuel = np.where(distance == 0, 0, fuel).astype(int)
+    return fuel if fuel.ndim else int(fuel)
+
+def travel_time(distance, speed, mode = "CRUISE"):
+    """
+    Function that computes how long a flight takes, works on scalars and arrays.
+
+    Parameters:
+    distance (float or np.ndarray): Distance of the flight
+    speed (int): Engine speed of the ship
+    mode (str): Flight mode
+
+    Returns:
+    int or np.ndarray: Seconds
+    """
+    distance = np.asarray(distance, dtype = float)
+    seconds = np.round(np.round(np.maximum(1, distance)) * (modeTimeMultipliers[mode] / speed) + flightTimeOverhead).astype(int)
+    return seconds if seconds.ndim else int(seconds)
+
+
+class SystemRouter():
+    """
+    Class that plans fuel aware routes between the waypoints of one system.
+    Distances between every pair of waypoints are computed once. Because a ship refuels to full at a refuel stop
+    and a direct flight never burns more fuel than a detour, the only stops worth making are refuel stops,
+    so the search runs over the start, the destination and the refuel stops.
+
+    Attributes:
+    systemSymbol (str): Symbol for the system
+    symbols (List of str): Waypoint symbols, in matrix order
+    positions (Dict): Maps waypoint symbol to its row in the matrix
+    distances (np.ndarray): Distance between every pair of waypoints
+    refuelSymbols (Set of str): Waypoints where the ship can refuel
+    """
+    def __init__(self, systemSymbol, waypointList, refuelSymbols = None):
+        """
+        Initializes a SystemRouter object.
+
+        Parameters:
+        systemSymbol (str): Symbol for the system
+        waypointList (List of Dicts): Waypoints of the system with symbol, x and y
+        refuelSymbols (Iterable of str): Waypoints where the ship can refuel, defaults to every MARKETPLACE waypoint
+
+        Returns:
+        None
+        """
+        self.systemSymbol = systemSymbol
+        self.symbols = [w["symbol"] for w in waypointList]
+        self.positions = {s: i for i, s in enumerate(self.symbols)}
+        self.distances = distance_matrix([w["x"] for w in waypointList], [w["y"] for w in waypointList])
+        if refuelSymbols is None:
+            refuelSymbols = [w["symbol"] for w in waypointList if any(t["symbol"] == "MARKETPLACE" for t in w.get("traits", []))]
+        self.refuelSymbols = set(refuelSymbols)
+
+    def _best_hops(self, distances, fuelAvailable, speed, modes):
+        """
+        Picks the fastest flight mode the ship can afford for a set of hops from one node.
+
+        Parameters:
+        distances (np.ndarray): Distance of each hop
+        fuelAvailable (int): Fuel in the tank at the start of the hops, None if the ship does not use fuel
+        speed (int): Engine speed of the ship
+        modes (Iterable of str): Flight modes the planner may use
+
+        Returns:
+        Tuple of np.ndarray: Index into modes, fuel and seconds for each hop, seconds is inf where no mode is affordable
+        """
+        bestMode = np.full(len(distances), -1)
+        bestFuel = np.zeros(len(distances), dtype = int)
+        bestTime = np.full(len(distances), np.inf)
+        for m, mode in enumerate(modes):
+            fuel = fuel_cost(distances, mode) if fuelAvailable is not None else np.zeros(len(distances), dtype = int)
+            seconds = travel_time(distances, speed, mode).astype(float)
+            if fuelAvailable is not None:
+                seconds[fuel > fuelAvailable] = np.inf
+            better = seconds < bestTime
+            bestMode[better] = m
+            bestFuel[better] = fuel[better]
+            bestTime[better] = seconds[better]
+        return bestMode, bestFuel, bestTime
+
+    def plan(self, origin, destination, fuelCurrent, fuelCapacity, speed, modes = defaultModes):
+        """
+        Plans the fastest route from origin to destination that never runs the tank dry.
+
+        Parameters:
+        origin (str): Symbol of the starting waypoint
+        destination (str): Symbol of the destination waypoint
+        fuelCurrent (int): Fuel in the tank now
+        fuelCapacity (int): Size of the tank, 0 for ships that do not use fuel
+        speed (int): Engine speed of the ship
+        modes (Sequence of str): Flight modes the planner may use
+
+        Returns:
+        Dict: path (List of str), legs (List of Dicts), fuel (int) and time (int seconds), None if the destination cannot be reached
+        """
+        if origin not in self.positions or destination not in self.positions:
+            return None
+        if origin == destination:
+            return {"path": [origin], "legs": [], "fuel": 0, "time": 0}
+        usesFuel = fuelCapacity > 0
+        #Nodes worth stopping at: the origin, refuel stops and the destination
+        nodes = [origin] + [s for s in self.refuelSymbols if s not in (origin, destination)] + [destination]
+        #Fuel in the tank when leaving a node, a refuel stop fills the tank
+        startFuel = fuelCapacity if origin in self.refuelSymbols else fuelCurrent
+
+        nodePositions = np.array([self.positions[n] for n in nodes])
+        best = {origin: 0}
+        previous = {}
+        queue = [(0, origin)]
+        while queue:
+            seconds, node = heapq.heappop(queue)
+            if node == destination:
+                break
+            if seconds > best.get(node, float("inf")):
+                continue
+            fuelAvailable = (startFuel if node == origin else fuelCapacity) if usesFuel else None
+            hopDistances = self.distances[self.positions[node], nodePositions]
+            hopModes, hopFuel, hopTimes = self._best_hops(hopDistances, fuelAvailable, speed, modes)
+            #Skip the origin and the node itself, neither is worth flying to
+            for i in range(1, len(nodes)):
+                nextNode = nodes[i]
+                if nextNode == node or hopTimes[i] == np.inf:
+                    continue
+                arrival = seconds + int(hopTimes[i])
+                if arrival < best.get(nextNode, float("inf")):
+                    best[nextNode] = arrival
+                    previous[nextNode] = (node, (modes[hopModes[i]], int(hopFuel[i]), int(hopTimes[i])))
+                    heapq.heappush(queue, (arrival, nextNode))
+        if destination not in previous:
+            return None
+
+        legs = []
+        node = destination
+        while node != origin:
+            fromNode, (mode, fuel, seconds) = previous[node]
+            legs.append({
+                "from": fromNode
+                ,"to": node
+                ,"mode": mode
+                ,"distance": float(self.distances[self.positions[fromNode], self.positions[node]])
+                ,"fuel": fuel
+                ,"time": seconds
+                ,"refuelBefore": usesFuel and fromNode in self.refuelSymbols
+            })
+            node = fromNode
+        legs.reverse()
+        return {
+            "path": [origin] + [l["to"] for l in legs]
+            ,"legs": legs
+            ,"fuel": sum(l["fuel"] for l in legs)
+            ,"time": sum(l["time"] for l in legs)
+        }
+
+#Routers by system, rebuilt when the system's waypoints are refetched
+_routers = {}
+
+def get_router(systemWaypoints):
+    """
+    Function that gets the router for a system, building its distance matrix only once per fetch of the system.
+
+    Parameters:
+    systemWaypoints (waypoints.SystemWaypoints): Waypoints of the system
+
+    Returns:
+    SystemRouter: Router for the system
+    """
+    key = (systemWaypoints.systemSymbol, systemWaypoints.fetchedAt)
+    router = _routers.get(key)
+    if router is None:
+        router = SystemRouter(systemWaypoints.systemSymbol, systemWaypoints.all(), [w["symbol"] for w in systemWaypoints.markets()])
+        #Drop the router built from an older fetch of the same system
+        for oldKey in [k for k in _routers if k[0] == systemWaypoints.systemSymbol]:
+            del _routers[oldKey]
+        _routers[key] = router
+    return router
+
+def plan_ship_route(systemWaypoints, ship, destination, modes = defaultModes):
+    """
+    Function that plans a route for a ship to a waypoint in its current system.
+
+    Parameters:
+    systemWaypoints (waypoints.SystemWaypoints): Waypoints of the ship's system
+    ship (Ship): Ship object
+    destination (str): Symbol of the destination waypoint
+    modes (Sequence of str): Flight modes the planner may use
+
+    Returns:
+    Dict: Route from SystemRouter.plan, None if the destination cannot be reached
+    """
+    return get_router(systemWaypoints).plan(
+        ship.nav['waypointSymbol']
+        ,destination
+        ,ship.fuel['current']
+        ,ship.fuel['capacity']
+        ,ship.engine['speed']
+        ,tuple(modes)
+    )
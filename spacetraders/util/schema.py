@@ -0,0 +1,380 @@
+import threading
+
+import util.sqlite_functions as sqf
+
+#Table definitions for the core tables
+agentsTableSql = """CREATE TABLE {name} (
+    accountId VARCHAR(255) NOT NULL,
+    symbol VARCHAR(255) NOT NULL PRIMARY KEY,
+    headquarters VARCHAR(255),
+    credits INT,
+    startingFaction VARCHAR(255),
+    shipCount INT,
+    token VARCHAR(255) NOT NULL
+)"""
+
+systemsTableSql = "CREATE TABLE {name} (symbol TEXT PRIMARY KEY, sectorSymbol TEXT, type TEXT, x INTEGER, y INTEGER)"
+
+transactionsTableSql = """CREATE TABLE {name} (
+    waypointSymbol TEXT NOT NULL,
+    shipSymbol TEXT NOT NULL,
+    tradeSymbol TEXT NOT NULL,
+    type TEXT NOT NULL,
+    units INTEGER NOT NULL,
+    pricePerUnit INTEGER NOT NULL,
+    totalPrice INTEGER NOT NULL,
+    timestamp TEXT NOT NULL
+)"""
+
+tradeGoodsTableSql = """CREATE TABLE {name} (
+    symbol TEXT NOT NULL,
+    tradeVolume INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    supply TEXT NOT NULL,
+    purchasePrice INTEGER NOT NULL,
+    sellPrice INTEGER NOT NULL,
+    waypointSymbol TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    activity TEXT
+)"""
+
+#Columns that identify one market transaction, the API returns the same recent transactions on every poll
+transactionKeyColumns = ["waypointSymbol", "shipSymbol", "tradeSymbol", "type", "timestamp"]
+
+#The statements below are frozen copies of what each migration ran when it was written
+#A migration must do the same thing on every database, so they are never changed, a later schema change is a new migration
+
+#Migration 3, one OHLC table per resolution and the statement that fills it from Market_Transactions
+ohlcTableSql = """CREATE TABLE IF NOT EXISTS {name} (
+    tradeSymbol TEXT NOT NULL,
+    waypointSymbol TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    open INTEGER NOT NULL,
+    high INTEGER NOT NULL,
+    low INTEGER NOT NULL,
+    close INTEGER NOT NULL,
+    volume INTEGER NOT NULL,
+    trades INTEGER NOT NULL,
+    avgPrice REAL NOT NULL,
+    openTime TEXT NOT NULL,
+    closeTime TEXT NOT NULL,
+    PRIMARY KEY (tradeSymbol, waypointSymbol, bucket)
+)"""
+
+#Table and bucket start expression for each resolution
+ohlcTables = [
+    ("Market_Ohlc_1m", "substr(t.timestamp, 1, 16) || ':00.000Z'")
+    ,("Market_Ohlc_1h", "substr(t.timestamp, 1, 13) || ':00:00.000Z'")
+    ,("Market_Ohlc_1d", "substr(t.timestamp, 1, 10) || 'T00:00:00.000Z'")
+]
+
+ohlcFillSql = """INSERT OR REPLACE INTO {name} (tradeSymbol, waypointSymbol, bucket, open, high, low, close, volume, trades, avgPrice, openTime, closeTime)
+    SELECT tradeSymbol, waypointSymbol, bucket
+        ,MAX(CASE WHEN firstRank = 1 THEN pricePerUnit END), MAX(pricePerUnit), MIN(pricePerUnit), MAX(CASE WHEN lastRank = 1 THEN pricePerUnit END)
+        ,SUM(units), COUNT(*), AVG(pricePerUnit), MIN(timestamp), MAX(timestamp)
+    FROM (
+        SELECT t.tradeSymbol, t.waypointSymbol, t.pricePerUnit, t.units, t.timestamp, {bucket} AS bucket
+            ,ROW_NUMBER() OVER (PARTITION BY t.tradeSymbol, t.waypointSymbol, {bucket} ORDER BY t.timestamp, t.rowid) AS firstRank
+            ,ROW_NUMBER() OVER (PARTITION BY t.tradeSymbol, t.waypointSymbol, {bucket} ORDER BY t.timestamp DESC, t.rowid DESC) AS lastRank
+        FROM Market_Transactions t
+    )
+    GROUP BY tradeSymbol, waypointSymbol, bucket"""
+
+#Migration 4
+registryTableSql = """CREATE TABLE IF NOT EXISTS Market_Registry (
+    waypointSymbol TEXT PRIMARY KEY,
+    systemSymbol TEXT NOT NULL,
+    firstSeen REAL NOT NULL,
+    lastSeen REAL NOT NULL,
+    lastPolled REAL,
+    polls INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    volatility REAL NOT NULL DEFAULT 0,
+    lastPrices TEXT
+)"""
+
+#Migration 5, the latest state table and the statements that compact full snapshots into changes and 6 hour keyframes
+tradeGoodsLatestTableSql = """CREATE TABLE IF NOT EXISTS Market_TradeGoods_Latest (
+    waypointSymbol TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    tradeVolume INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    supply TEXT NOT NULL,
+    purchasePrice INTEGER NOT NULL,
+    sellPrice INTEGER NOT NULL,
+    activity TEXT,
+    timestamp TEXT NOT NULL,
+    changedAt TEXT NOT NULL,
+    PRIMARY KEY (waypointSymbol, symbol)
+)"""
+
+tradeGoodsCompactSql = [
+    """INSERT OR REPLACE INTO Market_TradeGoods_Latest (symbol, tradeVolume, type, supply, purchasePrice, sellPrice, waypointSymbol, timestamp, activity, changedAt)
+    SELECT symbol, tradeVolume, type, supply, purchasePrice, sellPrice, waypointSymbol, timestamp, activity, timestamp FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY waypointSymbol, symbol ORDER BY timestamp DESC, rowid DESC) AS newest
+        FROM Market_TradeGoods
+    ) WHERE newest = 1"""
+    ,"""DELETE FROM Market_TradeGoods WHERE rowid IN (
+    SELECT id FROM (
+        SELECT rowid AS id, purchasePrice, sellPrice, supply, activity, tradeVolume
+            ,substr(timestamp, 1, 11) || printf('%02d', CAST(substr(timestamp, 12, 2) AS INTEGER) / 6 * 6) AS keyWindow
+            ,LAG(purchasePrice) OVER w AS previous_purchasePrice, LAG(sellPrice) OVER w AS previous_sellPrice, LAG(supply) OVER w AS previous_supply
+            ,LAG(activity) OVER w AS previous_activity, LAG(tradeVolume) OVER w AS previous_tradeVolume
+            ,LAG(substr(timestamp, 1, 11) || printf('%02d', CAST(substr(timestamp, 12, 2) AS INTEGER) / 6 * 6)) OVER w AS previousWindow
+        FROM Market_TradeGoods
+        WINDOW w AS (PARTITION BY waypointSymbol, symbol ORDER BY timestamp, rowid)
+    ) WHERE keyWindow = previousWindow AND purchasePrice IS previous_purchasePrice AND sellPrice IS previous_sellPrice
+        AND supply IS previous_supply AND activity IS previous_activity AND tradeVolume IS previous_tradeVolume
+)"""
+    ,"""UPDATE Market_TradeGoods SET keyframe = 1 WHERE rowid IN (
+    SELECT id FROM (
+        SELECT rowid AS id, ROW_NUMBER() OVER (
+            PARTITION BY waypointSymbol, symbol, substr(timestamp, 1, 11) || printf('%02d', CAST(substr(timestamp, 12, 2) AS INTEGER) / 6 * 6)
+            ORDER BY timestamp, rowid
+        ) AS windowRank
+        FROM Market_TradeGoods
+    ) WHERE windowRank = 1
+)"""
+    ,"DROP TABLE IF EXISTS temp.TradeGoods_Changes"
+    ,"""CREATE TEMP TABLE TradeGoods_Changes AS
+    SELECT waypointSymbol, symbol, MAX(timestamp) AS changedAt FROM (
+        SELECT waypointSymbol, symbol, timestamp, purchasePrice, sellPrice, supply, activity, tradeVolume
+            ,LAG(purchasePrice) OVER w AS previous_purchasePrice, LAG(sellPrice) OVER w AS previous_sellPrice, LAG(supply) OVER w AS previous_supply
+            ,LAG(activity) OVER w AS previous_activity, LAG(tradeVolume) OVER w AS previous_tradeVolume
+            ,ROW_NUMBER() OVER w AS position
+        FROM Market_TradeGoods
+        WINDOW w AS (PARTITION BY waypointSymbol, symbol ORDER BY timestamp, rowid)
+    ) WHERE position = 1 OR NOT (purchasePrice IS previous_purchasePrice AND sellPrice IS previous_sellPrice
+        AND supply IS previous_supply AND activity IS previous_activity AND tradeVolume IS previous_tradeVolume)
+    GROUP BY waypointSymbol, symbol"""
+    ,"""UPDATE Market_TradeGoods_Latest SET changedAt = COALESCE((
+    SELECT c.changedAt FROM TradeGoods_Changes c WHERE c.waypointSymbol = Market_TradeGoods_Latest.waypointSymbol AND c.symbol = Market_TradeGoods_Latest.symbol
+), changedAt)"""
+    ,"DROP TABLE temp.TradeGoods_Changes"
+]
+
+#Migration 6
+taskMetricsTableSql = """CREATE TABLE IF NOT EXISTS Task_Metrics (
+    runId TEXT NOT NULL,
+    task TEXT NOT NULL,
+    startedAt REAL NOT NULL,
+    seconds REAL NOT NULL,
+    apiCalls INTEGER NOT NULL,
+    bytesReceived INTEGER NOT NULL,
+    rows INTEGER NOT NULL,
+    errors INTEGER NOT NULL,
+    PRIMARY KEY (runId, task)
+)"""
+
+_applied = False
+_applyLock = threading.Lock()
+
+
+def table_exists(cursor, tableName):
+    """
+    Function that checks if a table exists.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database
+    tableName (str): Name of the table
+
+    Returns:
+    bool: True if the table exists
+    """
+    row = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ? COLLATE NOCASE", (tableName,)).fetchone()
+    return row is not None
+
+def table_columns(cursor, tableName):
+    """
+    Function that gets the columns of a table.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database
+    tableName (str): Name of the table
+
+    Returns:
+    List of Tuples: (name, isPrimaryKey) for each column, in table order
+    """
+    return [(r[1], r[5] > 0) for r in cursor.execute("PRAGMA table_info(" + tableName + ")").fetchall()]
+
+def rebuild_table(cursor, tableName, tableSql, columns, orderBy = "rowid"):
+    """
+    Function that rebuilds a table with a new definition, copying the given columns across.
+    Rows are copied in orderBy order with INSERT OR REPLACE, so when the new definition adds a key the last row per key wins.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database, inside a transaction
+    tableName (str): Name of the table
+    tableSql (str): Create statement with a {name} placeholder
+    columns (List of str): Columns copied from the old table
+    orderBy (str): Order rows are copied in
+
+    Returns:
+    None
+    """
+    newName = tableName + "_migrating"
+    cursor.execute("DROP TABLE IF EXISTS " + newName)
+    cursor.execute(tableSql.format(name = newName))
+    if table_exists(cursor, tableName):
+        columnString = ", ".join(columns)
+        cursor.execute("INSERT OR REPLACE INTO " + newName + " (" + columnString + ") SELECT " + columnString + " FROM " + tableName + " ORDER BY " + orderBy)
+        cursor.execute("DROP TABLE " + tableName)
+    cursor.execute("ALTER TABLE " + newName + " RENAME TO " + tableName)
+
+def _migration_1(cursor):
+    """
+    Migration that gives the core tables their keys and indexes.
+    AGENTS and Systems get a primary key on symbol, the market tables get the composite indexes their lookups use.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database, inside a transaction
+
+    Returns:
+    None
+    """
+    agentColumns = ["accountId", "symbol", "headquarters", "credits", "startingFaction", "shipCount", "token"]
+    if ("symbol", True) not in table_columns(cursor, "AGENTS"):
+        rebuild_table(cursor, "AGENTS", agentsTableSql, agentColumns)
+    systemColumns = ["symbol", "sectorSymbol", "type", "x", "y"]
+    if table_columns(cursor, "Systems") != [(c, c == "symbol") for c in systemColumns]:
+        rebuild_table(cursor, "Systems", systemsTableSql, systemColumns)
+    if not table_exists(cursor, "Market_Transactions"):
+        cursor.execute(transactionsTableSql.format(name = "Market_Transactions"))
+    if not table_exists(cursor, "Market_TradeGoods"):
+        cursor.execute(tradeGoodsTableSql.format(name = "Market_TradeGoods"))
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_market_transactions_trade_time ON Market_Transactions (tradeSymbol, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_market_tradegoods_waypoint_symbol_time ON Market_TradeGoods (waypointSymbol, symbol, timestamp)")
+
+def _migration_2(cursor):
+    """
+    Migration that makes market transactions unique on their natural key.
+    Duplicates stored by earlier polls are removed, keeping the first copy of each transaction.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database, inside a transaction
+
+    Returns:
+    None
+    """
+    keyString = ", ".join(transactionKeyColumns)
+    cursor.execute("DELETE FROM Market_Transactions WHERE rowid NOT IN (SELECT MIN(rowid) FROM Market_Transactions GROUP BY " + keyString + ")")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_market_transactions_key ON Market_Transactions (" + keyString + ")")
+
+def _migration_3(cursor):
+    """
+    Migration that adds the OHLC price rollup tables and fills them from the stored transactions.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database, inside a transaction
+
+    Returns:
+    None
+    """
+    for name, bucket in ohlcTables:
+        cursor.execute(ohlcTableSql.format(name = name))
+        cursor.execute("DELETE FROM " + name)
+        cursor.execute(ohlcFillSql.format(name = name, bucket = bucket))
+
+def _migration_4(cursor):
+    """
+    Migration that adds the Market_Registry table the market polling scheduler keeps its markets in.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database, inside a transaction
+
+    Returns:
+    None
+    """
+    cursor.execute(registryTableSql)
+
+def _migration_5(cursor):
+    """
+    Migration that delta encodes trade goods, adding the latest state table and the keyframe flag
+    and removing stored snapshots that repeat the one before them.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database, inside a transaction
+
+    Returns:
+    None
+    """
+    cursor.execute(tradeGoodsLatestTableSql)
+    if "keyframe" not in [c for c, isKey in table_columns(cursor, "Market_TradeGoods")]:
+        cursor.execute("ALTER TABLE Market_TradeGoods ADD COLUMN keyframe INTEGER NOT NULL DEFAULT 0")
+    for statement in tradeGoodsCompactSql:
+        cursor.execute(statement)
+
+def _migration_6(cursor):
+    """
+    Migration that adds the Task_Metrics table marketFlow stores its per task measurements in.
+
+    Parameters:
+    cursor (sqlite3.Cursor): Cursor on the SQLite database, inside a transaction
+
+    Returns:
+    None
+    """
+    cursor.execute(taskMetricsTableSql)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_task_metrics_task_started ON Task_Metrics (task, startedAt)")
+
+#Every migration in order, (version, description, function), the database records the last version applied in PRAGMA user_version
+migrations = [
+    (1, "Keys on AGENTS and Systems, indexes on the market tables", _migration_1)
+    ,(2, "Unique key on market transactions", _migration_2)
+    ,(3, "OHLC rollups of market transactions", _migration_3)
+    ,(4, "Market registry for the polling scheduler", _migration_4)
+    ,(5, "Delta encoded trade goods", _migration_5)
+    ,(6, "Task metrics", _migration_6)
+]
+
+def get_version():
+    """
+    Function that gets the schema version of the database.
+
+    Parameters:
+    None
+
+    Returns:
+    int: Last migration applied, 0 if none
+    """
+    conn = sqf.create_connection()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    sqf.close_connection(conn)
+    return version
+
+def apply_migrations():
+    """
+    Function that brings the database up to the latest schema version. Each migration runs in its own transaction.
+    Runs the migrations once per process, later calls return straight away.
+
+    Parameters:
+    None
+
+    Returns:
+    int: Schema version after migrating
+    """
+    global _applied
+    with _applyLock:
+        if _applied:
+            return migrations[-1][0]
+        conn = sqf.create_connection()
+        cursor = conn.cursor()
+        try:
+            version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            for migrationVersion, description, migrate in migrations:
+                if migrationVersion <= version:
+                    continue
+                print(f"Applying migration {migrationVersion}: {description}")
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    migrate(cursor)
+                    cursor.execute(f"PRAGMA user_version = {migrationVersion}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                version = migrationVersion
+        finally:
+            sqf.close_connection(conn)
+        _applied = True
+        return version
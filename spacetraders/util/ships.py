@@ -1,10 +1,12 @@
 import json
 
 import pandas as pd
-import requests
 import streamlit as st
 
+import util.api_client as api
+import util.galaxy as galaxy
 import util.nav as nav
+import util.routing as routing
 import util.sqlite_functions as sqf
 
 
@@ -103,10 +105,12 @@ class Ship():
         token (str): Token for the agent
         
         Returns:
-        Dict: Dictionary containing ship information
+        Dict: Dictionary containing ship information, None if the waypoint could not be loaded
         
         """
-        waypoint = nav.get_waypoint(token, self.nav['systemSymbol'], self.nav['waypointSymbol'])
+        waypoint = nav.get_waypoint(token, self.nav['systemSymbol'], self.nav['waypointSymbol'], fields = ["x", "y", "faction"])
+        if waypoint is None:
+            return None
         shipDic = {
             "symbol" : self.symbol
             ,"systemSymbol" : self.nav['systemSymbol']
@@ -114,7 +118,7 @@ class Ship():
             , "x": waypoint['data']['x']
             , "y": waypoint['data']['y']
             , "waypoints": self.nav['waypointSymbol']
-            , "factions" : waypoint['data']['faction']['symbol']
+            , "factions" : waypoint['data'].get('faction', {}).get('symbol')
         }
         return shipDic
     
@@ -141,13 +145,7 @@ class Ship():
         Dict: Dictionary containing ship information similar to nav, can be used to update the ship's nav information.
         
         """
-        url = f"https://api.spacetraders.io/v2/my/ships/{self.symbol}/orbit"
-        headers = {
-        'Authorization': f'Bearer {token}',
-        'Accept': 'application/json'
-    }
-        payload = ""
-        response = requests.post(url, headers=headers)
+        response = api.get_client(token).post(f"/my/ships/{self.symbol}/orbit")
         if response.status_code == 200:
             nav_data = response.json()['data']
             return nav_data
@@ -166,13 +164,7 @@ class Ship():
         Dict: Dictionary containing ship information similar to nav, can be used to update the ship's nav information.
         
         """
-        url = f"https://api.spacetraders.io/v2/my/ships/{self.symbol}/dock"
-        headers = {
-        'Authorization': f'Bearer {token}',
-        'Accept': 'application/json'
-    }
-        payload = ""
-        response = requests.post(url, headers=headers)
+        response = api.get_client(token).post(f"/my/ships/{self.symbol}/dock")
         if response.status_code == 200:
             nav_data = response.json()['data']
             return nav_data
@@ -191,16 +183,10 @@ class Ship():
         Returns:
         Dict: Dictionary containing ship information similar to nav, can be used to update the ship's nav information.
         """
-        url = f"https://api.spacetraders.io/v2/my/ships/{self.symbol}/navigate"
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Accept': 'application/json'
-        }
-
         payload = {
             'waypointSymbol': waypoint_symbol
         }
-        response = requests.post(url, headers=headers, json=payload)
+        response = api.get_client(token).post(f"/my/ships/{self.symbol}/navigate", json=payload)
         if response.status_code == 200:
             st.success(f"Ship {self.symbol} is navigating to {waypoint_symbol}")
             return response.json()
@@ -208,6 +194,108 @@ class Ship():
             print(f"Error navigating to waypoint: {response.status_code} - {response.text}")
             return None
         
+    def plan_route(self, token, waypoint_symbol, modes = routing.defaultModes):
+        """
+        Function that plans a fuel aware route to a waypoint in the ship's current system, stopping to refuel at marketplaces when needed.
+        
+        Parameters:
+        token (str): Token for the agent
+        waypoint_symbol (str): Symbol for the destination waypoint
+        modes (Sequence of str): Flight modes the planner may use
+        
+        Returns:
+        Dict: Dictionary with path, legs, fuel and time of the route, None if the waypoint cannot be reached
+        """
+        systemWaypoints = nav.get_system_waypoints(token, self.nav['systemSymbol'])
+        return routing.plan_ship_route(systemWaypoints, self, waypoint_symbol, modes)
+
+    def refuel(self, token):
+        """
+        Function that refuels the ship to full. Ships must be docked at a marketplace that sells fuel.
+        
+        Parameters:
+        token (str): Token for the agent
+        
+        Returns:
+        Dict: Dictionary containing agent, fuel and transaction information, None if the ship could not refuel
+        """
+        response = api.get_client(token).post(f"/my/ships/{self.symbol}/refuel")
+        if response.status_code == 200:
+            data = response.json()['data']
+            self.fuel = data['fuel']
+            return data
+        else:
+            print(f"Error refueling: {response.status_code} - {response.text}")
+            return None
+
+    def set_flight_mode(self, token, flight_mode):
+        """
+        Function that sets the flight mode used by the ship's next navigation.
+        
+        Parameters:
+        token (str): Token for the agent
+        flight_mode (str): CRUISE, DRIFT, BURN or STEALTH
+        
+        Returns:
+        Dict: Dictionary containing the ship's nav information, None if the mode could not be set
+        """
+        response = api.get_client(token).request("PATCH", f"/my/ships/{self.symbol}/nav", json = {'flightMode': flight_mode})
+        if response.status_code == 200:
+            self.nav = response.json()['data']
+            return self.nav
+        else:
+            print(f"Error setting flight mode: {response.status_code} - {response.text}")
+            return None
+
+    def navigate_route(self, token, route):
+        """
+        Function that flies the next leg of a route from plan_route. The ship refuels first when the leg starts at a refuel stop,
+        then flies the leg in its planned flight mode. A leg takes time to fly, so plan again and call this once the ship has arrived.
+        
+        Parameters:
+        token (str): Token for the agent
+        route (Dict): Route from plan_route, starting at the ship's waypoint
+        
+        Returns:
+        Dict: Dictionary from navigate_to_waypoint, None if the route is empty or any step failed
+        """
+        if not route or not route['legs'] or route['legs'][0]['from'] != self.nav['waypointSymbol']:
+            return None
+        if self.nav['status'] == "IN_TRANSIT":
+            print(f"Ship {self.symbol} is in transit")
+            return None
+        leg = route['legs'][0]
+        if leg['refuelBefore'] and self.fuel['current'] < self.fuel['capacity']:
+            if self.nav['status'] != "DOCKED":
+                docked = self.docking(token)
+                if not docked:
+                    return None
+                self.nav = docked['nav']
+            if self.refuel(token) is None:
+                return None
+        if self.nav['status'] == "DOCKED":
+            orbiting = self.check_orbit(token)
+            if not orbiting:
+                return None
+            self.nav = orbiting['nav']
+        if self.nav.get('flightMode') != leg['mode'] and self.set_flight_mode(token, leg['mode']) is None:
+            return None
+        return self.navigate_to_waypoint(token, leg['to'])
+
+    def plan_itinerary(self, system_symbol, warp_range = None, token = None):
+        """
+        Function that plans a multi hop itinerary to another system over jump gates and warps.
+        
+        Parameters:
+        system_symbol (str): Symbol for the destination system
+        warp_range (float): Longest warp allowed, defaults to the ship's fuel capacity
+        token (str): Token for the agent, used to refresh the jump gate connections in the background
+        
+        Returns:
+        Dict: Dictionary with path, hops, time and fuel of the itinerary, None if the system cannot be reached
+        """
+        return galaxy.plan_ship_itinerary(self, system_symbol, warp_range, token)
+
     def warp_to_new_system(self, token, waypointSymbol):
         """
         Function that warps the ship to a new system.
@@ -220,15 +308,10 @@ class Ship():
         Dict: Dictionary containing ship information similar to nav, can be used to update the ship's nav information.
         """
 
-        url = f"https://api.spacetraders.io/v2/ships/{self.symbol}/warp"
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
         payload = {
             'waypointSymbol': waypointSymbol
         }
-        response = requests.post(url, headers=headers, json=payload)
+        response = api.get_client(token).post(f"/my/ships/{self.symbol}/warp", json=payload)
         if response.status_code == 200:
             return response.json()
         else:
@@ -244,8 +327,6 @@ def find_shipyards(token, system):
     system (str): Symbol for the system
     
     Returns:
-    Dict: Dictionary containing shipyard information
+    List of Dicts: List of dicts containing shipyard waypoint information
     """
-    data = nav.search_system(token, system, "SHIPYARD")
-    if data['data']: 
-        return data['data']
+    return nav.get_system_waypoints(token, system).shipyards()
@@ -0,0 +1,265 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+#Average number of systems per grid cell the index aims for
+defaultPointsPerCell = 4
+
+
+class SystemIndex():
+    """
+    Class that represents a uniform grid index over system coordinates, answering k-nearest and radius queries
+    without computing the distance to every system.
+
+    Attributes:
+    df (pd.DataFrame): Systems in the index, with a fresh RangeIndex
+    x (np.ndarray): x coordinate of each system
+    y (np.ndarray): y coordinate of each system
+    cellSize (float): Width and height of one grid cell
+    cells (Dict): Maps (cellX, cellY) to an array of row positions in df
+    """
+    def __init__(self, df, cellSize = None, pointsPerCell = defaultPointsPerCell):
+        """
+        Initializes a SystemIndex object.
+
+        Parameters:
+        df (pd.DataFrame): DataFrame containing at least symbol, x and y columns
+        cellSize (float): Width and height of one grid cell, picked from the data if not given
+        pointsPerCell (int): Average number of systems per cell when picking the cell size
+
+        Returns:
+        None
+        """
+        self.df = df.reset_index(drop = True)
+        self.x = self.df['x'].to_numpy(dtype = float)
+        self.y = self.df['y'].to_numpy(dtype = float)
+        self.symbolPositions = {s: i for i, s in enumerate(self.df['symbol'])} if 'symbol' in self.df else {}
+        self.cells = {}
+        if len(self.df) == 0:
+            self.minX = self.minY = 0.0
+            self.cellSize = cellSize or 1.0
+            self.maxRing = 0
+            return
+        self.minX = self.x.min()
+        self.minY = self.y.min()
+        span = max(self.x.max() - self.minX, self.y.max() - self.minY, 1.0)
+        if cellSize is None:
+            cellsPerSide = max(1, int(math.sqrt(len(self.df) / pointsPerCell)))
+            cellSize = span / cellsPerSide
+        self.cellSize = float(cellSize)
+        cellX = ((self.x - self.minX) // self.cellSize).astype(np.int64)
+        cellY = ((self.y - self.minY) // self.cellSize).astype(np.int64)
+        self.maxRing = int(max(cellX.max(), cellY.max())) + 1
+        #Group row positions by cell with one sort instead of a Python loop over rows
+        order = np.lexsort((cellY, cellX))
+        keys = np.stack([cellX[order], cellY[order]], axis = 1)
+        uniqueKeys, starts = np.unique(keys, axis = 0, return_index = True)
+        ends = np.append(starts[1:], len(order))
+        for (cx, cy), start, end in zip(uniqueKeys, starts, ends):
+            self.cells[(int(cx), int(cy))] = order[start:end]
+
+    def __len__(self):
+        """
+        Gets the number of systems in the index.
+
+        Parameters:
+        None
+
+        Returns:
+        int: Number of systems
+        """
+        return len(self.df)
+
+    def _cell_of(self, x, y):
+        """
+        Gets the grid cell a point falls in.
+
+        Parameters:
+        x (float): x coordinate
+        y (float): y coordinate
+
+        Returns:
+        Tuple: (cellX, cellY)
+        """
+        return int((x - self.minX) // self.cellSize), int((y - self.minY) // self.cellSize)
+
+    def _ring(self, cellX, cellY, ring):
+        """
+        Gets the row positions of every system in the square ring of cells at a distance of ring cells.
+
+        Parameters:
+        cellX (int): Center cell x
+        cellY (int): Center cell y
+        ring (int): Ring number, 0 is the center cell
+
+        Returns:
+        List of np.ndarray: Row positions, one array per non-empty cell
+        """
+        if ring == 0:
+            cell = self.cells.get((cellX, cellY))
+            return [] if cell is None else [cell]
+        found = []
+        for dx in range(-ring, ring + 1):
+            for dy in (-ring, ring):
+                cell = self.cells.get((cellX + dx, cellY + dy))
+                if cell is not None:
+                    found.append(cell)
+        for dy in range(-ring + 1, ring):
+            for dx in (-ring, ring):
+                cell = self.cells.get((cellX + dx, cellY + dy))
+                if cell is not None:
+                    found.append(cell)
+        return found
+
+    def _result(self, positions, distances):
+        """
+        Builds the result DataFrame for a query.
+
+        Parameters:
+        positions (np.ndarray): Row positions of the matching systems
+        distances (np.ndarray): Distance to each matching system
+
+        Returns:
+        pd.DataFrame: Matching systems sorted by Distance
+        """
+        order = np.argsort(distances, kind = 'stable')
+        result = self.df.iloc[positions[order]].copy()
+        result['Distance'] = distances[order]
+        return result
+
+    def nearest(self, x, y, k = 5):
+        """
+        Gets the k systems closest to a point.
+        Rings of cells are searched outwards until k systems are found and the kth distance is inside the searched area.
+
+        Parameters:
+        x (float): x coordinate
+        y (float): y coordinate
+        k (int): Number of systems to return
+
+        Returns:
+        pd.DataFrame: Closest systems sorted by Distance
+        """
+        if len(self.df) == 0 or k <= 0:
+            return self._result(np.array([], dtype = np.int64), np.array([]))
+        k = min(k, len(self.df))
+        cellX, cellY = self._cell_of(x, y)
+        #Rings needed before the search reaches the grid from a point outside it
+        ring = max(0, -cellX, -cellY, cellX - self.maxRing, cellY - self.maxRing)
+        candidates = []
+        while True:
+            candidates.extend(self._ring(cellX, cellY, ring))
+            count = sum(len(c) for c in candidates)
+            lastRing = ring >= self.maxRing + max(abs(cellX), abs(cellY))
+            if count >= k or lastRing:
+                positions = np.concatenate(candidates) if candidates else np.array([], dtype = np.int64)
+                distances = np.hypot(self.x[positions] - x, self.y[positions] - y)
+                if len(positions) >= k:
+                    kth = np.partition(distances, k - 1)[k - 1]
+                    #Every system outside the searched rings is at least ring * cellSize away
+                    if kth <= ring * self.cellSize or lastRing:
+                        nearest = np.argpartition(distances, k - 1)[:k]
+                        return self._result(positions[nearest], distances[nearest])
+                elif lastRing:
+                    return self._result(positions, distances)
+            ring += 1
+
+    def within_positions(self, x, y, radius):
+        """
+        Gets the row positions and distances of every system within a radius of a point, without building a DataFrame.
+
+        Parameters:
+        x (float): x coordinate
+        y (float): y coordinate
+        radius (float): Search radius
+
+        Returns:
+        Tuple of np.ndarray: Row positions and distances, unsorted
+        """
+        lowX, lowY = self._cell_of(x - radius, y - radius)
+        highX, highY = self._cell_of(x + radius, y + radius)
+        candidates = []
+        for cx in range(max(lowX, 0), min(highX, self.maxRing) + 1):
+            for cy in range(max(lowY, 0), min(highY, self.maxRing) + 1):
+                cell = self.cells.get((cx, cy))
+                if cell is not None:
+                    candidates.append(cell)
+        positions = np.concatenate(candidates) if candidates else np.array([], dtype = np.int64)
+        distances = np.hypot(self.x[positions] - x, self.y[positions] - y)
+        inside = distances <= radius
+        return positions[inside], distances[inside]
+
+    def within(self, x, y, radius):
+        """
+        Gets every system within a radius of a point.
+
+        Parameters:
+        x (float): x coordinate
+        y (float): y coordinate
+        radius (float): Search radius
+
+        Returns:
+        pd.DataFrame: Systems within the radius sorted by Distance
+        """
+        positions, distances = self.within_positions(x, y, radius)
+        return self._result(positions, distances)
+
+    def position_of(self, systemSymbol):
+        """
+        Gets the coordinates of a system in the index.
+
+        Parameters:
+        systemSymbol (str): Symbol for the system
+
+        Returns:
+        Tuple: (x, y), None if the system is not in the index
+        """
+        i = self.symbolPositions.get(systemSymbol)
+        if i is None:
+            return None
+        return self.x[i], self.y[i]
+
+    def ship_position(self, ship):
+        """
+        Gets the galaxy coordinates of a ship, the coordinates of the system it is in.
+        Falls back to the ship's route origin if the system is not in the index.
+
+        Parameters:
+        ship (Ship): Ship object
+
+        Returns:
+        Tuple: (x, y)
+        """
+        position = self.position_of(ship.nav['systemSymbol'])
+        if position is None:
+            position = (ship.nav['route']['origin']['x'], ship.nav['route']['origin']['y'])
+        return position
+
+    def nearest_to_ship(self, ship, k = 5):
+        """
+        Gets the k systems closest to a ship.
+
+        Parameters:
+        ship (Ship): Ship object
+        k (int): Number of systems to return
+
+        Returns:
+        pd.DataFrame: Closest systems sorted by Distance
+        """
+        x, y = self.ship_position(ship)
+        return self.nearest(x, y, k)
+
+    def within_of_ship(self, ship, radius):
+        """
+        Gets every system within a radius of a ship.
+
+        Parameters:
+        ship (Ship): Ship object
+        radius (float): Search radius
+
+        Returns:
+        pd.DataFrame: Systems within the radius sorted by Distance
+        """
+        x, y = self.ship_position(ship)
+        return self.within(x, y, radius)
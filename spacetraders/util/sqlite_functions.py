@@ -1,13 +1,151 @@
+import itertools
+import operator
+import queue
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 
 import pandas as pd
 
 #Path to the database file
 dbFile = "data/spaceTradersDb.db"
 
+#Connections kept open in the pool, callers beyond this get a connection that is closed on release
+poolSize = 8
+
+#Seconds a connection waits on a lock held by another writer before raising "database is locked"
+busyTimeout = 30
+
+#Prepared statements each connection keeps compiled
+cachedStatements = 256
+
+#Rows written per transaction by bulk_insert
+bulkChunkSize = 5000
+
+#Pragmas applied to every new connection
+#WAL lets readers run while a writer commits, NORMAL sync is safe under WAL and skips an fsync per commit
+connectionPragmas = [
+    "PRAGMA journal_mode = WAL"
+    ,"PRAGMA synchronous = NORMAL"
+    ,"PRAGMA cache_size = -65536"
+    ,"PRAGMA mmap_size = 268435456"
+    ,"PRAGMA temp_store = MEMORY"
+    ,f"PRAGMA busy_timeout = {busyTimeout * 1000}"
+]
+
+
+class ConnectionPool():
+    """
+    Class that represents a thread safe pool of long lived connections to one SQLite database.
+    A connection is used by one caller at a time and returned to the pool on release.
+
+    Attributes:
+    path (str): Path to the database file
+    size (int): Connections kept open in the pool
+    """
+    def __init__(self, path, size = poolSize):
+        """
+        Initializes a ConnectionPool object. Connections are opened on first use.
+
+        Parameters:
+        path (str): Path to the database file
+        size (int): Connections kept open in the pool
+
+        Returns:
+        None
+        """
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue(maxsize = size)
+
+    def _connect(self):
+        """
+        Opens a new connection with the pool's pragmas.
+
+        Parameters:
+        None
+
+        Returns:
+        sqlite3.Connection: Connection to the SQLite database
+        """
+        conn = sqlite3.connect(self.path, timeout = busyTimeout, check_same_thread = False, cached_statements = cachedStatements)
+        for pragma in connectionPragmas:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        """
+        Gets an idle connection from the pool, opening one if none is idle.
+
+        Parameters:
+        None
+
+        Returns:
+        sqlite3.Connection: Connection to the SQLite database
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool, rolling back anything left uncommitted.
+
+        Parameters:
+        conn (sqlite3.Connection): Connection from acquire
+
+        Returns:
+        None
+        """
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.ProgrammingError):
+            conn.close()
+
+    def close_all(self):
+        """
+        Closes every idle connection.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+_pool = None
+_poolLock = threading.Lock()
+
+def get_pool():
+    """
+    Function that gets the connection pool for dbFile, creating it on first use or when dbFile changes.
+
+    Parameters:
+    None
+
+    Returns:
+    ConnectionPool: Pool of connections to dbFile
+    """
+    global _pool
+    with _poolLock:
+        if _pool is None or _pool.path != dbFile:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(dbFile)
+        return _pool
+
 def create_connection():
     """
-    Function that creates a connection to the SQLite database.
+    Function that gets a pooled connection to the SQLite database. Hand it back with close_connection.
     
     Parameters:
     None
@@ -17,8 +155,7 @@ def create_connection():
     """
     conn = None
     try:
-        conn = sqlite3.connect(dbFile)
-        #print(sqlite3.version)
+        conn = get_pool().acquire()
     except Exception as e:
         print(e)
     finally:
@@ -27,7 +164,7 @@ def create_connection():
         
 def close_connection(conn):
     """
-    Function that closes the connection to the SQLite database.
+    Function that returns a connection to the pool. Uncommitted changes are rolled back.
     
     Parameters:
     conn (sqlite3.Connection): Connection to the SQLite database
@@ -35,7 +172,24 @@ def close_connection(conn):
     Returns:
     None
     """
-    conn.close()
+    get_pool().release(conn)
+
+@contextmanager
+def connection():
+    """
+    Context manager that gets a pooled connection and returns it to the pool afterwards.
+
+    Parameters:
+    None
+
+    Returns:
+    sqlite3.Connection: Connection to the SQLite database
+    """
+    conn = create_connection()
+    try:
+        yield conn
+    finally:
+        close_connection(conn)
 
 def create_table(tableName, columns):
     """
@@ -67,6 +221,106 @@ def create_table(tableName, columns):
         print(e)
     close_connection(conn)
 
+def _row_chunks(rows, columns, chunkSize):
+    """
+    Splits rows into chunks of value tuples in column order, without copying a DataFrame first.
+
+    Parameters:
+    rows (pd.DataFrame or Iterable of Dicts): Rows to split
+    columns (List of str): Columns to take from each row, in order
+    chunkSize (int): Rows per chunk
+
+    Returns:
+    Generator of Lists of Tuples: Chunks of rows
+    """
+    if isinstance(rows, pd.DataFrame):
+        #Iterating the columns side by side reads values straight from the DataFrame
+        rows = zip(*(rows[c] for c in columns))
+    else:
+        getter = operator.itemgetter(*columns) if len(columns) > 1 else (lambda r: (r[columns[0]],))
+        rows = (getter(r) if isinstance(r, dict) else tuple(r) for r in rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunkSize))
+        if not chunk:
+            return
+        yield chunk
+
+def prepare_insert(tableName, rows, columns = None, chunkSize = bulkChunkSize, onConflict = None):
+    """
+    Function that builds the INSERT statement for a set of rows and splits the rows into chunks to run it on.
+    Columns are bound by name, columns the table does not have are left out.
+
+    Parameters:
+    tableName (str): Name of the table
+    rows (pd.DataFrame or Iterable of Dicts): Rows to insert
+    columns (List of str): Columns to insert, defaults to the DataFrame's columns or the keys of the first row
+    chunkSize (int): Rows per chunk
+    onConflict (str): Conflict clause, e.g. "IGNORE" or "REPLACE"
+
+    Returns:
+    Tuple: INSERT statement and a generator of chunks of value tuples, the statement is None if there are no rows
+    """
+    tableColumns = get_table_columns(tableName)
+    if not tableColumns:
+        raise ValueError(f"Unknown table {tableName}")
+    if isinstance(rows, pd.DataFrame) and len(rows) == 0:
+        return None, iter(())
+    if columns is None:
+        if isinstance(rows, pd.DataFrame):
+            columns = list(rows.columns)
+        else:
+            rows = iter(rows)
+            first = next(rows, None)
+            if first is None:
+                return None, iter(())
+            columns = list(first.keys())
+            rows = itertools.chain([first], rows)
+    columns = [c for c in columns if c in tableColumns]
+    if not columns:
+        raise ValueError(f"No columns of {tableName} to insert")
+    verb = "INSERT OR " + onConflict if onConflict else "INSERT"
+    query = verb + " INTO " + tableName + " (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" for c in columns) + ")"
+    return query, _row_chunks(rows, columns, chunkSize)
+
+def bulk_insert(tableName, rows, columns = None, chunkSize = bulkChunkSize, onConflict = None):
+    """
+    Function that inserts rows into a table in chunks, one transaction per chunk.
+    Columns are bound by name, so the order of the DataFrame's columns does not matter, and columns the table does not have are left out.
+
+    Parameters:
+    tableName (str): Name of the table
+    rows (pd.DataFrame or Iterable of Dicts): Rows to insert, an iterable is read one chunk at a time
+    columns (List of str): Columns to insert, defaults to the DataFrame's columns or the keys of the first row
+    chunkSize (int): Rows per transaction
+    onConflict (str): Conflict clause, e.g. "IGNORE" to skip rows that break a unique key or "REPLACE" to overwrite them
+
+    Returns:
+    Dict: rows, inserted, skipped, batches and seconds
+    """
+    started = time.perf_counter()
+    query, chunks = prepare_insert(tableName, rows, columns, chunkSize, onConflict)
+    total = 0
+    inserted = 0
+    batches = 0
+    conn = create_connection()
+    try:
+        for chunk in chunks:
+            before = conn.total_changes
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(query, chunk)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            #REPLACE counts the deleted row as a change too, a row is never counted twice
+            inserted += min(conn.total_changes - before, len(chunk))
+            total += len(chunk)
+            batches += 1
+    finally:
+        close_connection(conn)
+    return {'rows': total, 'inserted': inserted, 'skipped': total - inserted, 'batches': batches, 'seconds': time.perf_counter() - started}
+
 def insert_data(tableName, cvDf):
     """
     Function that inserts data into a table in the SQLite database.
@@ -76,34 +330,30 @@ def insert_data(tableName, cvDf):
     cvDf (pd.DataFrame): DataFrame containing the data to insert
     
     Returns:
-    None"""
-    print("Inserting data into " + tableName)
-    conn = create_connection()
-    cursor = conn.cursor()
-    columns = cvDf.columns
-    valuesList = cvDf.values.tolist()
-    
-    columnString = "("
-    count = 0
-    for c in columns:
-        if count == len(columns) - 1:
-            columnString += "?)"
-        else:
-            columnString += "?,"
-        count += 1
-
-    query = "INSERT INTO " + tableName + " VALUES " + columnString
-    print(columns)
-    print(valuesList)
+    Dict: Counts and timings from bulk_insert, the exception if the insert failed"""
+    if len(cvDf) == 0:
+        return {'rows': 0, 'inserted': 0, 'skipped': 0, 'batches': 0, 'seconds': 0.0}
     try:
-        cursor.executemany(query, valuesList)
-        conn.commit()
-        close_connection(conn)
+        return bulk_insert(tableName, cvDf)
     except Exception as e:
         print(e)
-        close_connection(conn)
         return e
-    return True
+
+def insert_new_data(tableName, cvDf):
+    """
+    Function that inserts rows into a table, skipping rows that already exist under one of the table's unique keys.
+    Columns are matched to the table by name, so the DataFrame's column order does not matter.
+    
+    Parameters:
+    tableName (str): Name of the table
+    cvDf (pd.DataFrame): DataFrame containing the data to insert
+    
+    Returns:
+    Dict: Counts and timings from bulk_insert, with inserted and skipped row counts
+    """
+    if len(cvDf) == 0:
+        return {'rows': 0, 'inserted': 0, 'skipped': 0, 'batches': 0, 'seconds': 0.0}
+    return bulk_insert(tableName, cvDf, onConflict = "IGNORE")
 
 def get_all_values(tableName):
     """
@@ -128,42 +378,139 @@ def get_all_values(tableName):
         return e
     return df
 
-def update_agent_into(agentDic):
+def get_table_columns(tableName):
     """
-    Function that updates an agent into the SQLite database.
+    Function that gets the column names of a table, used to check identifiers before they go into a query.
+    
+    Parameters:
+    tableName (str): Name of the table
+    
+    Returns:
+    List of str: Column names in table order, empty if the table does not exist
+    """
+    conn = create_connection()
+    rows = conn.execute("PRAGMA table_info(" + tableName + ")").fetchall()
+    close_connection(conn)
+    return [r[1] for r in rows]
+
+def select_values(tableName, columns = None, filters = None, timeColumn = "timestamp", start = None, end = None, orderBy = None, descending = False, limit = None, offset = None):
+    """
+    Function that gets a filtered slice of a table, with filtering, sorting and paging done by SQLite.
+    Column names are checked against the table, values are bound as parameters.
+    
+    Parameters:
+    tableName (str): Name of the table
+    columns (List of str): Columns to return, None returns every column
+    filters (Dict): Maps column name to a value or a list of values the column must match
+    timeColumn (str): Column start and end apply to
+    start (str): Only rows with timeColumn at or after this ISO timestamp
+    end (str): Only rows with timeColumn before this ISO timestamp
+    orderBy (str): Column to sort by
+    descending (bool): Sort newest or largest first
+    limit (int): Maximum number of rows
+    offset (int): Rows to skip, used with limit for paging
+    
+    Returns:
+    pd.DataFrame: DataFrame containing the matching rows
+    """
+    tableColumns = get_table_columns(tableName)
+    if not tableColumns:
+        raise ValueError(f"Unknown table {tableName}")
+    for c in list(columns or []) + list((filters or {}).keys()) + [c for c in [orderBy] if c] + ([timeColumn] if start or end else []):
+        if c not in tableColumns:
+            raise ValueError(f"Unknown column {c} in {tableName}")
+
+    query = "SELECT " + (", ".join(columns) if columns else "*") + " FROM " + tableName
+    conditions = []
+    params = []
+    for c, v in (filters or {}).items():
+        if v is None:
+            continue
+        if isinstance(v, (list, tuple, set)):
+            v = list(v)
+            conditions.append(c + " IN (" + ", ".join("?" for i in v) + ")")
+            params.extend(v)
+        else:
+            conditions.append(c + " = ?")
+            params.append(v)
+    if start is not None:
+        conditions.append(timeColumn + " >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append(timeColumn + " < ?")
+        params.append(end)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if orderBy:
+        query += " ORDER BY " + orderBy + (" DESC" if descending else "")
+    if limit is not None or offset:
+        #SQLite only takes OFFSET after a LIMIT, -1 means no limit
+        query += " LIMIT ?"
+        params.append(-1 if limit is None else int(limit))
+        if offset:
+            query += " OFFSET ?"
+            params.append(int(offset))
+    conn = create_connection()
+    try:
+        df = pd.read_sql_query(query, con = conn, params = params)
+    finally:
+        close_connection(conn)
+    return df
+
+def get_distinct_values(tableName, column):
+    """
+    Function that gets the distinct values of a column, sorted.
+    
+    Parameters:
+    tableName (str): Name of the table
+    column (str): Name of the column
+    
+    Returns:
+    List: Distinct values of the column
+    """
+    if column not in get_table_columns(tableName):
+        raise ValueError(f"Unknown column {column} in {tableName}")
+    conn = create_connection()
+    rows = conn.execute("SELECT DISTINCT " + column + " FROM " + tableName + " ORDER BY " + column).fetchall()
+    close_connection(conn)
+    return [r[0] for r in rows]
+
+def write_agent(conn, agentDic):
+    """
+    Function that inserts or updates an agent on a connection, without committing.
     
     Parameters:
+    conn (sqlite3.Connection): Connection to the SQLite database
     agentDic (Dict): Dictionary containing agent information
     
     Returns:
     None
     """
-    conn = create_connection()
     cursor = conn.cursor()
-    query = "SELECT * from AGENTS WHERE symbol = " + "\'" + agentDic['symbol'] + "\'"
-    #Creates Query to get agent from database
-    df = pd.read_sql_query(query, con = conn)
+    #Checks if the agent is already in the database
+    row = cursor.execute("SELECT 1 FROM AGENTS WHERE symbol = ?", (agentDic['symbol'],)).fetchone()
     #If agent not in database, insert
-    if len(df) <= 0:
-        columnString ="("
-        valueString = "("
-        count = 0
-        for k in agentDic.keys():
-            if count == len(agentDic) - 1:
-                columnString += k + ")"
-                valueString += "\'" + str(agentDic[k]) + "\'" + ")"
-            else:
-                columnString += k + ", "
-                valueString += "\'" + str(agentDic[k]) + "\'"  + ", "
-            count += 1
-        query = "INSERT INTO AGENTS " + columnString + " VALUES " + valueString + (";")
-        print(query)
-        cursor.execute(query)
+    if row is None:
+        columns = list(agentDic.keys())
+        query = "INSERT INTO AGENTS (" + ", ".join(columns) + ") VALUES (" + ", ".join("?" for c in columns) + ")"
+        cursor.execute(query, [agentDic[c] for c in columns])
     #Else Update Agent Information
     else:
-        query = "UPDATE AGENTS SET accountID = ?, headquarters = ?, token = ?"
-        values = [agentDic["accountId"], agentDic["headquarters"], agentDic["token"]]
+        query = "UPDATE AGENTS SET accountId = ?, headquarters = ?, token = ? WHERE symbol = ?"
+        values = [agentDic["accountId"], agentDic["headquarters"], agentDic["token"], agentDic["symbol"]]
         cursor.execute(query, values)
-    conn.commit()
-
 
+def update_agent_into(agentDic):
+    """
+    Function that updates an agent into the SQLite database.
+    
+    Parameters:
+    agentDic (Dict): Dictionary containing agent information
+    
+    Returns:
+    None
+    """
+    conn = create_connection()
+    write_agent(conn, agentDic)
+    conn.commit()
+    close_connection(conn)
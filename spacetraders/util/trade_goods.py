@@ -0,0 +1,197 @@
+import math
+
+import pandas as pd
+
+import util.sqlite_functions as sqf
+
+#Columns compared against the last stored state, a snapshot is only stored when one of them changed
+deltaColumns = ["purchasePrice", "sellPrice", "supply", "activity", "tradeVolume"]
+
+#Columns of a stored trade good row, besides keyframe
+historyColumns = ["symbol", "tradeVolume", "type", "supply", "purchasePrice", "sellPrice", "waypointSymbol", "timestamp", "activity"]
+
+#Hours per keyframe window, the first snapshot of a good in each window it is polled in is stored even if nothing changed,
+#so the stored history shows when a good was seen as well as when it changed
+keyframeHours = 6
+
+
+def keyframe_window(timestamp):
+    """
+    Function that gets the keyframe window an ISO timestamp falls in.
+
+    Parameters:
+    timestamp (str): ISO timestamp
+
+    Returns:
+    str: Start of the window as YYYY-MM-DDTHH
+    """
+    return timestamp[:11] + "%02d" % (int(timestamp[11:13]) // keyframeHours * keyframeHours)
+
+def window_start(timestamp, windows = 1):
+    """
+    Function that gets the start of the keyframe window a number of windows before the one a timestamp falls in.
+
+    Parameters:
+    timestamp (str): ISO timestamp
+    windows (int): Windows to step back
+
+    Returns:
+    str: ISO timestamp
+    """
+    start = pd.Timestamp(keyframe_window(timestamp) + ":00:00Z") - pd.Timedelta(hours = keyframeHours * windows)
+    return start.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+def _clean(value):
+    """
+    Turns the NaN pandas uses for missing values into None.
+
+    Parameters:
+    value: Value from a snapshot
+
+    Returns:
+    Value, None if it was NaN
+    """
+    return None if isinstance(value, float) and math.isnan(value) else value
+
+def write_snapshot(conn, tradeGoods):
+    """
+    Function that stores a batch of trade good snapshots as changes against the latest state.
+    A snapshot is added to Market_TradeGoods only when one of deltaColumns changed or it is the good's first snapshot in a keyframe window.
+    Every snapshot refreshes the latest state. Runs on the given connection without committing, so it can be queued on the database writer.
+
+    Parameters:
+    conn (sqlite3.Connection): Connection to the SQLite database, inside a transaction
+    tradeGoods (pd.DataFrame or List of Dicts): Snapshots with every column of Market_TradeGoods
+
+    Returns:
+    Dict: rows received, changed rows stored, keyframes stored and unchanged rows skipped
+    """
+    records = tradeGoods.to_dict('records') if isinstance(tradeGoods, pd.DataFrame) else list(tradeGoods)
+    if not records:
+        return {'rows': 0, 'changed': 0, 'keyframes': 0, 'unchanged': 0}
+    records.sort(key = lambda r: r['timestamp'])
+    waypointSymbols = sorted({r['waypointSymbol'] for r in records})
+    latestColumns = historyColumns + ["changedAt"]
+    cursor = conn.execute(
+        "SELECT " + ", ".join(latestColumns) + " FROM Market_TradeGoods_Latest WHERE waypointSymbol IN (" + ", ".join("?" for w in waypointSymbols) + ")"
+        ,waypointSymbols
+    )
+    latest = {(r['waypointSymbol'], r['symbol']): r for r in (dict(zip(latestColumns, row)) for row in cursor.fetchall())}
+
+    history = []
+    changed = 0
+    keyframes = 0
+    for record in records:
+        state = {c: _clean(record.get(c)) for c in historyColumns}
+        key = (state['waypointSymbol'], state['symbol'])
+        previous = latest.get(key)
+        isKeyframe = previous is None or keyframe_window(previous['timestamp']) != keyframe_window(state['timestamp'])
+        isChanged = previous is not None and any(previous[c] != state[c] for c in deltaColumns)
+        if isKeyframe or isChanged:
+            history.append([state[c] for c in historyColumns] + [1 if isKeyframe else 0])
+            if isKeyframe:
+                keyframes += 1
+            else:
+                changed += 1
+        state['changedAt'] = state['timestamp'] if previous is None or isChanged else previous['changedAt']
+        latest[key] = state
+
+    conn.executemany(
+        "INSERT INTO Market_TradeGoods (" + ", ".join(historyColumns) + ", keyframe) VALUES (" + ", ".join("?" for c in historyColumns) + ", ?)"
+        ,history
+    )
+    touched = {(r['waypointSymbol'], r['symbol']) for r in records}
+    conn.executemany(
+        "INSERT OR REPLACE INTO Market_TradeGoods_Latest (" + ", ".join(latestColumns) + ") VALUES (" + ", ".join("?" for c in latestColumns) + ")"
+        ,[[latest[k][c] for c in latestColumns] for k in touched]
+    )
+    return {'rows': len(records), 'changed': changed, 'keyframes': keyframes, 'unchanged': len(records) - changed - keyframes}
+
+def get_latest(symbol = None, waypointSymbol = None):
+    """
+    Function that gets the current state of trade goods, the newest snapshot of each good with when it was last seen and last changed.
+
+    Parameters:
+    symbol (str or List of str): Only these trade goods
+    waypointSymbol (str or List of str): Only trade goods at these waypoints
+
+    Returns:
+    pd.DataFrame: One row per waypoint and trade good
+    """
+    return sqf.select_values("Market_TradeGoods_Latest", None, {'symbol': symbol, 'waypointSymbol': waypointSymbol}, orderBy = "waypointSymbol")
+
+def normalize_timestamp(timestamp):
+    """
+    Function that writes an ISO timestamp in the format the API and the stored rows use, so timestamps compare as strings.
+
+    Parameters:
+    timestamp (str): ISO timestamp
+
+    Returns:
+    str: Timestamp as YYYY-MM-DDTHH:MM:SS.mmmZ in UTC
+    """
+    ts = pd.Timestamp(timestamp)
+    ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+    return ts.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def instant_after(timestamp):
+    """
+    Function that gets the first stored timestamp after a timestamp, used as an exclusive end that keeps rows taken at it.
+
+    Parameters:
+    timestamp (str): ISO timestamp in the stored format
+
+    Returns:
+    str: Timestamp one millisecond later
+    """
+    return normalize_timestamp(pd.Timestamp(timestamp) + pd.Timedelta(milliseconds = 1))
+
+def get_as_of(timestamp, symbol = None, waypointSymbol = None):
+    """
+    Function that gets the newest stored row at or before a timestamp for every trade good in the latest state table.
+    Each good is one seek on the (waypointSymbol, symbol, timestamp) index, however long ago it was last polled.
+
+    Parameters:
+    timestamp (str): ISO timestamp in the stored format
+    symbol (str or List of str): Only these trade goods
+    waypointSymbol (str or List of str): Only trade goods at these waypoints
+
+    Returns:
+    Tuple: pd.DataFrame of the rows found, and a list of (waypointSymbol, symbol) keys with no row at or before the timestamp in SQLite
+    """
+    conditions = []
+    params = [timestamp]
+    for c, v in {'symbol': symbol, 'waypointSymbol': waypointSymbol}.items():
+        if v is None:
+            continue
+        v = list(v) if isinstance(v, (list, tuple, set)) else [v]
+        conditions.append("k." + c + " IN (" + ", ".join("?" for i in v) + ")")
+        params.extend(v)
+    query = ("SELECT k.waypointSymbol AS keyWaypointSymbol, k.symbol AS keySymbol, " + ", ".join("t." + c for c in historyColumns)
+        + " FROM Market_TradeGoods_Latest k LEFT JOIN Market_TradeGoods t ON t.rowid = ("
+        + "SELECT h.rowid FROM Market_TradeGoods h WHERE h.waypointSymbol = k.waypointSymbol AND h.symbol = k.symbol AND h.timestamp <= ?"
+        + " ORDER BY h.timestamp DESC, h.rowid DESC LIMIT 1)")
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    conn = sqf.create_connection()
+    try:
+        df = pd.read_sql_query(query, con = conn, params = params)
+    finally:
+        sqf.close_connection(conn)
+    found = df['timestamp'].notna()
+    missing = list(zip(df.loc[~found, 'keyWaypointSymbol'], df.loc[~found, 'keySymbol']))
+    return df.loc[found, historyColumns].reset_index(drop = True), missing
+
+def state_as_of(history, timestamp):
+    """
+    Function that picks the state of each trade good at a point in time from stored rows.
+
+    Parameters:
+    history (pd.DataFrame): Stored rows with historyColumns
+    timestamp (str): ISO timestamp in the stored format
+
+    Returns:
+    pd.DataFrame: One row per waypoint and trade good, the newest row at or before the timestamp
+    """
+    history = history[history['timestamp'] <= timestamp].sort_values('timestamp', kind = 'stable')
+    return history.groupby(['waypointSymbol', 'symbol'], sort = True).tail(1).sort_values(['waypointSymbol', 'symbol']).reset_index(drop = True)
@@ -0,0 +1,423 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+import util.api_client as api
+import util.schema as schema
+import util.spatial as spatial
+import util.sqlite_functions as sqf
+
+#How long a stored universe is served before it is refreshed in the background
+defaultTtl = timedelta(hours = 24)
+
+#How often the server reset date is checked, each check costs one API call
+resetCheckInterval = timedelta(minutes = 30)
+
+#Columns stored in the Systems table, waypoints and factions live in the System_Waypoints and System_Factions child tables
+systemColumns = ["symbol", "sectorSymbol", "type", "x", "y"]
+waypointColumns = ["systemSymbol", "symbol", "type", "x", "y", "orbits"]
+factionColumns = ["systemSymbol", "factionSymbol"]
+
+#Table definitions, {name} is filled in with the live or staging table name
+waypointsTableSql = "CREATE TABLE {name} (systemSymbol TEXT NOT NULL, symbol TEXT NOT NULL, type TEXT, x INTEGER, y INTEGER, orbits TEXT, PRIMARY KEY (systemSymbol, symbol))"
+factionsTableSql = "CREATE TABLE {name} (systemSymbol TEXT NOT NULL, factionSymbol TEXT NOT NULL, PRIMARY KEY (systemSymbol, factionSymbol))"
+
+#Live table and create statement for every table the loader swaps, each load stages into its own <table>_Staging_<load id> copies
+universeTables = [
+    ("Systems", schema.systemsTableSql)
+    ,("System_Waypoints", waypointsTableSql)
+    ,("System_Factions", factionsTableSql)
+]
+
+#Secondary indexes, built after the swap so the bulk insert does not maintain them row by row
+universeIndexes = [
+    "CREATE INDEX IF NOT EXISTS idx_system_waypoints_type ON System_Waypoints (type)"
+    ,"CREATE INDEX IF NOT EXISTS idx_system_factions_faction ON System_Factions (factionSymbol)"
+]
+
+_refreshLock = threading.Lock()
+#Held for the whole of a load, so loads in this process run one at a time and a waiting caller sees the finished universe
+_loadLock = threading.Lock()
+_refreshThread = None
+_lastResetCheck = None
+
+#Seconds between checks of Universe_Meta for a universe loaded by another process, loads in this process reset the index directly
+indexCheckInterval = 60
+
+#Spatial index over the stored systems, rebuilt when the stored universe changes
+_indexLock = threading.Lock()
+_index = None
+_indexFetchedAt = None
+_indexCheckedAt = None
+
+_metaReady = False
+
+
+def ensure_meta_table():
+    """
+    Function that creates the Universe_Meta table if it does not exist.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    global _metaReady
+    if _metaReady:
+        return
+    conn = sqf.create_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS Universe_Meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.commit()
+    sqf.close_connection(conn)
+    _metaReady = True
+
+def get_meta():
+    """
+    Function that gets the fetch time and reset date of the stored universe.
+
+    Parameters:
+    None
+
+    Returns:
+    Dict: Dictionary with fetchedAt and resetDate, values are None if never fetched
+    """
+    ensure_meta_table()
+    conn = sqf.create_connection()
+    rows = conn.execute("SELECT key, value FROM Universe_Meta").fetchall()
+    sqf.close_connection(conn)
+    meta = {"fetchedAt": None, "resetDate": None}
+    meta.update(dict(rows))
+    return meta
+
+def set_meta(conn, fetchedAt, resetDate):
+    """
+    Function that records the fetch time and reset date of the stored universe.
+    Does not commit, so it can share a transaction with the Systems write.
+
+    Parameters:
+    conn (sqlite3.Connection): Connection to the SQLite database
+    fetchedAt (str): ISO timestamp of the fetch
+    resetDate (str): Server reset date at the time of the fetch
+
+    Returns:
+    None
+    """
+    conn.executemany(
+        "INSERT OR REPLACE INTO Universe_Meta (key, value) VALUES (?, ?)"
+        ,[("fetchedAt", fetchedAt), ("resetDate", resetDate)]
+    )
+
+def get_server_reset_date(token = None):
+    """
+    Function that gets the current reset date from the API status endpoint.
+
+    Parameters:
+    token (str): Token for the agent
+
+    Returns:
+    str: Reset date, None if the status could not be loaded
+    """
+    response = api.get_client(token).get("/")
+    if response.status_code == 200:
+        return response.json().get("resetDate")
+    else:
+        print(f"Error: {response.status_code} - {response.text}")
+        return None
+
+def is_stale(meta, resetDate = None, ttl = defaultTtl):
+    """
+    Function that checks if the stored universe needs a refresh.
+
+    Parameters:
+    meta (Dict): Dictionary from get_meta
+    resetDate (str): Current server reset date, None if unknown
+    ttl (timedelta): Maximum age of the stored universe
+
+    Returns:
+    bool: True if the universe was never fetched, is older than the ttl, or the server has reset since
+    """
+    if meta["fetchedAt"] is None:
+        return True
+    if resetDate is not None and resetDate != meta["resetDate"]:
+        return True
+    fetchedAt = datetime.fromisoformat(meta["fetchedAt"])
+    return datetime.now(timezone.utc) - fetchedAt > ttl
+
+def load_systems():
+    """
+    Function that loads the stored universe from the Systems table.
+
+    Parameters:
+    None
+
+    Returns:
+    pd.DataFrame: DataFrame containing system information, empty if nothing is stored
+    """
+    conn = sqf.create_connection()
+    df = pd.read_sql_query("SELECT " + ", ".join(systemColumns) + " FROM Systems", con = conn)
+    sqf.close_connection(conn)
+    return df
+
+def load_system_waypoints(systemSymbol = None):
+    """
+    Function that loads the waypoints stored for the universe, as listed by the systems endpoint.
+
+    Parameters:
+    systemSymbol (str): Only load waypoints of this system, None loads every system
+
+    Returns:
+    pd.DataFrame: DataFrame containing waypoint information
+    """
+    conn = sqf.create_connection()
+    query = "SELECT " + ", ".join(waypointColumns) + " FROM System_Waypoints"
+    params = []
+    if systemSymbol is not None:
+        query += " WHERE systemSymbol = ?"
+        params.append(systemSymbol)
+    try:
+        df = pd.read_sql_query(query, con = conn, params = params)
+    except Exception as e:
+        #Child tables only exist once the bulk loader has run
+        print(e)
+        df = pd.DataFrame(columns = waypointColumns)
+    sqf.close_connection(conn)
+    return df
+
+def _split_system(system):
+    """
+    Function that splits one system from the API into rows for Systems, System_Waypoints and System_Factions.
+
+    Parameters:
+    system (Dict): System from the systems endpoint
+
+    Returns:
+    Tuple: System row, list of waypoint rows, list of faction rows
+    """
+    systemRow = tuple(system.get(c) for c in systemColumns)
+    waypointRows = [
+        (system["symbol"], w["symbol"], w.get("type"), w.get("x"), w.get("y"), w.get("orbits"))
+        for w in system.get("waypoints", [])
+    ]
+    factionRows = [(system["symbol"], f["symbol"]) for f in system.get("factions", [])]
+    return systemRow, waypointRows, factionRows
+
+def _staging_tables(loadId):
+    """
+    Gets the staging table names of one load, so concurrent loads never touch each other's tables.
+
+    Parameters:
+    loadId (str): Id of the load
+
+    Returns:
+    List of Tuples: (live table, staging table, create statement) for each table in universeTables
+    """
+    return [(live, live + "_Staging_" + loadId, tableSql) for live, tableSql in universeTables]
+
+def _drop_staging(conn, stagingTables):
+    """
+    Function that drops the staging tables of a load.
+
+    Parameters:
+    conn (sqlite3.Connection): Connection to the SQLite database
+    stagingTables (List of Tuples): Output of _staging_tables
+
+    Returns:
+    None
+    """
+    for live, staging, tableSql in stagingTables:
+        conn.execute("DROP TABLE IF EXISTS " + staging)
+    conn.commit()
+
+def refresh_systems(token, resetDate = None):
+    """
+    Function that bulk loads the entire universe from the API.
+    Every page is streamed into staging tables as it arrives and committed on its own, so the write lock is only held
+    for one page's insert at a time and other writers are not locked out for the length of the crawl.
+    Once every page is in, the staging tables are swapped in for the live ones in one short transaction,
+    so readers see either the old universe or the new one, never a partial one.
+    Each load has its own staging tables and loads in this process run one at a time, so two loads never mix their pages.
+    If any page fails the staging tables are dropped and the stored universe is kept.
+
+    Parameters:
+    token (str): Token for the agent
+    resetDate (str): Current server reset date, looked up if not given
+
+    Returns:
+    pd.DataFrame: DataFrame containing system information
+    """
+    with _loadLock:
+        _load_systems(token, resetDate)
+    return load_systems()
+
+def _load_systems(token, resetDate):
+    """
+    Loads the universe into this load's staging tables and swaps them in, see refresh_systems.
+
+    Parameters:
+    token (str): Token for the agent
+    resetDate (str): Current server reset date, looked up if not given
+
+    Returns:
+    None
+    """
+    if resetDate is None:
+        resetDate = get_server_reset_date(token)
+    ensure_meta_table()
+    stagingTables = _staging_tables(uuid.uuid4().hex[:12])
+    systemsStaging, waypointsStaging, factionsStaging = [staging for live, staging, tableSql in stagingTables]
+    conn = sqf.create_connection()
+    cursor = conn.cursor()
+    systemCount = 0
+    try:
+        for live, staging, tableSql in stagingTables:
+            cursor.execute(tableSql.format(name = staging))
+        conn.commit()
+        for page in api.iter_pages(token, "/systems", raiseOnError = True):
+            systemRows = []
+            waypointRows = []
+            factionRows = []
+            for system in page:
+                systemRow, systemWaypoints, systemFactions = _split_system(system)
+                systemRows.append(systemRow)
+                waypointRows.extend(systemWaypoints)
+                factionRows.extend(systemFactions)
+            cursor.executemany("INSERT OR REPLACE INTO " + systemsStaging + " VALUES (?, ?, ?, ?, ?)", systemRows)
+            cursor.executemany("INSERT OR REPLACE INTO " + waypointsStaging + " VALUES (?, ?, ?, ?, ?, ?)", waypointRows)
+            cursor.executemany("INSERT OR REPLACE INTO " + factionsStaging + " VALUES (?, ?)", factionRows)
+            conn.commit()
+            systemCount += len(systemRows)
+        if systemCount == 0:
+            raise RuntimeError("No systems returned")
+        #Only the swap and the meta update hold the write lock
+        cursor.execute("BEGIN IMMEDIATE")
+        for live, staging, tableSql in stagingTables:
+            cursor.execute("DROP TABLE IF EXISTS " + live)
+            cursor.execute("ALTER TABLE " + staging + " RENAME TO " + live)
+        for indexSql in universeIndexes:
+            cursor.execute(indexSql)
+        set_meta(conn, datetime.now(timezone.utc).isoformat(), resetDate)
+        conn.commit()
+        invalidate_system_index()
+        print(f"Loaded {systemCount} systems")
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        print(f"Error loading systems, keeping the stored universe: {e}")
+        try:
+            _drop_staging(conn, stagingTables)
+        except Exception as dropError:
+            print(dropError)
+    finally:
+        sqf.close_connection(conn)
+
+def invalidate_system_index():
+    """
+    Function that drops the spatial index, the next lookup rebuilds it from the stored systems.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    global _index
+    with _indexLock:
+        _index = None
+
+def get_system_index():
+    """
+    Function that gets the spatial index over the stored systems.
+    The index is built once per universe load and served from memory. Loads in this process drop it straight away,
+    Universe_Meta is read at most once per indexCheckInterval to pick up loads by other processes.
+
+    Parameters:
+    None
+
+    Returns:
+    spatial.SystemIndex: Index over the systems in the Systems table
+    """
+    global _index, _indexFetchedAt, _indexCheckedAt
+    with _indexLock:
+        now = time.monotonic()
+        if _index is not None and now - _indexCheckedAt < indexCheckInterval:
+            return _index
+        fetchedAt = get_meta()["fetchedAt"]
+        _indexCheckedAt = now
+        if _index is None or fetchedAt != _indexFetchedAt:
+            _index = spatial.SystemIndex(load_systems())
+            _indexFetchedAt = fetchedAt
+        return _index
+
+def _check_and_refresh(token, ttl):
+    """
+    Function run on the background thread, refreshes the universe if it is stale.
+
+    Parameters:
+    token (str): Token for the agent
+    ttl (timedelta): Maximum age of the stored universe
+
+    Returns:
+    None
+    """
+    global _refreshThread
+    try:
+        resetDate = get_server_reset_date(token)
+        if is_stale(get_meta(), resetDate, ttl):
+            print("Refreshing stored universe in the background")
+            refresh_systems(token, resetDate)
+    except Exception as e:
+        print(e)
+    finally:
+        with _refreshLock:
+            _refreshThread = None
+
+def refresh_in_background(token, ttl = defaultTtl):
+    """
+    Function that starts a background check of the stored universe, unless one is already running.
+
+    Parameters:
+    token (str): Token for the agent
+    ttl (timedelta): Maximum age of the stored universe
+
+    Returns:
+    bool: True if a check was started
+    """
+    global _refreshThread
+    with _refreshLock:
+        if _refreshThread is not None:
+            return False
+        _refreshThread = threading.Thread(target = _check_and_refresh, args = (token, ttl), daemon = True)
+        _refreshThread.start()
+        return True
+
+def get_systems(token, ttl = defaultTtl):
+    """
+    Function that gets the universe, served from SQLite.
+    Only an empty Systems table blocks on the API. Otherwise the stored systems are returned right away and,
+    at most once per resetCheckInterval, a background thread refreshes them if the ttl has expired or the server has reset.
+
+    Parameters:
+    token (str): Token for the agent
+    ttl (timedelta): Maximum age of the stored universe
+
+    Returns:
+    pd.DataFrame: DataFrame containing system information
+    """
+    global _lastResetCheck
+    df = load_systems()
+    if df.empty:
+        #Callers that find the store empty at the same time wait for one load instead of each crawling the universe
+        with _loadLock:
+            df = load_systems()
+            if df.empty:
+                _load_systems(token, None)
+        return load_systems()
+    now = datetime.now(timezone.utc)
+    if _lastResetCheck is None or now - _lastResetCheck > resetCheckInterval:
+        _lastResetCheck = now
+        refresh_in_background(token, ttl)
+    return df
@@ -0,0 +1,511 @@
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+import util.api_client as api
+import util.sqlite_functions as sqf
+
+#How long each waypoint field stays fresh in seconds, None never expires
+#Coordinates and types do not change within a reset, traits and factions rarely do
+fieldTtls = {
+    "symbol": None
+    ,"systemSymbol": None
+    ,"type": None
+    ,"x": None
+    ,"y": None
+    ,"orbits": None
+    ,"orbitals": 24 * 3600
+    ,"faction": 24 * 3600
+    ,"chart": 24 * 3600
+    ,"traits": 6 * 3600
+    ,"isUnderConstruction": 3600
+    ,"modifiers": 300
+}
+
+#TTL for fields not listed in fieldTtls
+defaultFieldTtl = 3600
+
+#Fields the API leaves out of some waypoints, e.g. faction on unclaimed ones
+#A cached waypoint without one of them still answers for it until that field's TTL expires
+optionalFields = {"orbits", "faction", "chart"}
+
+#In memory copy of the cache, maps waypoint symbol to (data, fetchedAt)
+_memory = {}
+_memoryLock = threading.Lock()
+
+#Lookups currently waiting on the API, maps a waypoint or system key to a Future shared by every caller
+_inFlight = {}
+_inFlightLock = threading.Lock()
+
+#Systems whose waypoints were all fetched, maps system symbol to SystemWaypoints
+_systems = {}
+_systemsLock = threading.Lock()
+
+#How long a fetched system answers trait, type and faction queries in seconds
+systemTtl = fieldTtls["traits"]
+
+_tableReady = False
+
+
+class SystemWaypoints():
+    """
+    Class that represents every waypoint of one system with inverted indexes by trait, type and faction.
+
+    Attributes:
+    systemSymbol (str): Symbol for the system
+    waypoints (Dict): Maps waypoint symbol to waypoint data, in API order
+    byTrait (Dict): Maps trait symbol to a list of waypoints with that trait
+    byType (Dict): Maps waypoint type to a list of waypoints of that type
+    byFaction (Dict): Maps faction symbol to a list of waypoints of that faction
+    fetchedAt (float): Epoch time the waypoints were fetched
+    """
+    def __init__(self, systemSymbol, waypointList, fetchedAt):
+        """
+        Initializes a SystemWaypoints object and builds its indexes.
+
+        Parameters:
+        systemSymbol (str): Symbol for the system
+        waypointList (List of Dicts): Every waypoint of the system as returned by the API
+        fetchedAt (float): Epoch time the waypoints were fetched
+
+        Returns:
+        None
+        """
+        self.systemSymbol = systemSymbol
+        self.fetchedAt = fetchedAt
+        self.waypoints = {}
+        self.byTrait = {}
+        self.byType = {}
+        self.byFaction = {}
+        for w in waypointList:
+            self.waypoints[w["symbol"]] = w
+            for t in w.get("traits", []):
+                self.byTrait.setdefault(t["symbol"], []).append(w)
+            self.byType.setdefault(w.get("type"), []).append(w)
+            faction = w.get("faction")
+            if faction:
+                self.byFaction.setdefault(faction["symbol"], []).append(w)
+
+    def all(self):
+        """
+        Gets every waypoint of the system.
+
+        Parameters:
+        None
+
+        Returns:
+        List of Dicts: List of dicts containing waypoint information
+        """
+        return list(self.waypoints.values())
+
+    def get(self, waypointSymbol):
+        """
+        Gets one waypoint of the system.
+
+        Parameters:
+        waypointSymbol (str): Symbol for the waypoint
+
+        Returns:
+        Dict: Waypoint data, None if the waypoint is not in the system
+        """
+        return self.waypoints.get(waypointSymbol)
+
+    def with_trait(self, trait):
+        """
+        Gets the waypoints with a trait, e.g. MARKETPLACE or SHIPYARD.
+
+        Parameters:
+        trait (str): Trait symbol
+
+        Returns:
+        List of Dicts: List of dicts containing waypoint information
+        """
+        return self.byTrait.get(trait, [])
+
+    def of_type(self, waypointType):
+        """
+        Gets the waypoints of a type, e.g. FUEL_STATION or JUMP_GATE.
+
+        Parameters:
+        waypointType (str): Waypoint type
+
+        Returns:
+        List of Dicts: List of dicts containing waypoint information
+        """
+        return self.byType.get(waypointType, [])
+
+    def of_faction(self, factionSymbol):
+        """
+        Gets the waypoints of a faction.
+
+        Parameters:
+        factionSymbol (str): Faction symbol
+
+        Returns:
+        List of Dicts: List of dicts containing waypoint information
+        """
+        return self.byFaction.get(factionSymbol, [])
+
+    def query(self, trait = None, waypointType = None, factionSymbol = None):
+        """
+        Gets the waypoints matching every filter given.
+
+        Parameters:
+        trait (str): Trait symbol
+        waypointType (str): Waypoint type
+        factionSymbol (str): Faction symbol
+
+        Returns:
+        List of Dicts: List of dicts containing waypoint information, in API order
+        """
+        matches = None
+        for found in [
+            None if trait is None else self.with_trait(trait)
+            ,None if waypointType is None else self.of_type(waypointType)
+            ,None if factionSymbol is None else self.of_faction(factionSymbol)
+        ]:
+            if found is None:
+                continue
+            symbols = {w["symbol"] for w in found}
+            matches = symbols if matches is None else matches & symbols
+        if matches is None:
+            return self.all()
+        return [w for s, w in self.waypoints.items() if s in matches]
+
+    def markets(self):
+        """
+        Gets the waypoints with a marketplace.
+
+        Parameters:
+        None
+
+        Returns:
+        List of Dicts: List of dicts containing waypoint information
+        """
+        return self.with_trait("MARKETPLACE")
+
+    def shipyards(self):
+        """
+        Gets the waypoints with a shipyard.
+
+        Parameters:
+        None
+
+        Returns:
+        List of Dicts: List of dicts containing waypoint information
+        """
+        return self.with_trait("SHIPYARD")
+
+    def fuel_stations(self):
+        """
+        Gets the fuel station waypoints.
+
+        Parameters:
+        None
+
+        Returns:
+        List of Dicts: List of dicts containing waypoint information
+        """
+        return self.of_type("FUEL_STATION")
+
+
+def ensure_cache_table():
+    """
+    Function that creates the Waypoint_Cache and System_Waypoint_Fetches tables if they do not exist.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    global _tableReady
+    if _tableReady:
+        return
+    conn = sqf.create_connection()
+    conn.execute("CREATE TABLE IF NOT EXISTS Waypoint_Cache (symbol TEXT PRIMARY KEY, systemSymbol TEXT NOT NULL, data TEXT NOT NULL, fetchedAt REAL NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_waypoint_cache_system ON Waypoint_Cache (systemSymbol)")
+    conn.execute("CREATE TABLE IF NOT EXISTS System_Waypoint_Fetches (systemSymbol TEXT PRIMARY KEY, fetchedAt REAL NOT NULL)")
+    conn.commit()
+    sqf.close_connection(conn)
+    _tableReady = True
+
+def field_ttl(field):
+    """
+    Function that gets the TTL of a waypoint field.
+
+    Parameters:
+    field (str): Field name
+
+    Returns:
+    float: TTL in seconds, None if the field never expires
+    """
+    return fieldTtls.get(field, defaultFieldTtl)
+
+def is_fresh(data, fetchedAt, fields = None, now = None):
+    """
+    Function that checks if a cached waypoint can answer a lookup.
+
+    Parameters:
+    data (Dict): Cached waypoint data
+    fetchedAt (float): Epoch time the waypoint was fetched
+    fields (List of str): Fields the caller needs, None needs every cached field
+    now (float): Current epoch time
+
+    Returns:
+    bool: True if every needed field is cached, or is optional and left out by the API, and inside its TTL
+    """
+    if now is None:
+        now = time.time()
+    if fields is None:
+        fields = data.keys()
+    age = now - fetchedAt
+    for f in fields:
+        if f not in data and f not in optionalFields:
+            return False
+        ttl = field_ttl(f)
+        if ttl is not None and age > ttl:
+            return False
+    return True
+
+def _load_cached(waypointSymbol):
+    """
+    Function that gets a waypoint from the in memory cache, falling back to SQLite.
+
+    Parameters:
+    waypointSymbol (str): Symbol for the waypoint
+
+    Returns:
+    Tuple: (data, fetchedAt), None if the waypoint was never cached
+    """
+    with _memoryLock:
+        cached = _memory.get(waypointSymbol)
+    if cached is not None:
+        return cached
+    ensure_cache_table()
+    conn = sqf.create_connection()
+    row = conn.execute("SELECT data, fetchedAt FROM Waypoint_Cache WHERE symbol = ?", (waypointSymbol,)).fetchone()
+    sqf.close_connection(conn)
+    if row is None:
+        return None
+    cached = (json.loads(row[0]), row[1])
+    with _memoryLock:
+        _memory[waypointSymbol] = cached
+    return cached
+
+def store_waypoints(waypointList, fetchedAt = None):
+    """
+    Function that puts waypoints into the cache, in memory and in SQLite.
+
+    Parameters:
+    waypointList (List of Dicts): Waypoints as returned by the API
+    fetchedAt (float): Epoch time the waypoints were fetched, defaults to now
+
+    Returns:
+    None
+    """
+    if not waypointList:
+        return
+    if fetchedAt is None:
+        fetchedAt = time.time()
+    with _memoryLock:
+        for w in waypointList:
+            _memory[w["symbol"]] = (w, fetchedAt)
+    ensure_cache_table()
+    conn = sqf.create_connection()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO Waypoint_Cache (symbol, systemSymbol, data, fetchedAt) VALUES (?, ?, ?, ?)"
+            ,[(w["symbol"], w["systemSymbol"], json.dumps(w), fetchedAt) for w in waypointList]
+        )
+    sqf.close_connection(conn)
+
+def fetch_waypoint(token, systemSymbol, waypointSymbol):
+    """
+    Function that gets a waypoint from the API, bypassing the cache.
+
+    Parameters:
+    token (str): Token for the agent
+    systemSymbol (str): Symbol for the system
+    waypointSymbol (str): Symbol for the waypoint
+
+    Returns:
+    Dict: Waypoint data, None if the request failed
+    """
+    response = api.get_client(token).get(f"/systems/{systemSymbol}/waypoints/{waypointSymbol}")
+    if response.status_code == 200:
+        return response.json()['data']
+    else:
+        print(f"Error: {response.status_code} - {response.text}")
+        return None
+
+def _coalesce(key, fetch):
+    """
+    Function that runs a fetch, sharing one run between every concurrent caller with the same key.
+
+    Parameters:
+    key (str): Key identifying the fetch, e.g. a waypoint or system symbol
+    fetch (Callable): Function with no arguments doing the fetch
+
+    Returns:
+    Any: Result of the fetch
+    """
+    with _inFlightLock:
+        future = _inFlight.get(key)
+        leader = future is None
+        if leader:
+            future = Future()
+            _inFlight[key] = future
+    if not leader:
+        return future.result()
+    try:
+        result = fetch()
+        future.set_result(result)
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inFlightLock:
+            del _inFlight[key]
+    return result
+
+def _fetch_and_store(token, systemSymbol, waypointSymbol):
+    """
+    Function that fetches a waypoint from the API and puts it into the cache.
+
+    Parameters:
+    token (str): Token for the agent
+    systemSymbol (str): Symbol for the system
+    waypointSymbol (str): Symbol for the waypoint
+
+    Returns:
+    Dict: Waypoint data, None if the request failed
+    """
+    data = fetch_waypoint(token, systemSymbol, waypointSymbol)
+    if data is not None:
+        store_waypoints([data])
+    return data
+
+def get_waypoint(token, systemSymbol, waypointSymbol, fields = None):
+    """
+    Function that gets a waypoint, served from the cache while the needed fields are inside their TTL.
+
+    Parameters:
+    token (str): Token for the agent
+    systemSymbol (str): Symbol for the system
+    waypointSymbol (str): Symbol for the waypoint
+    fields (List of str): Fields the caller needs, None needs every field to be fresh
+
+    Returns:
+    Dict: Waypoint data, None if it is not cached and the request failed
+    """
+    cached = _load_cached(waypointSymbol)
+    if cached is not None and is_fresh(cached[0], cached[1], fields):
+        return cached[0]
+    return _coalesce("waypoint:" + waypointSymbol, lambda: _fetch_and_store(token, systemSymbol, waypointSymbol))
+
+def invalidate(waypointSymbol = None):
+    """
+    Function that drops waypoints from the cache.
+
+    Parameters:
+    waypointSymbol (str): Symbol for the waypoint, None drops every waypoint
+
+    Returns:
+    None
+    """
+    ensure_cache_table()
+    conn = sqf.create_connection()
+    with conn:
+        if waypointSymbol is None:
+            conn.execute("DELETE FROM Waypoint_Cache")
+            conn.execute("DELETE FROM System_Waypoint_Fetches")
+        else:
+            conn.execute("DELETE FROM Waypoint_Cache WHERE symbol = ?", (waypointSymbol,))
+    sqf.close_connection(conn)
+    with _memoryLock:
+        if waypointSymbol is None:
+            _memory.clear()
+        else:
+            _memory.pop(waypointSymbol, None)
+    if waypointSymbol is None:
+        with _systemsLock:
+            _systems.clear()
+
+def _load_system_from_db(systemSymbol, maxAge):
+    """
+    Function that rebuilds a system from SQLite if all its waypoints were fetched within maxAge.
+
+    Parameters:
+    systemSymbol (str): Symbol for the system
+    maxAge (float): Maximum age in seconds
+
+    Returns:
+    SystemWaypoints: Stored system, None if it was never fetched or is too old
+    """
+    ensure_cache_table()
+    conn = sqf.create_connection()
+    row = conn.execute("SELECT fetchedAt FROM System_Waypoint_Fetches WHERE systemSymbol = ?", (systemSymbol,)).fetchone()
+    if row is None or time.time() - row[0] > maxAge:
+        sqf.close_connection(conn)
+        return None
+    rows = conn.execute("SELECT data FROM Waypoint_Cache WHERE systemSymbol = ? ORDER BY rowid", (systemSymbol,)).fetchall()
+    sqf.close_connection(conn)
+    return SystemWaypoints(systemSymbol, [json.loads(r[0]) for r in rows], row[0])
+
+def _fetch_system(token, systemSymbol):
+    """
+    Function that fetches every page of a system's waypoints and puts them into the cache.
+
+    Parameters:
+    token (str): Token for the agent
+    systemSymbol (str): Symbol for the system
+
+    Returns:
+    SystemWaypoints: Fetched system, None if any page could not be fetched
+    """
+    fetchedAt = time.time()
+    #A partial system would answer trait and type queries with waypoints missing until systemTtl, so any failed page fails the fetch
+    waypointList = []
+    try:
+        for page in api.iter_pages(token, f"/systems/{systemSymbol}/waypoints", raiseOnError = True):
+            waypointList.extend(page)
+    except RuntimeError as e:
+        print(e)
+        return None
+    if not waypointList:
+        return None
+    store_waypoints(waypointList, fetchedAt)
+    conn = sqf.create_connection()
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO System_Waypoint_Fetches (systemSymbol, fetchedAt) VALUES (?, ?)", (systemSymbol, fetchedAt))
+    sqf.close_connection(conn)
+    return SystemWaypoints(systemSymbol, waypointList, fetchedAt)
+
+def get_system(token, systemSymbol, maxAge = None):
+    """
+    Function that gets every waypoint of a system with trait, type and faction indexes.
+    Served from memory, then SQLite, and fetched from the API only when older than maxAge.
+
+    Parameters:
+    token (str): Token for the agent
+    systemSymbol (str): Symbol for the system
+    maxAge (float): Maximum age in seconds, defaults to systemTtl
+
+    Returns:
+    SystemWaypoints: Waypoints of the system, empty if they could not be fetched
+    """
+    if maxAge is None:
+        maxAge = systemTtl
+    with _systemsLock:
+        system = _systems.get(systemSymbol)
+    if system is None or time.time() - system.fetchedAt > maxAge:
+        system = _load_system_from_db(systemSymbol, maxAge)
+        if system is None:
+            system = _coalesce("system:" + systemSymbol, lambda: _fetch_system(token, systemSymbol))
+        if system is None:
+            return SystemWaypoints(systemSymbol, [], 0)
+        with _systemsLock:
+            _systems[systemSymbol] = system
+    return system